@@ -0,0 +1,91 @@
+import argparse, sys
+
+# `python -m tncture COMMAND ...`. Nothing beyond argparse is imported up
+# front: each command pulls in only its own subsystem, so a scripted dial
+# doesn't pay for textual, and `monitor` or `bench` don't pay for the dialers.
+
+# Commands that hand the rest of the line to an existing main(argv)
+PASSTHROUGH = {
+	'monitor': ('tncture.monitor.capture', "Record, show and convert packet captures, `monitor sessions ...` to follow connections, or `monitor mheard ...` for heard stations"),
+	'node': (None, "Run a node: shard MYCALL [--workers N] | digi MYCALL [ALIAS ...]"),
+	'bench': (None, "Run the offline benchmarks, `bench shard ...` for the node benchmark, or `bench loadgen ...` to load-test a node"),
+	'trace': ('tncture.trace', "Decode a protocol trace dump"),
+	'profile': ('tncture.profiler', "Run a module's main() under the stack sampler: profile MODULE [ARGS ...]"),
+	'hub': ('tncture.transport.kisshub', "Share one KISS TNC among local clients (serves KISS on localhost:8101)"),
+}
+
+NODES = {
+	'shard': 'tncture.node.shard',
+	'digi': 'tncture.node.digipeater',
+}
+
+def build_parser():
+	from .dial.args import add_session_arguments
+
+	parser = argparse.ArgumentParser(prog='tncture')
+	commands = parser.add_subparsers(dest='command', metavar='COMMAND', required=True)
+
+	add_session_arguments(commands.add_parser('dial', help="Line-mode client on stdin/stdout"))
+
+	tui = add_session_arguments(commands.add_parser('tui', help="Full-screen client"))
+	tui.add_argument('--snoop', action='store_true', help="Only watch the channel, don't connect")
+	tui.add_argument('--history', type=int, default=5000, metavar='N', help="Lines/rows kept in each view")
+
+	xfer = add_session_arguments(commands.add_parser('xfer', help="YAPP file transfer"))
+	xfer.add_argument('action', choices=('send', 'recv'))
+	xfer.add_argument('path', metavar='FILE|DIR')
+
+	for name, (_, description) in PASSTHROUGH.items():
+		commands.add_parser(name, help=description, add_help=False)
+	return parser
+
+def run_passthrough(command, rest):
+	from importlib import import_module
+
+	module = PASSTHROUGH[command][0]
+	if command == 'node':
+		if not rest or rest[0] not in NODES:
+			print(f"Usage: tncture node ({' | '.join(NODES)}) ...")
+			return 1
+		module, command, rest = NODES[rest[0]], f'node {rest[0]}', rest[1:]
+	elif command == 'monitor' and rest and rest[0] in ('sessions', 'mheard'):
+		module, command, rest = f'tncture.monitor.{rest[0]}', f'monitor {rest[0]}', rest[1:]
+	elif command == 'bench':
+		if rest and rest[0] == 'shard':
+			module, command, rest = 'tncture.bench.shard', 'bench shard', rest[1:]
+		elif rest and rest[0] == 'loadgen':
+			module, command, rest = 'tncture.bench.loadgen', 'bench loadgen', rest[1:]
+		else:
+			module = 'tncture.bench.suite'
+	return import_module(module).main([f'tncture {command}'] + rest)
+
+def main(argv):
+	# `kill -USR2` starts and stops the stack sampler in any command
+	from .profiler import install_signal_toggle
+	install_signal_toggle(on_toggle=lambda path: print(
+		"[profiler] Sampling..." if path is None else f"[profiler] Profile written to {path}", file=sys.stderr))
+
+	if len(argv) > 1 and argv[1] in PASSTHROUGH:
+		# Their own parsers handle the arguments, including --help
+		return run_passthrough(argv[1], argv[2:])
+
+	parser = build_parser()
+	args = parser.parse_args(argv[1:])
+	if args.command == 'tui' and args.snoop and args.agw_offload:
+		parser.error("--snoop needs raw frames, which --agw-offload doesn't see")
+
+	from .dial.args import session_from_args
+	session = session_from_args(args)
+
+	if args.command == 'dial':
+		from .dial.cli import run_ui
+		run_ui(session)
+	elif args.command == 'tui':
+		from .dial.tui import run_ui
+		run_ui(session, args.history, args.snoop)
+	elif args.command == 'xfer':
+		from .dial.xfer import run_transfer
+		run_transfer(session, args.action, args.path)
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
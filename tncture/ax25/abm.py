@@ -1,12 +1,21 @@
+from collections import deque
 from enum import Enum
 from .frame import *
-import time
+from .compress import PayloadCompression, PID_TEXT, PID_COMPRESSED, XID_PI_COMPRESSION, COMPRESSION_VERSION
+from ..metrics import REGISTRY, CounterSet, FAST_BUCKETS
+from ..trace import TraceRing, TraceEvents as TE, frame_args
+import itertools, time
+
+# Tells apart the series of sessions with the same call pair that overlap, e.g.
+# a reconnect while the old session is still tearing down
+SESSION_IDS = itertools.count(1)
 
 class Timer:
 	def __init__(self, name, timeout):
 		self.name = name
 		self.timeout = timeout
 		self.started = None
+		self.remaining = None # Time left when paused
 
 	@property
 	def running(self):
@@ -20,11 +29,76 @@ class Timer:
 	def elapsed(self):
 		return time.time() - self.started
 
+	@property
+	def deadline(self):
+		if self.running:
+			return self.started + self.timeout
+
 	def start(self, bonus_time=0):
 		self.started = time.time() + bonus_time
+		self.remaining = None
 
 	def stop(self):
 		self.started = None
+		self.remaining = None
+
+	def pause(self):
+		if self.running:
+			self.remaining = self.deadline - time.time()
+			self.started = None
+
+	def resume(self):
+		if self.remaining is not None:
+			self.started = time.time() + self.remaining - self.timeout
+			self.remaining = None
+
+class ByteQueue:
+	# Outgoing stream kept as a list of chunks, so appending another connection's
+	# received payload stores a reference instead of copying the whole backlog
+	def __init__(self, data=b''):
+		self.chunks = deque()
+		self.length = 0
+		self.append(data)
+
+	def append(self, data):
+		if data:
+			self.chunks.append(memoryview(data))
+			self.length += len(data)
+
+	def __iadd__(self, data):
+		self.append(data)
+		return self
+
+	def __len__(self):
+		return self.length
+
+	def __bool__(self):
+		return self.length > 0
+
+	def take(self, n):
+		# Up to n bytes from the front
+		out = []
+		while self.chunks and n > 0:
+			chunk = self.chunks[0]
+			if len(chunk) <= n:
+				self.chunks.popleft()
+			else:
+				self.chunks[0] = chunk[n:]
+				chunk = chunk[:n]
+			out.append(chunk)
+			n -= len(chunk)
+			self.length -= len(chunk)
+		return b''.join(out)
+
+	def clear(self):
+		self.chunks.clear()
+		self.length = 0
+
+	def __bytes__(self):
+		return b''.join(self.chunks)
+
+	def __repr__(self):
+		return repr(bytes(self))
 
 class AX25ConnectedModeConnection:
 	class States(Enum):
@@ -33,13 +107,23 @@ class AX25ConnectedModeConnection:
 		DISCONNECTING = 2 # Sending DISC
 		DISCONNECTED = 3  # Closed
 
-	def __init__(self, port, mycall, theircall):
+	def __init__(self, port, mycall, theircall, incoming=False, compression=False, via=()):
 		self.mycall = mycall
 		self.theircall = theircall
+		self.via = [AX25Address.parse(v) if isinstance(v, str) else v for v in via] # Digipeaters, in order
 		self.port = port
 
-		self.stream_outgoing = b''
+		self._stream_outgoing = ByteQueue()
 		self.stream_incoming = b''
+		self.on_data = None # If set, called with received payload instead of appending to stream_incoming
+		self.on_drain = lambda:None # Called after bytes are taken from stream_outgoing, and again once they're acknowledged
+		self.drain_due = False
+		self.on_disconnect = lambda:None
+
+		self.link_up = True # Last seen state of the port's link to the TNC
+		self.busy = False # We can't take more I-frames; RNR the other end
+		self.peer_busy = False # The other end sent RNR
+		self.last_heard = None # When a frame from the other end last arrived
 
 		self.vs = 0 # Send State Variable
 		#self.ns = 0 # Send Sequence Number
@@ -50,6 +134,9 @@ class AX25ConnectedModeConnection:
 		self.window_size = 8
 
 		self.state = self.States.CONNECTING
+		self.accept_incoming = incoming # Wait for the other end's SABM instead of sending one
+		if incoming:
+			self.state = self.States.DISCONNECTED
 
 		self.keepalive_timer = Timer('keepalive', 30)
 		self.retransmit_timer = Timer('retransmit', 10)
@@ -57,27 +144,81 @@ class AX25ConnectedModeConnection:
 
 		self.mtu = 200
 		self.pending_ack_frame = None
+		self.pending_ack_pid = PID_TEXT
+
+		# Offered to the other end by XID once connected; only used if it agrees
+		self.compression = PayloadCompression() if compression else None
 
 		self.faultinject = False
 
 		self._base_cmd = self._base_frame(0, 1)
 		self._base_rsp = self._base_frame(1, 0)
 
-		self.debug_print = lambda *a, **k: None
+		self.trace = TraceRing()
+		self.trace_dump_path = None # Where to dump the trace if poll() raises
+
+		labels = self.metric_labels = {'connection': f"{mycall}>{theircall}", 'session': str(next(SESSION_IDS))}
+		self.m_frames_tx = CounterSet(REGISTRY, 'tncture_abm_frames_tx_total', 'Frames sent by type', 'type', **labels)
+		self.m_frames_rx = CounterSet(REGISTRY, 'tncture_abm_frames_rx_total', 'Frames received by type', 'type', **labels)
+		self.m_bytes_tx = REGISTRY.counter('tncture_abm_bytes_tx_total', 'Encoded frame bytes sent', **labels)
+		self.m_bytes_rx = REGISTRY.counter('tncture_abm_bytes_rx_total', 'Encoded frame bytes received', **labels)
+		self.m_retransmits = REGISTRY.counter('tncture_abm_retransmits_total', 'I-frames sent again', **labels)
+		self.m_timer_expired = CounterSet(REGISTRY, 'tncture_abm_timer_expirations_total', 'Timer expirations acted on', 'timer', **labels)
+		self.m_rtt = REGISTRY.histogram('tncture_abm_rtt_seconds', 'I-frame to acknowledgement time, first transmissions only', **labels)
+		self.m_queue = REGISTRY.gauge('tncture_abm_queue_bytes', 'Bytes waiting in stream_outgoing', **labels)
+		self.m_poll_cpu = REGISTRY.histogram('tncture_abm_poll_cpu_seconds', 'Thread CPU time per poll()', **labels)
+		self.m_poll_time = REGISTRY.histogram('tncture_abm_poll_seconds', 'Wall-clock time per poll()', FAST_BUCKETS, **labels)
+		self.m_payload = CounterSet(REGISTRY, 'tncture_abm_payload_bytes_total', 'I-frame payload before and after compression', 'stage', **labels)
+		self.pending_ack_sent = None # Time the pending frame was first sent, None once retransmitted
+
+	@property
+	def stream_outgoing(self):
+		return self._stream_outgoing
+
+	@stream_outgoing.setter
+	def stream_outgoing(self, data):
+		if data is not self._stream_outgoing:
+			self._stream_outgoing = ByteQueue(data)
+
+	@property
+	def transport(self):
+		return self.port.transport
+
+	def pending(self):
+		return self.port.pending()
+
+	def next_deadline(self):
+		# Earliest time poll() has timer work to do, for callers that sleep between polls
+		if self.state == self.States.DISCONNECTED or not self.link_up:
+			return None
+		deadlines = [t.deadline for t in (self.retransmit_timer, self.keepalive_timer, self.burst_recieve_timer) if t.running]
+		if self.state == self.States.CONNECTING and not self.retransmit_timer.running:
+			deadlines.append(0)
+		if self.state == self.States.CONNECTED and self.stream_outgoing and self.vs == self.va and not self.peer_busy:
+			deadlines.append(0) # Can send right away
+		return min(deadlines, default=None)
 
 	def _base_frame(self, self_c, other_c):
 		return (
 			AX25SourceAddress(self.mycall.callsign, self.mycall.ssid, c=self_c),
-			AX25DestinationAddress(self.theircall.callsign, self.theircall.ssid, c=other_c)
+			AX25DestinationAddress(self.theircall.callsign, self.theircall.ssid, c=other_c),
+			[AX25RepeaterAddress(v.callsign, v.ssid) for v in self.via]
 		)
 
 	def send_frame(self, frame):
 		if self.faultinject and frame.data==b'B\r':
 			self.faultinject = False
-			self.debug_print("FAULT-INJECT NO RX")
+			self.trace.record(TE.FAULT_INJECT)
 			return
-		self.debug_print("AX25ConnectedModeConnection: send:", frame)
-		return self.port.send_data_frame(encode_ax25_frame(frame, 8))
+		self.trace.record(TE.SEND, *frame_args(frame))
+		encoded = encode_ax25_frame(frame, 8)
+		self.m_frames_tx[frame.typename].inc()
+		self.m_bytes_tx.inc(len(encoded))
+		return self.port.send_data_frame(encoded)
+
+	def drained(self):
+		# Everything queued has been sent and acknowledged
+		return not self.stream_outgoing and self.pending_ack_frame is None
 
 	def initiate_disconnection(self):
 		self.state = self.States.DISCONNECTING
@@ -90,34 +231,128 @@ class AX25ConnectedModeConnection:
 		self.retransmit_timer.stop()
 		self.burst_recieve_timer.stop()
 		self.keepalive_timer.stop()
+		self.release_metrics() # A closed connection stays closed
+		self.on_disconnect()
+
+	def release_metrics(self):
+		# Drop this connection's series from the registry; also for owners
+		# that abandon a session without it ever disconnecting
+		REGISTRY.remove(**self.metric_labels)
+
+	def set_busy(self, busy):
+		# Flow control from whoever consumes our received data: RNR stops the other
+		# end sending I-frames until we RR again
+		if busy == self.busy:
+			return
+		self.busy = busy
+		if self.state == self.States.CONNECTED:
+			self.trace.record(TE.BUSY_SET if busy else TE.BUSY_CLEAR)
+			self.send_frame(AX25Frame(
+				*self._base_rsp,
+				AX25SControl(ss=SFrameTypes.RNR if busy else SFrameTypes.RR, nr=self.vr, pf=0)
+			))
+			self.burst_recieve_timer.stop()
+
+	def accept_connection(self):
+		self.vs = self.vr = self.va = 0
+		self.pending_ack_frame = None
+		self.pending_ack_sent = None
+		self.peer_busy = False
+		if self.compression:
+			self.compression.reset()
+		self.state = self.States.CONNECTED
+		self.retransmit_timer.stop()
+		self.keepalive_timer.start()
+		self.send_UA()
+
+	def send_XID(self, command):
+		params = {XID_PI_COMPRESSION: COMPRESSION_VERSION} if self.compression else {}
+		self.trace.record(TE.XID_SENT, int(command), int(bool(params)))
+		self.send_frame(AX25Frame(
+			*(self._base_cmd if command else self._base_rsp),
+			AX25UControl(UFrameTypes.XID, pf=1),
+			[], encode_xid_params(params)
+		))
+
+	def compression_stats(self, bitrate=1200):
+		return self.compression.stats(bitrate) if self.compression else None
 
 	def send_UA(self):
 		self.send_frame(AX25Frame(
-			*self._base_rsp, [],
+			*self._base_rsp,
 			AX25UControl(UFrameTypes.UA, pf=1)
 		))
 
 	def poll(self):
-		dbg = self.debug_print
+		t0 = time.thread_time()
+		w0 = time.perf_counter()
+		try:
+			self._poll()
+			if self.drain_due:
+				# After the frame is handled, so the callback sees (and can
+				# change) the connection as it's left
+				self.drain_due = False
+				self.on_drain()
+		except Exception:
+			if self.trace_dump_path:
+				self.trace.dump(self.trace_dump_path)
+			raise
+		finally:
+			self.m_queue.set(len(self.stream_outgoing))
+			self.m_poll_cpu.observe(time.thread_time() - t0)
+			self.m_poll_time.observe(time.perf_counter() - w0)
+
+	def _ack_pending(self):
+		if self.pending_ack_sent is not None:
+			self.m_rtt.observe(time.time() - self.pending_ack_sent)
+		self.pending_ack_frame = None
+		self.pending_ack_sent = None
+		self.drain_due = True
+
+	def _link_changed(self, up):
+		# Nothing gets through while the TNC is away, so hold the timers rather
+		# than spend retries and keep-alives on it
+		self.link_up = up
+		self.trace.record(TE.LINK_UP if up else TE.LINK_DOWN)
+		for timer in (self.retransmit_timer, self.keepalive_timer, self.burst_recieve_timer):
+			timer.resume() if up else timer.pause()
+
+	def _poll(self):
+		tr = self.trace.record
+
+		link_up = getattr(self.port, 'link_up', True)
+		if link_up != self.link_up:
+			self._link_changed(link_up)
+		if not link_up:
+			return
 
-		newmsg = self.port.recieve_data_frame()
+		newmsg = raw = self.port.recieve_data_frame()
 		if newmsg:
 			newmsg = parse_ax25_frame(newmsg, 8)
 			if newmsg:
 				if (not newmsg.dest.same_station(self.mycall)) or (not newmsg.source.same_station(self.theircall)):
 					newmsg = None
+				else:
+					self.m_frames_rx[newmsg.typename].inc()
+					self.m_bytes_rx.inc(len(raw))
+					self.last_heard = time.time()
 
 		if self.state == self.States.DISCONNECTED:
 			if newmsg:
-				if newmsg.control.mmmmm == UFrameTypes.DISC:
-					dbg("Got DISC while DISCONNECTED, send UA again")
+				tr(TE.RECV, *frame_args(newmsg))
+				if newmsg.frametype == 'U' and newmsg.control.mmmmm == UFrameTypes.SABM and self.accept_incoming:
+					tr(TE.SABM_ACCEPTED)
+					self.accept_incoming = False
+					self.accept_connection()
+				elif newmsg.frametype == 'U' and newmsg.control.mmmmm == UFrameTypes.DISC:
+					tr(TE.DISC_WHILE_DISCONNECTED)
 					self.send_UA()
 				else:
-					dbg("??? frame while DISCONNECTED")
+					tr(TE.FRAME_WHILE_DISCONNECTED)
 			return
 
 		if newmsg:
-			dbg("AX25ConnectedModeConnection: recv:", newmsg)
+			tr(TE.RECV, *frame_args(newmsg))
 			self.keepalive_timer.start()
 
 		if self.state == self.States.CONNECTING and not self.retransmit_timer.running:
@@ -127,31 +362,63 @@ class AX25ConnectedModeConnection:
 			if newmsg.frametype == 'U':
 				if self.state == self.States.CONNECTING:
 					if newmsg.control.mmmmm == UFrameTypes.UA:
-						dbg("Got UA, going CONNECTING -> CONNECTED")
+						tr(TE.UA_CONNECTED)
 						self.state = self.States.CONNECTED
 						self.retransmit_timer.stop()
 						self.keepalive_timer.start()
+						if self.compression:
+							self.compression.reset()
+							self.send_XID(command=True)
 
 					if newmsg.control.mmmmm == UFrameTypes.DM:
-						dbg("Got DM, going CONNECTING -> DISCONNECTED")
+						tr(TE.DM_DISCONNECTED)
 						self.disconnect()
 
 				if self.state == self.States.DISCONNECTING:
 					if newmsg.control.mmmmm == UFrameTypes.UA:
-						dbg("Got UA, going CONNECTED -> DISCONNECTED")
+						tr(TE.UA_DISCONNECTED)
 						self.disconnect()
 				
 				if self.state == self.States.CONNECTED:
 					if newmsg.control.mmmmm == UFrameTypes.DISC:
-						dbg("Got DISC, going CONNECTED -> DISCONNECTED")
+						tr(TE.DISC_DISCONNECTED)
 						self.disconnect()
 						self.send_UA()
+					elif newmsg.control.mmmmm == UFrameTypes.SABM:
+						# Our UA got lost, or the other end restarted the link
+						tr(TE.SABM_RESET)
+						self.accept_connection()
+						return
+					elif newmsg.control.mmmmm == UFrameTypes.XID and self.compression:
+						agreed = parse_xid_params(newmsg.data).get(XID_PI_COMPRESSION) == COMPRESSION_VERSION
+						tr(TE.XID_RECEIVED, int(newmsg.dest.c), int(agreed))
+						self.compression.tx_enabled = agreed
+						if newmsg.dest.c:
+							self.send_XID(command=False)
 
 			if self.state == self.States.CONNECTED and newmsg.frametype == 'I':
 				self.va = newmsg.control.nr
-				if newmsg.control.ns == self.vr:
-					dbg("Accept I frame: ", newmsg.data)
-					self.stream_incoming += newmsg.data
+				if self.va == self.vs and self.pending_ack_frame:
+					# Acknowledged by N(R) of their I-frame
+					self._ack_pending()
+					self.retransmit_timer.stop()
+				if self.busy:
+					# Discard it, the other end resends after we RR
+					tr(TE.BUSY_DISCARD, newmsg.control.ns)
+					self.send_frame(AX25Frame(
+						*self._base_rsp,
+						AX25SControl(ss=SFrameTypes.RNR, nr=self.vr, pf=newmsg.control.pf)
+					))
+					self.burst_recieve_timer.stop()
+				elif newmsg.control.ns == self.vr:
+					tr(TE.ACCEPT_I, newmsg.control.ns, len(newmsg.data))
+					data = newmsg.data
+					if list(newmsg.pid) == [PID_COMPRESSED] and self.compression:
+						data = self.compression.decompress(data)
+					if self.on_data:
+						self.on_data(data)
+					else:
+						self.stream_incoming += data
 					self.vr = (newmsg.control.ns + 1) % self.window_size
 					self.vr_needs_sending = True
 					self.burst_recieve_timer.start(5 if newmsg.control.pf == 0 else 0)
@@ -159,110 +426,145 @@ class AX25ConnectedModeConnection:
 					# out of order
 					# TODO: Restricts to non-selective reject
 					if newmsg.control.pf:
-						dbg("Out of order I-frame, REJ")
+						tr(TE.OUT_OF_ORDER_REJ, newmsg.control.ns, self.vr)
 						self.send_frame(AX25Frame(
-							*self._base_rsp, [],
+							*self._base_rsp,
 							AX25SControl(ss=SFrameTypes.REJ, nr=self.vr, pf=1)
 						))
 						self.burst_recieve_timer.stop() # REJ includes ACK
 					else:
-						dbg("Got out of order I-frame with PF=0, ignoring for now")
+						tr(TE.OUT_OF_ORDER_IGNORED, newmsg.control.ns, self.vr)
 			
 			if self.state == self.States.CONNECTED and newmsg.frametype == 'S':
+				if newmsg.control.ss == SFrameTypes.RNR:
+					tr(TE.RNR_RX, newmsg.control.nr)
+					self.peer_busy = True
+					self.va = newmsg.control.nr
+					if self.va == self.vs and self.pending_ack_frame:
+						self._ack_pending()
+						self.retransmit_timer.stop()
+
 				if newmsg.control.ss == SFrameTypes.RR:
 					self.va = newmsg.control.nr
+					if self.peer_busy:
+						tr(TE.PEER_READY)
+						self.peer_busy = False
+						if self.va != self.vs and self.pending_ack_frame:
+							self.retransmit_timer.start(-1000) # Resend what it discarded now
 					if newmsg.dest.c:
-						dbg("Receive polling acknowledgement, reply")
+						tr(TE.RR_POLL)
 						self.burst_recieve_timer.start()
 						# This is to work around LinBPQ queueing multiple RR requests in a row
 						# and then freaking out when it gets multiple responses
 
 						# self.send_frame(AX25Frame(
-						# 	*self._base_rsp, [], #C/C bits backwards
+						# 	*self._base_rsp, #C/C bits backwards
 						# 	AX25SControl(ss=SFrameTypes.RR, nr=self.vr, pf=1)
 						# ))
 						# self.burst_recieve_timer.stop()
 					else:
-						dbg("Receive normal acknowledgement")
+						tr(TE.RR_ACK)
 
 					if self.va == self.vs:
-						self.pending_ack_frame = None
+						if self.pending_ack_frame:
+							self._ack_pending()
 						self.retransmit_timer.stop()
 					else:
-						dbg("Recieved ACK for past frame")
+						tr(TE.RR_PAST, newmsg.control.nr, self.vs)
 						pass # Should resend because this ack was for a past frame
 					
 				elif newmsg.control.ss == SFrameTypes.REJ:
-					if self.pending_ack_frame:
-						print("REJ for pending frame, resend")
+					self.va = newmsg.control.nr
+					if self.va == self.vs and self.pending_ack_frame:
+						# They already have it and only the ack went missing, e.g.
+						# across a TNC restart; resending would just draw another REJ
+						tr(TE.REJ_IGNORED)
+						self._ack_pending()
+						self.retransmit_timer.stop()
+					elif self.pending_ack_frame:
+						tr(TE.REJ_RESEND)
+						self.m_retransmits.inc()
+						self.pending_ack_sent = None
 						self.send_frame(AX25Frame(
-							*self._base_cmd, [],
+							*self._base_cmd,
 							AX25IControl(ns=self.vs, nr=self.vr, pf=1),
-							[0xf0],
+							[self.pending_ack_pid],
 							self.pending_ack_frame
 						))
 						self.retransmit_timer.start()
 					else:
-						print("REJ for ACKed frame, ignore")
+						tr(TE.REJ_IGNORED)
 
 		newvr = (self.vs + 1) % self.window_size
 		# TODO: Restricts to exactly one outstanding TX frame
 		if self.state == self.States.CONNECTED and self.stream_outgoing:
-			if self.vs == self.va:
-				dbg("TX frame")
-				frame = self.stream_outgoing[:self.mtu]
-				self.stream_outgoing = self.stream_outgoing[self.mtu:]
+			if self.vs == self.va and not self.peer_busy:
+				tr(TE.TX_I, self.vs, min(len(self.stream_outgoing), self.mtu))
+				frame = self.stream_outgoing.take(self.mtu)
+				self.m_payload['raw'].inc(len(frame))
+				pid = PID_TEXT
+				if self.compression:
+					pid, frame = self.compression.compress(frame)
+				self.m_payload['sent'].inc(len(frame))
 				self.send_frame(AX25Frame(
-					*self._base_cmd, [],
+					*self._base_cmd,
 					AX25IControl(ns=self.vs, nr=self.vr, pf=1),
-					[0xf0],
+					[pid],
 					frame
 				))
 				self.pending_ack_frame = frame
+				self.pending_ack_pid = pid
+				self.pending_ack_sent = time.time()
 				self.vs = newvr
 				self.burst_recieve_timer.stop()
 				self.retransmit_timer.start()
+				self.drain_due = True
 				return
 			else:
-				dbg("Have outstanding data, can't TX")
+				tr(TE.TX_BLOCKED)
 		
 		if self.state == self.States.CONNECTING and self.retransmit_timer.expired:
-			dbg("Transmit SABM")
+			tr(TE.TX_SABM)
 			self.send_frame(AX25Frame(
-				*self._base_cmd, [],
+				*self._base_cmd,
 				AX25UControl(UFrameTypes.SABM, pf=1)
 			))
 			self.retransmit_timer.start()
 		elif self.state == self.States.CONNECTED:
 			if self.pending_ack_frame and self.retransmit_timer.expired:
-				dbg("Resend I-frame")
+				tr(TE.RESEND_I, (self.vs - 1) % self.window_size)
+				self.m_timer_expired['retransmit'].inc()
+				self.m_retransmits.inc()
+				self.pending_ack_sent = None
 				self.send_frame(AX25Frame(
-					*self._base_cmd, [],
+					*self._base_cmd,
 					AX25IControl(ns=(self.vs - 1) % self.window_size, nr=self.vr, pf=1),
-					[0xf0],
+					[self.pending_ack_pid],
 					self.pending_ack_frame
 				))
 				self.retransmit_timer.start()
 			elif self.keepalive_timer.expired:
 				# Keep-alive
-				dbg("Send keep-alive")
+				tr(TE.KEEPALIVE)
+				self.m_timer_expired['keepalive'].inc()
 				self.send_frame(AX25Frame(
-					*self._base_cmd, [],
+					*self._base_cmd,
 					AX25SControl(ss=SFrameTypes.RR, nr=self.vr, pf=1)
 				))
 				self.keepalive_timer.start()
 		elif self.state == self.States.DISCONNECTING and self.retransmit_timer.expired:
-			dbg("Transmit DISC")
+			tr(TE.TX_DISC)
 			self.send_frame(AX25Frame(
-				*self._base_cmd, [],
+				*self._base_cmd,
 				AX25UControl(UFrameTypes.DISC, pf=1)
 			))
 			self.retransmit_timer.start()
 
 		if (not newmsg) and self.burst_recieve_timer.expired:
-			dbg("Send delayed RR")
+			tr(TE.DELAYED_RR)
+			self.m_timer_expired['burst_recieve'].inc()
 			self.send_frame(AX25Frame(
-				*self._base_rsp, [],
-				AX25SControl(ss=SFrameTypes.RR, nr=self.vr, pf=1)
+				*self._base_rsp,
+				AX25SControl(ss=SFrameTypes.RNR if self.busy else SFrameTypes.RR, nr=self.vr, pf=1)
 			))
 			self.burst_recieve_timer.stop()
\ No newline at end of file
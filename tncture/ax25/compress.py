@@ -0,0 +1,57 @@
+import zlib
+
+# Optional deflate compression of I-frame payloads between tncture peers. Each
+# direction is one zlib stream carried across I-frames and sync-flushed at the
+# end of every frame, so the receiver can always decode what it has. Compressed
+# frames use a private PID so anything else on the link still reads as text.
+
+PID_TEXT = 0xF0
+PID_COMPRESSED = 0xF1
+XID_PI_COMPRESSION = 0xF1 # Private XID parameter; value is the stream format version
+COMPRESSION_VERSION = b'\x01'
+
+class PayloadCompression:
+	def __init__(self, level=6):
+		self.level = level
+		self.reset()
+
+	def reset(self):
+		# New link: both streams start over, and the other end has to agree again
+		self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+		self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+		self.tx_enabled = False
+		self.raw_bytes = 0 # Payload handed to us to send
+		self.sent_bytes = 0 # Payload actually sent after compression
+		self.frames_compressed = 0
+		self.frames_plain = 0
+
+	def compress(self, data):
+		# (pid, payload) for one I-frame's worth of data. Frames that wouldn't
+		# shrink go out plain and stay out of the compressor's history.
+		self.raw_bytes += len(data)
+		if self.tx_enabled:
+			trial = self.compressor.copy()
+			out = trial.compress(data) + trial.flush(zlib.Z_SYNC_FLUSH)
+			if len(out) < len(data):
+				self.compressor = trial
+				self.frames_compressed += 1
+				self.sent_bytes += len(out)
+				return PID_COMPRESSED, out
+		self.frames_plain += 1
+		self.sent_bytes += len(data)
+		return PID_TEXT, data
+
+	def decompress(self, data):
+		return self.decompressor.decompress(data)
+
+	def stats(self, bitrate=1200):
+		saved = self.raw_bytes - self.sent_bytes
+		return {
+			'enabled': self.tx_enabled,
+			'raw_bytes': self.raw_bytes,
+			'sent_bytes': self.sent_bytes,
+			'ratio': self.sent_bytes / self.raw_bytes if self.raw_bytes else 1.0,
+			'frames_compressed': self.frames_compressed,
+			'frames_plain': self.frames_plain,
+			'airtime_saved': saved * 8 / bitrate, # Seconds, ignoring HDLC overhead
+		}
@@ -110,6 +110,15 @@ class AX25Frame:
 			AX25SControl: 'S'
 		}[type(self.control)]
 
+	@property
+	def typename(self):
+		if type(self.control) == AX25IControl:
+			return 'I'
+		elif type(self.control) == AX25SControl:
+			return self.control.ss.name
+		else:
+			return self.control.mmmmm.name
+
 	def __str__(self):
 		cc = self.source.bit, self.dest.bit
 		ccname = "cmd" if cc==(0,1) else ("rsp" if cc==(1,0) else "?"+str(cc))
@@ -210,7 +219,7 @@ def parse_ax25_frame(frame, mod128mode=None):
 		else:
 			raise ValueError("Unknown mod128mode")
 
-		if type(control) == AX25IControl:
+		if type(control) == AX25IControl or (type(control) == AX25UControl and control.mmmmm == UFrameTypes.UI):
 			pid = [take_bytes(1)[0]]
 			if pid[0] in [0b11111111, 0b00001000]:
 				pid.append(take_bytes(1)[0])
@@ -237,3 +246,74 @@ def encode_ax25_frame(frame, mod128mode):
 	buf += frame.data
 
 	return buf
+
+def ax25_address_key(raw):
+	# Callsign + SSID of an encoded address, ignoring the C/H, reserved and extension bits
+	return bytes(raw[:6]) + bytes([raw[6] & 0b00011110])
+
+def encode_ax25_address_key(address):
+	if isinstance(address, str):
+		address = AX25Address.parse(address)
+	address = AX25DestinationAddress(address.callsign, address.ssid)
+	return ax25_address_key(encode_ax25_address(address, False))
+
+def str_ax25_address_key(key):
+	call = ''.join([chr(x>>1) for x in key[:6]]).rstrip(' ')
+	return f"{call}-{(key[6] >> 1) & 0b1111}"
+
+def ax25_address_end(frame):
+	# Offset of the control field: address fields end at the first extension bit
+	end = 13
+	while end < len(frame) and not frame[end] & 1:
+		end += 7
+	return end + 1
+
+def peek_ax25_addresses(frame):
+	# (source key, dest key) straight from the raw bytes, without a full parse
+	return ax25_address_key(frame[7:14]), ax25_address_key(frame[0:7])
+
+def encode_ui_header(source, dest, pid, via=()):
+	# Everything in a UI command frame before the information field
+	if isinstance(dest, str):
+		dest = AX25Address.parse(dest)
+	via = [AX25Address.parse(v) if isinstance(v, str) else v for v in via]
+	return encode_ax25_frame(AX25Frame(
+		AX25SourceAddress(source.callsign, source.ssid, c=0),
+		AX25DestinationAddress(dest.callsign, dest.ssid, c=1),
+		[AX25RepeaterAddress(v.callsign, v.ssid) for v in via],
+		AX25UControl(UFrameTypes.UI, pf=0), [pid]
+	), 8)
+
+def peek_ui_frame(frame, dest_key=None, pid=None):
+	# (source, dest, pid, data) of a UI frame straight from the raw bytes, or None
+	# if it isn't one or doesn't match dest_key/pid
+	if dest_key is not None and ax25_address_key(frame[0:7]) != dest_key:
+		return None
+	end = ax25_address_end(frame)
+	if end + 1 >= len(frame) or (frame[end] & ~0b10000) != 0b00000011:
+		return None
+	if pid is not None and frame[end+1] != pid:
+		return None
+	source, dest = peek_ax25_addresses(frame)
+	return str_ax25_address_key(source), str_ax25_address_key(dest), frame[end+1], frame[end+2:]
+
+XID_FORMAT_INDICATOR = 0x82
+XID_GROUP_PARAMETERS = 0x80
+
+def encode_xid_params(params):
+	# {PI: value bytes} -> XID information field with one parameter group
+	body = b''.join(bytes([pi, len(pv)]) + pv for pi, pv in params.items())
+	return bytes([XID_FORMAT_INDICATOR, XID_GROUP_PARAMETERS]) + len(body).to_bytes(2, 'big') + body
+
+def parse_xid_params(data):
+	# XID information field -> {PI: value bytes}, empty if it isn't one we understand
+	if len(data) < 4 or data[0] != XID_FORMAT_INDICATOR or data[1] != XID_GROUP_PARAMETERS:
+		return {}
+	end = min(len(data), 4 + int.from_bytes(data[2:4], 'big'))
+	params = {}
+	i = 4
+	while i + 2 <= end:
+		pi, pl = data[i], data[i+1]
+		params[pi] = bytes(data[i+2:i+2+pl])
+		i += 2 + pl
+	return params
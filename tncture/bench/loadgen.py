@@ -0,0 +1,293 @@
+from collections import Counter, deque
+import multiprocessing, random, socket, sys, time
+from ..ax25.frame import *
+from ..ax25.abm import AX25ConnectedModeConnection
+from ..transport.kiss import TCPKISSConnection, KISSPort
+from ..transport.mux import PortMux
+from ..reactor import Reactor
+from .shard import node_main
+
+# Many simulated stations calling an echo node, ramped up in steps, to find
+# where connect latency and echo round trips fall apart. The node is a local
+# ShardedNode on KISS socketpairs, or whatever answers on --kiss HOST:PORT
+# (e.g. a node sharing a `tncture hub`). Each client process runs its share
+# of the stations as ordinary AX25ConnectedModeConnections on one PortMux.
+#
+# A station connects, sends --messages payloads of --payload bytes, waiting
+# for each echo and then thinking for a random (exponential) time, and
+# disconnects; --abrupt of them just go quiet instead of sending DISC.
+
+# Station callsigns are L, the client and the station's index / 16 in base 36,
+# then the index % 16 as the SSID: six characters, as AX.25 allows
+BASE36 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+MAX_CLIENTS = 36
+MAX_STATIONS_PER_CLIENT = 36 ** 4 * 16
+
+def base36(n, width):
+	digits = ''
+	for i in range(width):
+		n, d = divmod(n, 36)
+		digits = BASE36[d] + digits
+	return digits
+
+class Options:
+	def __init__(self, argv):
+		def option(name, default, type_=str):
+			return type_(argv[argv.index(name) + 1]) if name in argv else default
+
+		self.clients = option('--clients', 2, int)
+		self.workers = option('--workers', 2, int)
+		self.kiss = option('--kiss', None)
+		self.node = option('--node', 'NODE')
+		self.stations = option('--stations', 2000, int)
+		self.ramp = [int(n) for n in option('--ramp', '50,100,200,400').split(',')]
+		self.step = option('--step', 10, float) # Seconds per ramp step
+		self.rate = option('--rate', 50, float) # New connections per second, across all clients
+		self.think = option('--think', 1, float) # Mean seconds between an echo and the next message
+		low, _, high = option('--payload', '32-128').partition('-')
+		self.payload = (int(low), int(high or low))
+		self.messages = option('--messages', 5, int)
+		self.abrupt = option('--abrupt', 0, float) # Fraction that vanish without DISC
+		self.timeout = option('--timeout', 30, float) # For a connect or one echo
+		self.ack_delay = option('--ack-delay', 0.1, float) # Stations' delayed-RR timer
+
+		if self.clients > MAX_CLIENTS:
+			sys.exit(f"At most {MAX_CLIENTS} clients, or their callsigns won't fit in six characters")
+		if self.stations // self.clients > MAX_STATIONS_PER_CLIENT:
+			sys.exit(f"At most {MAX_STATIONS_PER_CLIENT} stations per client, or their callsigns won't fit in six characters")
+
+class Station:
+	__slots__ = ('conn', 'call', 'step', 'phase', 'started', 'messages', 'expected', 'received', 'sent_at', 'timer')
+
+	def __init__(self, conn, call, step, messages):
+		self.conn = conn
+		self.call = call
+		self.step = step # Ramp step it was started in
+		self.phase = 'connecting' # connecting, waiting, thinking, closing
+		self.started = time.time()
+		self.messages = messages
+		self.expected = b''
+		self.received = b''
+		self.sent_at = None
+		self.timer = None
+
+class StepStats:
+	def __init__(self):
+		self.connect = [] # Seconds from starting a station to connected
+		self.rtt = [] # Seconds from payload queued to whole echo back
+		self.failed = Counter()
+		self.completed = 0
+		self.started = 0
+
+	def merge(self, other):
+		self.connect += other.connect
+		self.rtt += other.rtt
+		self.failed.update(other.failed)
+		self.completed += other.completed
+		self.started += other.started
+
+class LoadClient:
+	def __init__(self, client, port, options, start):
+		self.client = client
+		self.options = options
+		self.start = start
+		self.share = options.clients
+		self.reactor = Reactor()
+		self.mux = PortMux(port)
+		self.reactor.add_transport(self.mux)
+		self.nodecall = AX25Address.parse(options.node)
+		self.random = random.Random(client)
+
+		self.free_calls = deque(self.station_call(n) for n in range(options.stations // options.clients))
+		self.active = set()
+		self.connecting = set()
+		self.stats = [StepStats() for n in options.ramp]
+		self.tokens = 0
+		self.last_tick = start
+
+		self.reactor.after_poll.append(self.check_connecting)
+		self.reactor.call_at(start, self.tick)
+
+	def station_call(self, n):
+		return AX25Address.parse(f"L{base36(self.client, 1)}{base36(n // 16, 4)}-{n % 16}")
+
+	def current_step(self):
+		return min(int((time.time() - self.start) / self.options.step), len(self.options.ramp) - 1)
+
+	def tick(self):
+		now = time.time()
+		if now - self.start >= self.options.step * len(self.options.ramp):
+			self.reactor.stop()
+			return
+		rate = self.options.rate / self.share
+		self.tokens = min(self.tokens + (now - self.last_tick) * rate, max(rate, 1)) # At most a second's burst
+		self.last_tick = now
+		target = self.options.ramp[self.current_step()] // self.share
+		while self.tokens >= 1 and len(self.active) < target and self.free_calls:
+			self.tokens -= 1
+			self.start_station()
+		self.reactor.call_later(0.01, self.tick)
+
+	def start_station(self):
+		call = self.free_calls.popleft()
+		conn = AX25ConnectedModeConnection(self.mux.session_port(call, self.nodecall), call, self.nodecall)
+		conn.burst_recieve_timer.timeout = self.options.ack_delay
+		station = Station(conn, call, self.current_step(), self.options.messages)
+		conn.on_data = lambda data: self.on_data(station, data)
+		conn.on_disconnect = lambda: self.on_disconnect(station)
+		self.active.add(station)
+		self.connecting.add(station)
+		self.stats[station.step].started += 1
+		self.reactor.add_session(conn)
+		self.arm(station, self.options.timeout, 'connect timeout')
+
+	def arm(self, station, delay, reason):
+		if station.timer:
+			station.timer.cancel()
+		station.timer = self.reactor.call_later(delay, lambda: self.fail(station, reason))
+
+	def check_connecting(self):
+		for station in [s for s in self.connecting if s.conn.state == s.conn.States.CONNECTED]:
+			self.connecting.discard(station)
+			self.stats[self.current_step()].connect.append(time.time() - station.started)
+			self.send_next(station)
+
+	def send_next(self, station):
+		if station not in self.active:
+			return
+		if station.messages == 0:
+			self.finish(station)
+			return
+		size = self.random.randint(*self.options.payload)
+		station.expected = bytes(self.random.randrange(0x20, 0x7f) for i in range(size))
+		station.received = b''
+		station.sent_at = time.time()
+		station.phase = 'waiting'
+		station.conn.stream_outgoing += station.expected
+		self.arm(station, self.options.timeout, 'echo timeout')
+
+	def on_data(self, station, data):
+		if station.phase != 'waiting':
+			return
+		station.received += data
+		if len(station.received) < len(station.expected):
+			return
+		stats = self.stats[self.current_step()]
+		if station.received[:len(station.expected)] != station.expected:
+			self.fail(station, 'echo mismatch')
+			return
+		stats.rtt.append(time.time() - station.sent_at)
+		station.messages -= 1
+		station.phase = 'thinking'
+		delay = self.random.expovariate(1 / self.options.think) if self.options.think else 0
+		station.timer.cancel()
+		station.timer = self.reactor.call_later(delay, lambda: self.send_next(station))
+
+	def finish(self, station):
+		if self.random.random() < self.options.abrupt:
+			self.stats[self.current_step()].completed += 1
+			self.release(station) # Off the air without a DISC; the node has to notice
+			return
+		station.phase = 'closing'
+		station.conn.initiate_disconnection()
+		self.arm(station, self.options.timeout, 'disconnect timeout')
+
+	def on_disconnect(self, station):
+		if station not in self.active:
+			return
+		if station.phase == 'closing':
+			self.stats[self.current_step()].completed += 1
+			self.release(station)
+		else:
+			self.fail(station, 'refused' if station.phase == 'connecting' else 'dropped by node')
+
+	def fail(self, station, reason):
+		if station not in self.active:
+			return
+		self.stats[self.current_step()].failed[reason] += 1
+		self.release(station)
+
+	def release(self, station):
+		if station.timer:
+			station.timer.cancel()
+		self.active.discard(station)
+		self.connecting.discard(station)
+		if station.conn in self.reactor.sessions:
+			self.reactor.remove_session(station.conn)
+		station.conn.port.close()
+		self.free_calls.append(station.call) # Reused last, after every other call
+
+	def run(self):
+		self.reactor.run()
+		return self.stats
+
+def client_main(client, target, options, start, results):
+	if isinstance(target, socket.socket):
+		kiss = TCPKISSConnection.from_socket(target)
+	else:
+		kiss = TCPKISSConnection(*target)
+	results.put(LoadClient(client, KISSPort(kiss, 0), options, start).run())
+
+def percentiles(values, qs=(0.5, 0.95, 0.99)):
+	if not values:
+		return [None for q in qs]
+	values = sorted(values)
+	return [values[min(int(q * len(values)), len(values) - 1)] for q in qs]
+
+def run(options):
+	ctx = multiprocessing.get_context('fork')
+	node = None
+	if options.kiss:
+		host, _, port = options.kiss.rpartition(':')
+		targets = [(host or 'localhost', int(port))] * options.clients
+	else:
+		pairs = [socket.socketpair() for i in range(options.clients)]
+		node = ctx.Process(target=node_main, args=([a for a, b in pairs], options.workers))
+		node.start()
+		targets = [b for a, b in pairs]
+
+	results = ctx.Queue()
+	start = time.time() + 0.5 # Let every client get going first
+	procs = [ctx.Process(target=client_main, args=(i, t, options, start, results)) for i, t in enumerate(targets)]
+	for p in procs:
+		p.start()
+	stats = [StepStats() for n in options.ramp]
+	for p in procs:
+		for total, part in zip(stats, results.get()):
+			total.merge(part)
+	for p in procs:
+		p.join()
+
+	if node:
+		node.terminate()
+		node.join()
+		for a, b in pairs:
+			a.close()
+			b.close()
+	return stats
+
+def main(argv):
+	if '--help' in argv:
+		print("Usage: tncture.bench.loadgen [--kiss HOST:PORT --node CALL | --workers N] [--clients N]")
+		print("       [--stations N] [--ramp N,N,...] [--step SECONDS] [--rate PER_SEC] [--think SECONDS]")
+		print("       [--payload MIN-MAX] [--messages N] [--abrupt FRACTION] [--timeout SECONDS] [--ack-delay SECONDS]")
+		return 0
+	options = Options(argv)
+	target = options.kiss or f"local node, {options.workers} workers"
+	print(f"{options.clients} clients -> {target}; {options.rate:g} connects/s, {options.payload[0]}-{options.payload[1]} byte payloads,"
+		f" {options.messages} each, {options.think:g}s think, {options.abrupt:.0%} abrupt")
+	print(f"{'stations':>8} {'started':>8} {'done':>6} {'failed':>6} {'conn p50':>9} {'p95':>7} {'p99':>7} {'echo/s':>7} {'rtt p50':>8} {'p95':>7} {'p99':>7}")
+
+	def ms(v):
+		return f"{v * 1000:.0f}ms" if v is not None else '-'
+
+	for concurrency, s in zip(options.ramp, run(options)):
+		c50, c95, c99 = percentiles(s.connect)
+		r50, r95, r99 = percentiles(s.rtt)
+		print(f"{concurrency:>8} {s.started:>8} {s.completed:>6} {sum(s.failed.values()):>6} {ms(c50):>9} {ms(c95):>7} {ms(c99):>7}"
+			f" {len(s.rtt) / options.step:>7.1f} {ms(r50):>8} {ms(r95):>7} {ms(r99):>7}")
+		if s.failed:
+			print(f"{'':>8} failures: {', '.join(f'{reason} {n}' for reason, n in s.failed.most_common())}")
+
+if __name__ == '__main__':
+	main(sys.argv)
@@ -0,0 +1,116 @@
+import multiprocessing, os, signal, socket, sys, time
+from ..ax25.frame import *
+from ..ax25.abm import AX25ConnectedModeConnection
+from ..transport.kiss import TCPKISSConnection, KISSPort
+from ..transport.mux import PortMux
+from ..node.shard import ShardedNode
+from ..reactor import Reactor
+
+# Sessions/sec and frames/sec through a ShardedNode as the worker count grows.
+# Each client process drives its own KISS link to the node, so the clients are
+# not what limits the numbers.
+
+NODE_CALL = 'NODE'
+MESSAGE = b'x' * 32
+
+def client_call(client, n):
+	return AX25Address.parse(f"B{client}{n // 16:03d}-{n % 16}")
+
+def node_main(socks, workers):
+	signal.signal(signal.SIGTERM, lambda *a: sys.exit(0)) # So stop() reaps the workers
+	ports = [KISSPort(TCPKISSConnection.from_socket(s), 0) for s in socks]
+	ShardedNode(ports, AX25Address.parse(NODE_CALL), workers).run()
+
+def client_main(client, sock, sessions, concurrency, messages, results):
+	reactor = Reactor()
+	mux = PortMux(KISSPort(TCPKISSConnection.from_socket(sock), 0))
+	reactor.add_transport(mux)
+	nodecall = AX25Address.parse(NODE_CALL)
+
+	started = 0
+	finished = 0
+	frames = 0
+	active = {} # connection -> messages still to send
+
+	def count(frame):
+		nonlocal frames
+		frames += 1
+
+	def start_session():
+		nonlocal started
+		mycall = client_call(client, started)
+		port = mux.session_port(mycall, nodecall)
+		port.on_tx = port.on_rx = count
+		conn = AX25ConnectedModeConnection(port, mycall, nodecall)
+		active[conn] = messages
+		reactor.add_session(conn)
+		started += 1
+
+	def after_poll():
+		nonlocal finished
+		for conn, left in list(active.items()):
+			if conn.state == conn.States.CONNECTED:
+				if len(conn.stream_incoming) >= len(MESSAGE):
+					conn.stream_incoming = conn.stream_incoming[len(MESSAGE):]
+					left -= 1
+				if left == 0:
+					conn.initiate_disconnection()
+				elif not conn.stream_outgoing and conn.vs == conn.va and not conn.stream_incoming:
+					conn.stream_outgoing = MESSAGE
+				active[conn] = left
+			elif conn.state == conn.States.DISCONNECTED:
+				del active[conn]
+				reactor.remove_session(conn)
+				conn.port.close()
+				finished += 1
+		while len(active) < concurrency and started < sessions:
+			start_session()
+		if finished == sessions:
+			reactor.stop()
+
+	reactor.after_poll.append(after_poll)
+	reactor.call_soon(after_poll)
+	reactor.run()
+	results.put(frames)
+
+def run(workers, clients, sessions, concurrency, messages):
+	ctx = multiprocessing.get_context('fork')
+	pairs = [socket.socketpair() for i in range(clients)]
+	node = ctx.Process(target=node_main, args=([a for a, b in pairs], workers))
+	node.start()
+
+	results = ctx.Queue()
+	start = time.perf_counter()
+	procs = [ctx.Process(target=client_main, args=(i, b, sessions, concurrency, messages, results)) for i, (a, b) in enumerate(pairs)]
+	for p in procs:
+		p.start()
+	frames = sum(results.get() for p in procs)
+	elapsed = time.perf_counter() - start
+	for p in procs:
+		p.join()
+
+	node.terminate()
+	node.join()
+	for a, b in pairs:
+		a.close()
+		b.close()
+	return clients * sessions / elapsed, frames / elapsed
+
+def main(argv):
+	clients = int(argv[argv.index('--clients') + 1]) if '--clients' in argv else 4
+	sessions = int(argv[argv.index('--sessions') + 1]) if '--sessions' in argv else 50
+	concurrency = int(argv[argv.index('--concurrency') + 1]) if '--concurrency' in argv else 10
+	messages = int(argv[argv.index('--messages') + 1]) if '--messages' in argv else 10
+
+	print(f"{clients} clients x {sessions} sessions ({concurrency} at once), {messages} echoes each, {os.cpu_count()} CPUs")
+	print(f"{'workers':>8} {'sessions/s':>12} {'frames/s':>12}")
+	if '--workers' in argv:
+		counts = [int(n) for n in argv[argv.index('--workers') + 1].split(',')]
+	else:
+		counts = [n for n in (1, 2, 4, 8) if n <= os.cpu_count()] or [1]
+	for workers in counts:
+		sessions_rate, frames_rate = run(workers, clients, sessions, concurrency, messages)
+		print(f"{workers:>8} {sessions_rate:>12.1f} {frames_rate:>12.1f}")
+
+if __name__ == '__main__':
+	main(sys.argv)
@@ -0,0 +1,216 @@
+from collections import deque
+import gc, json, os, socket, statistics, sys, time
+from ..ax25.frame import *
+from ..ax25.abm import AX25ConnectedModeConnection
+from ..transport.kiss import TCPKISSConnection
+from ..transport.agw import AGWTCPConnection, RawAGWFrame
+
+# Offline micro-benchmarks for the hot paths. Each benchmark is a setup function
+# returning (op, n): calling op() does n units of work. Results are ops/sec and
+# allocations per op, compared against a JSON baseline.
+
+BENCHMARKS = {}
+
+def benchmark(name):
+	def register(setup):
+		BENCHMARKS[name] = setup
+		return setup
+	return register
+
+def sample_frame(length=128):
+	return AX25Frame(
+		AX25SourceAddress('N0CALL', 1, c=0),
+		AX25DestinationAddress('N0NODE', 2, c=1),
+		[AX25RepeaterAddress('WIDE1', 1, h=1)],
+		AX25IControl(ns=3, nr=5, pf=1), [0xf0],
+		bytes(range(256))[:length]
+	)
+
+@benchmark('frame.parse')
+def bench_parse():
+	raw = encode_ax25_frame(sample_frame(), 8)
+	return lambda: parse_ax25_frame(raw, 8), 1
+
+@benchmark('frame.encode')
+def bench_encode():
+	frame = sample_frame()
+	return lambda: encode_ax25_frame(frame, 8), 1
+
+@benchmark('slip.pack')
+def bench_slip_pack():
+	data = encode_ax25_frame(sample_frame(), 8) # Includes bytes that need escaping
+	return lambda: TCPKISSConnection.kiss_frame(0, data), 1
+
+@benchmark('slip.unpack')
+def bench_slip_unpack():
+	packed = TCPKISSConnection.kiss_frame(0, encode_ax25_frame(sample_frame(), 8))[1:-1]
+	return lambda: TCPKISSConnection.unpack_slip_frame(packed), 1
+
+BATCH = 100
+
+@benchmark('kiss.reassembly')
+def bench_kiss_reassembly():
+	a, b = socket.socketpair()
+	conn = TCPKISSConnection.from_socket(b)
+	stream = TCPKISSConnection.kiss_frame(0, encode_ax25_frame(sample_frame(), 8)) * BATCH
+
+	def op():
+		a.sendall(stream)
+		for i in range(BATCH):
+			while conn.recieve_data_frame(0) is None:
+				pass
+	return op, BATCH
+
+@benchmark('agw.reassembly')
+def bench_agw_reassembly():
+	a, b = socket.socketpair()
+	conn = AGWTCPConnection.from_socket(b)
+	conn.claim_raw_port(0)
+	a.recv(4096) # The monitoring request claim_raw_port sent
+	frame = encode_ax25_frame(sample_frame(), 8)
+	stream = RawAGWFrame(0, 'K', 0, '', '', b'\x00' + frame).to_buffer() * BATCH
+
+	def op():
+		a.sendall(stream)
+		for i in range(BATCH):
+			while conn.recieve_data_frame(0) is None:
+				pass
+	return op, BATCH
+
+class LoopbackPort:
+	# In-memory port whose sends arrive on its peer
+	def __init__(self):
+		self.rx = deque()
+		self.peer = None
+		self.on_tx = lambda f:None
+		self.on_rx = lambda f:None
+
+	@classmethod
+	def pair(cls):
+		a, b = cls(), cls()
+		a.peer, b.peer = b, a
+		return a, b
+
+	def pending(self):
+		return bool(self.rx)
+
+	def send_data_frame(self, frame):
+		self.peer.rx.append(frame)
+
+	def recieve_data_frame(self):
+		if self.rx:
+			return self.rx.popleft()
+
+@benchmark('abm.transfer')
+def bench_abm_transfer():
+	pa, pb = LoopbackPort.pair()
+	a = AX25ConnectedModeConnection(pa, AX25Address('AA', 0), AX25Address('BB', 0))
+	b = AX25ConnectedModeConnection(pb, AX25Address('BB', 0), AX25Address('AA', 0), incoming=True)
+	b.burst_recieve_timer.timeout = 0 # Ack straight away instead of after the burst delay
+	while b.state != b.States.CONNECTED or a.state != a.States.CONNECTED:
+		a.poll()
+		b.poll()
+	payload = bytes(a.mtu)
+
+	def op():
+		# One full I-frame sent, delivered and acknowledged
+		a.stream_outgoing += payload
+		while len(b.stream_incoming) < len(payload) or a.vs != a.va or pa.rx or pb.rx:
+			a.poll()
+			b.poll()
+		b.stream_incoming = b''
+	return op, 1
+
+def ops_per_sec(op, n, min_time=0.2, repeat=3):
+	best = 0
+	for r in range(repeat):
+		count = 0
+		start = time.perf_counter()
+		while True:
+			op()
+			count += 1
+			elapsed = time.perf_counter() - start
+			if elapsed >= min_time:
+				break
+		best = max(best, count * n / elapsed)
+	return best
+
+def allocs_per_op(op, n, samples=20):
+	# Median growth in the interpreter's allocated memory blocks over one op()
+	# call, per op. Blocks an op frees again before it returns aren't counted,
+	# so this is what each op leaves behind (queued buffers, parsed objects
+	# kept, caches). The collector is held off so it can't free unrelated
+	# garbage mid-sample.
+	counts = []
+	gc.collect()
+	gc.disable()
+	try:
+		for i in range(samples):
+			before = sys.getallocatedblocks()
+			op()
+			counts.append(max(0, sys.getallocatedblocks() - before))
+	finally:
+		gc.enable()
+	return statistics.median(counts) / n
+
+def run(names=None):
+	results = {}
+	for name, setup in BENCHMARKS.items():
+		if names and name not in names:
+			continue
+		op, n = setup()
+		op() # Warm up
+		results[name] = {
+			'ops_per_sec': ops_per_sec(op, n),
+			'allocs_per_op': allocs_per_op(op, n),
+		}
+	return results
+
+def compare(results, baseline, tolerance):
+	# Names that got slower, or allocate more, by more than `tolerance`
+	regressions = []
+	for name, r in results.items():
+		base = baseline.get(name)
+		if not base:
+			continue
+		if r['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+			regressions.append((name, 'ops_per_sec', base['ops_per_sec'], r['ops_per_sec']))
+		# Small absolute slack so a stray block doesn't fail a zero-allocation path
+		if r['allocs_per_op'] > base['allocs_per_op'] * (1 + tolerance) + 1:
+			regressions.append((name, 'allocs_per_op', base['allocs_per_op'], r['allocs_per_op']))
+	return regressions
+
+def main(argv):
+	baseline_path = argv[argv.index('--baseline') + 1] if '--baseline' in argv else 'tncture-bench-baseline.json'
+	tolerance = float(argv[argv.index('--tolerance') + 1]) if '--tolerance' in argv else 0.25
+	flags_with_values = {'--baseline', '--tolerance'}
+	names = [a for i, a in enumerate(argv[1:], 1) if not a.startswith('--') and argv[i-1] not in flags_with_values]
+
+	results = run(names)
+	print(f"{'benchmark':<18} {'ops/s':>12} {'allocs/op':>11}")
+	for name, r in results.items():
+		print(f"{name:<18} {r['ops_per_sec']:>12.0f} {r['allocs_per_op']:>11.2f}")
+
+	if '--save' in argv:
+		baseline = {}
+		if os.path.exists(baseline_path):
+			with open(baseline_path) as f:
+				baseline = json.load(f)
+		baseline.update(results)
+		with open(baseline_path, 'w') as f:
+			json.dump(baseline, f, indent=2, sort_keys=True)
+		print(f"Saved baseline to {baseline_path}")
+		return 0
+
+	if not os.path.exists(baseline_path):
+		print(f"No baseline at {baseline_path}; run with --save to create one")
+		return 0
+	with open(baseline_path) as f:
+		baseline = json.load(f)
+	regressions = compare(results, baseline, tolerance)
+	for name, metric, base, now in regressions:
+		print(f"REGRESSION {name} {metric}: {base:.2f} -> {now:.2f}")
+	return 1 if regressions else 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -1,21 +1,66 @@
-import sys
-from ..ax25.frame import *
-from ..ax25.abm import *
-from ..transport.kiss import *
+import argparse, sys
 
-def get_session(name):
-    if len(sys.argv) < 3:
-        print(f"Usage: {name} MYCALL[-X] THEIRCALL-X")
-        sys.exit(1)
+# Only the frame codec is needed to build an address; transports and the
+# session classes are imported once we know which ones were asked for.
+from ..ax25.frame import AX25Address
 
-    mycall = AX25Address.parse(sys.argv[1])
-    theircall = AX25Address.parse(sys.argv[2])
+def host_port(s):
+    host, _, port = s.rpartition(':')
+    return (host or 'localhost', int(port))
 
-    if '--dummy' not in sys.argv:
-        kiss = TCPKISSConnection('localhost', 8001)
+def add_session_arguments(parser):
+    parser.add_argument('mycall', type=AX25Address.parse, metavar='MYCALL[-X]')
+    parser.add_argument('theircall', type=AX25Address.parse, metavar='THEIRCALL-X')
+    transport = parser.add_mutually_exclusive_group()
+    transport.add_argument('--agw', action='store_true', help="Use an AGWPE server (localhost:8000) as a raw port")
+    transport.add_argument('--agw-offload', action='store_true', help="Let the AGWPE server run the AX.25 connection")
+    transport.add_argument('--dummy', action='store_true', help="Use an in-memory KISS connection")
+    parser.add_argument('--kiss', type=host_port, default=('localhost', 8001), metavar='HOST:PORT',
+        help="KISS TNC (or `tncture hub`) to use, default localhost:8001")
+    parser.add_argument('--listen', action='store_true', help="Wait for THEIRCALL to connect to us")
+    parser.add_argument('--compress', action='store_true', help="Offer payload compression to the other end")
+    parser.add_argument('--metrics', action='store_true', help="Serve Prometheus metrics on 127.0.0.1:9125")
+    parser.add_argument('--trace-dump', metavar='PATH', help="Dump the protocol trace here if the session crashes")
+    return parser
+
+def session_from_args(args):
+    if args.metrics:
+        from ..metrics import serve_prometheus
+        serve_prometheus()
+
+    if args.agw_offload:
+        # The TNC runs the connection, so only what it offers is available
+        for option, given in (('--listen', args.listen), ('--compress', args.compress), ('--trace-dump', args.trace_dump)):
+            if given:
+                sys.exit(f"{option} isn't supported with --agw-offload")
+        from ..transport.agw import AGWTCPConnection
+        from ..transport.agw_session import AGWConnectedModeConnection
+        return AGWConnectedModeConnection(AGWTCPConnection('localhost', 8000), 0, args.mycall, args.theircall)
+
+    if args.agw:
+        from ..transport.agw import AGWTCPConnection, AGWPort
+        port = AGWPort(AGWTCPConnection('localhost', 8000), 0)
     else:
-        kiss = DummyKISSConnection()
+        from ..transport.kiss import TCPKISSConnection, DummyKISSConnection, KISSPort
+        if not args.dummy:
+            kiss = TCPKISSConnection(*args.kiss)
+        else:
+            kiss = DummyKISSConnection()
 
-    port = KISSPort(kiss, 0)
-    session = AX25ConnectedModeConnection(port, mycall, theircall)
+        port = KISSPort(kiss, 0)
+
+    from ..ax25.abm import AX25ConnectedModeConnection
+    session = AX25ConnectedModeConnection(port, args.mycall, args.theircall, incoming=args.listen,
+        compression=args.compress)
+    if args.trace_dump:
+        from ..trace import TraceRing, DUMP_CAPACITY
+        session.trace = TraceRing(DUMP_CAPACITY) # More history for the post-mortem
+        session.trace_dump_path = args.trace_dump
     return session
+
+def get_session(name, argv=None):
+    # For the per-client `python -m tncture.dial.*` entry points; options they
+    # handle themselves are left alone
+    parser = add_session_arguments(argparse.ArgumentParser(prog=name))
+    args, _ = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+    return session_from_args(args)
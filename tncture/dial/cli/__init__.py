@@ -1,35 +1,80 @@
 from ...ax25.frame import *
 from ...ax25.abm import *
 from ...transport.kiss import *
-import sys, time
-import threading
+from ...reactor import Reactor
+import os, sys, time
 
+# Received text goes straight to stdout's buffer: CRs become newlines and
+# anything that isn't ASCII is dropped, in one pass
+CR_TO_LF = bytes.maketrans(b'\r', b'\n')
+NON_ASCII = bytes(range(128, 256))
 
 def run_ui(session):
+	reactor = Reactor()
+	reactor.add_session(session)
+
+	closing = False # Input ended; disconnect once what it queued has gone
+	partial = b'' # Input after the last newline
+
+	def send_input(data):
+		# Lines go out CR-terminated; anything that isn't ASCII becomes '?'
+		nonlocal partial
+		*lines, partial = (partial + data).split(b'\n')
+		for line in lines:
+			session.stream_outgoing += line.decode('utf-8', 'replace').encode('ascii', 'replace') + b'\r'
+
+	def end_input():
+		nonlocal closing, partial
+		if partial:
+			send_input(b'\n')
+		closing = True
+
 	def input_handler():
-		# print("input_handler() running")
-		while 1:
-			data = input().encode('ascii') + b'\r'
-			# print("input_handler() submit", data)
-			session.stream_outgoing += data
+		# Straight from the fd: sys.stdin would read ahead into its own buffer,
+		# leaving lines there that select() can't see
+		data = os.read(sys.stdin.fileno(), 4096)
+		if not data:
+			reactor.remove_reader(sys.stdin)
+			end_input()
+			return
+		send_input(data)
 
-	threading.Thread(target=input_handler, daemon=True).start()
+	try:
+		reactor.add_reader(sys.stdin, input_handler)
+	except (PermissionError, ValueError):
+		# A regular file or /dev/null can't be selected on, but it can't block
+		# either: queue all of it now
+		send_input(sys.stdin.buffer.read())
+		end_input()
 
 	connected = False
+	link_up = True
 
-	print(f"[client] Dialing {mycall} -> {theircall} via KISS:localhost:8001")
+	def after_poll():
+		nonlocal connected, link_up
+		if getattr(session.transport, 'link_up', True) != link_up:
+			link_up = not link_up
+			print("[client] TNC link back." if link_up else "[client] Lost the TNC link, reconnecting...")
 
-	while 1:
-		session.poll()
 		if session.stream_incoming:
-			print(session.stream_incoming.decode('ascii', 'ignore').replace('\r', '\n'), end='', flush=True)
+			sys.stdout.buffer.write(session.stream_incoming.translate(CR_TO_LF, NON_ASCII))
+			sys.stdout.flush()
 			session.stream_incoming = b''
-		# time.sleep(0.1)
+
 		if session.state == AX25ConnectedModeConnection.States.DISCONNECTED:
 			print("[client] Disconnected.")
-			break
+			reactor.stop()
 
 		if not connected and session.state == AX25ConnectedModeConnection.States.CONNECTED:
 			print("[client] Connected.")
 			connected = True
+
+		if closing and session.state == AX25ConnectedModeConnection.States.CONNECTED and session.drained():
+			session.initiate_disconnection()
+
+	reactor.after_poll.append(after_poll)
+
+	print(f"[client] Dialing {session.mycall} -> {session.theircall}")
+
+	reactor.run()
 	sys.exit(0)
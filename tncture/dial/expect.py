@@ -0,0 +1,140 @@
+import re
+
+# expect-style scripting over a connection's received stream. The Expecter
+# takes the session's on_data and keeps what arrives in a bounded rolling
+# buffer; each chunk is only searched together with the tail of what came
+# before it, so waiting for a prompt doesn't rescan the whole session.
+#
+#	exp = Expecter(session, reactor)
+#	exp.expect(b'> ', timeout=30)
+#	exp.sendline('MHEARD')
+#	heard = exp.expect(re.compile(rb'\r(\S+)> '), timeout=30)
+#
+# expect() drives the reactor until a match (or raises); expect_async()
+# returns at once and calls back from inside the reactor, so many sessions
+# can be scripted on one reactor.
+
+class ExpectError(Exception):
+	def __init__(self, message, data):
+		super().__init__(message)
+		self.data = data # What was buffered, unconsumed
+
+class ExpectTimeout(ExpectError):
+	pass
+
+class ExpectDisconnected(ExpectError):
+	pass
+
+def compile_pattern(pattern, lookbehind):
+	# (regex, how far back into already searched data a match can start)
+	if isinstance(pattern, str):
+		pattern = pattern.encode('ascii')
+	if isinstance(pattern, (bytes, bytearray)):
+		return re.compile(re.escape(pattern)), max(len(pattern) - 1, 0)
+	return pattern, lookbehind
+
+class Expecter:
+	def __init__(self, session, reactor, max_buffer=65536, lookbehind=256):
+		self.session = session
+		self.reactor = reactor
+		self.max_buffer = max_buffer
+		self.lookbehind = lookbehind # Longest regex match that can straddle two chunks
+		self.buffer = bytearray()
+		self.scanned = 0 # buffer[:scanned] has been searched for the current patterns
+		self.discarded = 0 # Bytes dropped off the front of a full buffer
+
+		self.patterns = None # [(regex, lookbehind)] while an expectation is waiting
+		self.callback = None
+		self.timer = None
+
+		self.match = None # re.Match of the last expectation, against its own copy of the text
+		self.index = None # Which of the patterns matched
+
+		if session.stream_incoming:
+			self.buffer += session.stream_incoming
+			session.stream_incoming = b''
+		session.on_data = self.feed
+		reactor.after_poll.append(self._check_connection)
+
+	def detach(self):
+		# Hand the receive stream back to stream_incoming
+		if self.session.on_data == self.feed:
+			self.session.on_data = None
+		self.session.stream_incoming += bytes(self.buffer)
+		self.buffer.clear()
+		self.reactor.after_poll.remove(self._check_connection)
+
+	def send(self, data):
+		if isinstance(data, str):
+			data = data.encode('ascii')
+		self.session.stream_outgoing += data
+
+	def sendline(self, line):
+		self.send(line)
+		self.send(b'\r')
+
+	def feed(self, data):
+		self.buffer += data
+		excess = len(self.buffer) - self.max_buffer
+		if excess > 0:
+			del self.buffer[:excess]
+			self.scanned = max(self.scanned - excess, 0)
+			self.discarded += excess
+		if self.patterns:
+			self._search()
+
+	def _search(self):
+		if self.scanned == len(self.buffer) and self.scanned:
+			return
+		best = None
+		for i, (regex, lookbehind) in enumerate(self.patterns):
+			start = max(self.scanned - lookbehind, 0)
+			window = bytes(self.buffer[start:])
+			m = regex.search(window)
+			if m and (best is None or start + m.start() < best[0]):
+				best = (start + m.start(), start + m.end(), i, m) # Earliest match wins, then pattern order
+		self.scanned = len(self.buffer)
+		if best:
+			_, end, self.index, self.match = best
+			consumed = bytes(self.buffer[:end])
+			del self.buffer[:end]
+			self.scanned = 0
+			self._finish(consumed)
+
+	def _finish(self, result):
+		callback = self.callback
+		if self.timer:
+			self.timer.cancel()
+		self.patterns = self.callback = self.timer = None
+		callback(result)
+
+	def _expired(self):
+		self._finish(ExpectTimeout(f"Timed out waiting for {self.session.theircall}", bytes(self.buffer)))
+
+	def _check_connection(self):
+		if self.patterns and self.session.state == self.session.States.DISCONNECTED:
+			self._finish(ExpectDisconnected(f"{self.session.theircall} disconnected", bytes(self.buffer)))
+
+	def expect_async(self, patterns, callback, timeout=None):
+		# callback gets the consumed bytes up to and including the match, or an
+		# ExpectError. It's called from the reactor, never from in here.
+		if self.patterns:
+			raise ExpectError("Already waiting on an expectation", bytes(self.buffer))
+		if not isinstance(patterns, (list, tuple)):
+			patterns = [patterns]
+		self.patterns = [compile_pattern(p, self.lookbehind) for p in patterns]
+		self.callback = callback
+		self.match = self.index = None
+		self.scanned = 0 # New patterns, so everything buffered is unsearched
+		if timeout is not None:
+			self.timer = self.reactor.call_later(timeout, self._expired)
+		self.reactor.call_soon(lambda: self.patterns and self._search())
+
+	def expect(self, patterns, timeout=30):
+		result = []
+		self.expect_async(patterns, result.append, timeout)
+		while not result:
+			self.reactor.run_once()
+		if isinstance(result[0], ExpectError):
+			raise result[0]
+		return result[0]
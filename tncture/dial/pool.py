@@ -0,0 +1,194 @@
+from contextlib import contextmanager
+import time
+from ..ax25.abm import AX25ConnectedModeConnection
+from ..ax25.frame import AX25Address, encode_ax25_address_key
+from ..metrics import REGISTRY
+from ..reactor import Reactor, TIMER_SLACK
+from ..transport.mux import PortMux
+
+# Keeps connections to remote nodes open between scripted commands, so a
+# script that runs one command per dial pays for the SABM/UA (seconds, over RF
+# and digipeaters) once. Idle connections are held up by the sessions' own
+# keep-alive RR. Sessions only run while the pool does: every call into it
+# drives its reactor, and a script with nothing to do can call idle(). Like the
+# reactor it's single-threaded.
+
+class PoolError(Exception):
+	pass
+
+class PooledConnection:
+	__slots__ = ('key', 'session', 'in_use', 'idle_since')
+
+	def __init__(self, key, session):
+		self.key = key # (mycall key, theircall key, path keys)
+		self.session = session
+		self.in_use = False
+		self.idle_since = time.time()
+
+	@property
+	def node(self):
+		return self.key[1]
+
+class ConnectionPool:
+	def __init__(self, port, mycall, max_per_node=1, max_idle=300, probe_after=30, probe_timeout=10, connect_timeout=60):
+		self.mycall = AX25Address.parse(mycall) if isinstance(mycall, str) else mycall
+		self.max_per_node = max_per_node # Sessions to one node, across our callsigns and paths
+		self.max_idle = max_idle # Seconds an unused connection is kept before we DISC it
+		self.probe_after = probe_after # Poll the other end before handing out a connection this quiet
+		self.probe_timeout = probe_timeout
+		self.connect_timeout = connect_timeout
+
+		self.mux = PortMux(port)
+		self.reactor = Reactor()
+		self.reactor.after_poll.append(self.maintain)
+		self.entries = {} # key -> PooledConnection
+
+		self.m_connects = REGISTRY.counter('tncture_pool_connects_total', 'New connections made by the pool')
+		self.m_reuses = REGISTRY.counter('tncture_pool_reuses_total', 'Connections handed out again without a new SABM')
+		self.m_probe_failures = REGISTRY.counter('tncture_pool_probe_failures_total', 'Idle connections dropped because the other end stopped answering')
+		self.m_connections = REGISTRY.gauge('tncture_pool_connections', 'Connections held by the pool')
+
+	@staticmethod
+	def _address(call):
+		return AX25Address.parse(call) if isinstance(call, str) else call
+
+	def _key(self, mycall, theircall, via):
+		return (
+			encode_ax25_address_key(mycall),
+			encode_ax25_address_key(theircall),
+			tuple(encode_ax25_address_key(v) for v in via)
+		)
+
+	def run_until(self, predicate, timeout):
+		# Drive the sessions until predicate() is true; False if timeout ran out first
+		deadline = time.time() + timeout
+		while not predicate():
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				return False
+			self.reactor.run_once(remaining)
+		return True
+
+	def idle(self, seconds):
+		# Let keep-alives and idle expiry run while the script has nothing to send
+		self.run_until(lambda: False, seconds)
+
+	def acquire(self, theircall, via=(), mycall=None):
+		mycall = self._address(mycall or self.mycall)
+		theircall = self._address(theircall)
+		via = [self._address(v) for v in via]
+		key = self._key(mycall, theircall, via)
+
+		entry = self.entries.get(key)
+		if entry and entry.in_use:
+			raise PoolError(f"{mycall} > {theircall} is already in use")
+		if entry and self._healthy(entry):
+			self.m_reuses.inc()
+			return self._hand_out(entry)
+		if entry:
+			self._discard(entry)
+
+		self._make_room(key)
+		session = AX25ConnectedModeConnection(self.mux.session_port(mycall, theircall), mycall, theircall, via=via)
+		entry = self.entries[key] = PooledConnection(key, session)
+		self.m_connections.set(len(self.entries))
+		self.reactor.add_session(session)
+		self.m_connects.inc()
+
+		self.run_until(lambda: session.state != session.States.CONNECTING, self.connect_timeout)
+		if session.state != session.States.CONNECTED:
+			self._discard(entry)
+			if session.state == session.States.CONNECTING:
+				raise PoolError(f"{theircall} didn't answer within {self.connect_timeout}s")
+			raise PoolError(f"{theircall} refused the connection")
+		return self._hand_out(entry)
+
+	def _hand_out(self, entry):
+		entry.in_use = True
+		entry.session.stream_incoming = b'' # Whatever trickled in while it sat idle
+		return entry.session
+
+	def _healthy(self, entry):
+		session = entry.session
+		if session.state != session.States.CONNECTED:
+			return False
+		if session.last_heard is not None and time.time() - session.last_heard < self.probe_after:
+			return True
+		# Force the keep-alive RR now and wait for any answer
+		heard = session.last_heard
+		session.keepalive_timer.start(-1000)
+		answered = self.run_until(lambda: session.last_heard != heard or session.state != session.States.CONNECTED, self.probe_timeout)
+		if not answered:
+			self.m_probe_failures.inc()
+		return answered and session.state == session.States.CONNECTED
+
+	def _make_room(self, key):
+		mine, node, _ = key
+		for entry in list(self.entries.values()):
+			if entry.key[:2] == (mine, node):
+				# The mux routes by callsign pair alone, so another path between the
+				# same two stations has to go; our SABM resets the other end's side
+				if entry.in_use:
+					raise PoolError(f"{entry.session.theircall} is in use from {entry.session.mycall} over another path")
+				self._discard(entry)
+
+		open_ = [e for e in self.entries.values() if e.node == node and e.session.state != e.session.States.DISCONNECTING]
+		if len(open_) < self.max_per_node:
+			return
+		idle = [e for e in open_ if not e.in_use]
+		if not idle:
+			raise PoolError(f"All {self.max_per_node} connections to {open_[0].session.theircall} are in use")
+		min(idle, key=lambda e: e.idle_since).session.initiate_disconnection()
+
+	def release(self, session, reuse=True):
+		# Give a connection back; reuse=False (or a session that's gone) disconnects it
+		entry = next((e for e in self.entries.values() if e.session is session), None)
+		if entry is None:
+			return
+		entry.in_use = False
+		entry.idle_since = time.time()
+		session.on_data = None
+		session.on_drain = lambda:None
+		if not reuse and session.state == session.States.CONNECTED:
+			session.initiate_disconnection()
+		else:
+			self.reactor.call_later(self.max_idle + TIMER_SLACK, self.maintain) # Wake up to expire it
+		self.maintain()
+
+	@contextmanager
+	def connection(self, theircall, via=(), mycall=None):
+		session = self.acquire(theircall, via, mycall)
+		try:
+			yield session
+		except BaseException:
+			# We don't know where in its output the other end is any more
+			self.release(session, reuse=False)
+			raise
+		self.release(session)
+
+	def _discard(self, entry):
+		if self.entries.get(entry.key) is entry:
+			del self.entries[entry.key]
+		if entry.session in self.reactor.sessions:
+			self.reactor.remove_session(entry.session)
+		entry.session.port.close()
+		entry.session.release_metrics()
+		self.m_connections.set(len(self.entries))
+
+	def maintain(self):
+		now = time.time()
+		for entry in list(self.entries.values()):
+			session = entry.session
+			if session.state == session.States.DISCONNECTED:
+				self._discard(entry)
+			elif not entry.in_use and session.state == session.States.CONNECTED and now - entry.idle_since > self.max_idle:
+				session.initiate_disconnection()
+
+	def close(self, timeout=10):
+		for entry in self.entries.values():
+			if entry.session.state != entry.session.States.DISCONNECTED:
+				entry.session.initiate_disconnection()
+		self.run_until(lambda: not self.entries, timeout)
+		for entry in list(self.entries.values()):
+			self._discard(entry)
+		self.reactor.close()
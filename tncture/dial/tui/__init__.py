@@ -8,6 +8,11 @@ from rich.markup import escape
 from ...ax25.frame import *
 from ...ax25.abm import *
 from ...transport.kiss import *
+from ...reactor import Reactor
+from ...monitor.sessions import SessionMonitor, format_stats
+from ...profiler import toggle_sampler, install_signal_toggle
+from ...trace import TraceRing, DUMP_CAPACITY
+from collections import deque
 import sys
 
 class ClientApp(App):
@@ -16,37 +21,51 @@ class ClientApp(App):
         Binding("ctrl+c", "ctrl_c", "Disconnect & Quit", show=False, priority=True),
         Binding("ctrl+z", "quit", "Force-Quit", show=False, priority=True),
         Binding("ctrl+d", "disconnect", "Disconnect", show=False, priority=True),
+        Binding("ctrl+t", "dump_trace", "Dump Trace", show=False, priority=True),
+        Binding("ctrl+o", "toggle_profiler", "Toggle Profiler", show=False, priority=True),
         Binding("tab", "focus_next", "Focus Next", show=False),
         Binding("shift+tab", "focus_previous", "Focus Previous", show=False),
     ]
 
-    def __init__(self, session):
+    def __init__(self, session, history=5000, snoop=False):
         App.__init__(self)
-        self.output_text = ''
-        self.log_text = ''
-        self.packets = []
+        # Session output, packets and log all keep the last `history` lines/rows
+        self.history = history
+        self.partial_line = '' # Session output after the last line break, shown below the log
+        self.packet_rows = deque() # Row keys in the packet table, oldest first
+        self.pending_rows = [] # Built in the worker thread, added to the table after each poll
+        self.diagnostics_text = None
         self.session = session
+        if not session.trace.seq:
+            session.trace = TraceRing(DUMP_CAPACITY) # ctrl+t dumps it; one session can afford the history
+        self.reactor = Reactor()
         self.session.port.on_tx = self.on_port_tx
         self.session.port.on_rx = self.on_port_rx
         self.quit_on_disconnect = False
         self.session_t_zero = time.time()
-        self.snoop_mode = '--snoop' in sys.argv
+        self.snoop_mode = snoop
+        self.snoop_lines = [] # Session monitor output, (is_data, line), flushed after each poll
         if self.snoop_mode:
             self.session.state = self.session.States.DISCONNECTED
+            self.monitor = SessionMonitor()
+            self.monitor.on_open = lambda s: self.snoop_lines.append((False, f"[monitor] {s} opened"))
+            self.monitor.on_close = lambda s, reason: self.snoop_lines.extend(
+                (False, f"[monitor] {line}") for line in format_stats(s.stats()).split('\n'))
+            self.monitor.on_data = lambda s, source, data: self.snoop_lines.append(
+                (True, f"[{str_ax25_address_key(source)}] " + data.decode('utf-8', 'backslashreplace').replace('\r', '\n')))
 
     def compose(self) -> ComposeResult:
         # with Vertical():
         with TabbedContent():
             with TabPane("Session"):
-                with VerticalScroll(id="results-container", classes='scroll-container'):
-                    yield Label(id="results", classes='scroll-body')
+                yield RichLog(id="results", classes='scroll-container', max_lines=self.history, markup=True, wrap=True)
+                yield Label(id="results-partial", classes='scroll-body')
             with TabPane("Packets"):
                 with VerticalScroll(id="packets-container", classes='scroll-container'):
                     yield DataTable(id="packets", classes='scroll-body')
             with TabPane("Diagnostics"):
                 yield Label(id="diagnostics", classes='scroll-body')
-                with VerticalScroll(id="log-container", classes='scroll-container'):
-                    yield Label(id="log", classes='scroll-body')
+                yield RichLog(id="log", classes='scroll-container', max_lines=self.history)
 
         with Container(id="bottom-container"):
             yield Markdown(id="status")
@@ -68,34 +87,57 @@ class ClientApp(App):
             'Body'
         )
         self.on_abm_state_change()
+        install_signal_toggle(on_toggle=lambda path: self.call_next(self.on_profiler_toggled, path))
         self.background_processing()
 
     def on_input_submitted(self, message: Input.Changed) -> None:
         b = message.value.encode('utf-8', 'backslashreplace') + b'\r'
-        self.session.stream_outgoing += b
+        def send():
+            self.session.stream_outgoing += b
+        self.reactor.call_soon_threadsafe(send)
         self.on_abm_rx(b, from_me=True)
         self.query_one(Input).value = ''
 
     def on_abm_rx(self, message, from_me=False):
-        t = escape(message.decode('utf-8', 'backslashreplace').replace('\r', '\n'))
-        if from_me:
-            t = '[b]' + t + '[/]'
-        self.output_text += t
-        self.query_one('#results').update(self.output_text)
-        self.query_one('#results-container').scroll_end()
+        def fmt(piece):
+            if not piece:
+                return ''
+            return '[b]' + escape(piece) + '[/]' if from_me else escape(piece)
+
+        # Only whole lines go to the log; the line still being typed stays in
+        # a one-line label until its line break arrives
+        *lines, rest = message.decode('utf-8', 'backslashreplace').replace('\r', '\n').split('\n')
+        results = self.query_one('#results')
+        for line in lines:
+            results.write(self.partial_line + fmt(line))
+            self.partial_line = ''
+        self.partial_line += fmt(rest)
+        if len(self.partial_line) > 4096:
+            results.write(self.partial_line)
+            self.partial_line = ''
+        self.query_one('#results-partial').update(self.partial_line)
 
     def on_port_rx(self, frame):
+        if self.snoop_mode:
+            self.monitor.feed(frame)
         f = parse_ax25_frame(frame, 8)
         if f.source.same_station(self.session.mycall) and not self.snoop_mode:
             # Crosstalk echo of my own packet
             # TODO: Better solution
             return
-        self.add_packet(True, f)
+        self.pending_rows.append(self.packet_row(True, f))
 
     def on_port_tx(self, frame):
-        self.add_packet(False, parse_ax25_frame(frame, 8))
+        self.pending_rows.append(self.packet_row(False, parse_ax25_frame(frame, 8)))
+
+    def add_packet_rows(self, rows):
+        table = self.query_one('#packets')
+        for row in rows:
+            self.packet_rows.append(table.add_row(*row))
+        while len(self.packet_rows) > self.history:
+            table.remove_row(self.packet_rows.popleft())
 
-    def add_packet(self, is_rx, frame):
+    def packet_row(self, is_rx, frame):
         if is_rx:
             if frame.source.same_station(self.session.theircall):
                 dir_pre = '[blue]'
@@ -122,7 +164,7 @@ class ClientApp(App):
         if dir_pre == '[grey46]':
             row = [dir_pre + x + '[/]' for x in row]
 
-        self.query_one('#packets').add_row(*row)
+        return row
 
     def on_abm_state_change(self):
         self.query_one("#status").update(self.session.state.name + (" (quitting...)" if self.quit_on_disconnect else ''))
@@ -144,58 +186,104 @@ class ClientApp(App):
             else:
                 return f"[grey46]STOP[/]/{timer.timeout:.1f}"
 
-        self.query_one('#diagnostics').update("\n".join([
+        if not hasattr(self.session, 'retransmit_timer'):
+            # The TNC runs this connection (--agw-offload); only the queues are ours
+            text = "\n".join([
+                f"Frames outstanding in the TNC: {self.session.outstanding}",
+                f"Outgoing Stream: {len(self.session.stream_outgoing)} bytes queued"
+            ])
+            if text != self.diagnostics_text:
+                self.diagnostics_text = text
+                self.query_one('#diagnostics').update(text)
+            return
+
+        pending = self.session.pending_ack_frame
+        text = "\n".join([
             f"V(S) = {self.session.vs}, V(R) = {self.session.vr}, V(A) = {self.session.va}",
             f"Retransmit timer: {str_timer(self.session.retransmit_timer)}",
             f"Keepalive timer: {str_timer(self.session.keepalive_timer)}",
             f"Burst ACK timer: {str_timer(self.session.burst_recieve_timer)}",
-            f"Pending frame: {self.session.pending_ack_frame}",
-            f"Outgoing Stream: {self.session.stream_outgoing}"
-        ]))
+            f"Pending frame: {escape(repr(pending[:64])) + ('...' if len(pending) > 64 else '') if pending else None}",
+            f"Outgoing Stream: {len(self.session.stream_outgoing)} bytes queued"
+        ])
+        if text != self.diagnostics_text:
+            self.diagnostics_text = text
+            self.query_one('#diagnostics').update(text)
+
+    def on_snoop_lines(self, lines):
+        results = self.query_one('#results')
+        log = self.query_one('#log')
+        for is_data, line in lines:
+            (results if is_data else log).write(escape(line) if is_data else line)
 
-    def on_session_log(self, a):
-        message = ' '.join(map(str, a)) + "\n"
-        self.log_text += message
-        self.query_one('#log').update(self.log_text)
-        self.query_one('#log-container').scroll_end()
+    def on_session_log(self, lines):
+        log = self.query_one('#log')
+        for line in lines[-self.history:]:
+            log.write(line)
 
     def action_ctrl_c(self):
         if self.session.state == AX25ConnectedModeConnection.States.DISCONNECTED:
             self.exit(0)
         else:
-            self.session.initiate_disconnection()
+            self.reactor.call_soon_threadsafe(self.session.initiate_disconnection)
             self.quit_on_disconnect = True
 
     def action_disconnect(self):
-        self.session.initiate_disconnection()
+        self.reactor.call_soon_threadsafe(self.session.initiate_disconnection)
+
+    def action_dump_trace(self):
+        path = f"tncture-trace-{int(time.time())}.bin"
+        self.session.trace.dump(path)
+        self.on_session_log([f"[client] Trace dumped to {path}"])
+
+    def action_toggle_profiler(self):
+        self.on_profiler_toggled(toggle_sampler())
+
+    def on_profiler_toggled(self, path):
+        self.on_session_log(["[client] Profiler sampling..." if path is None else f"[client] Profile written to {path}"])
 
     @work(exclusive=True, thread=True)
     def background_processing(self):
-        def log(*a, **k):
-            assert k == {}
-            self.call_from_thread(self.on_session_log, a)
-        self.session.debug_print = log
-        time.sleep(0.1)
-        while True:
-            prev_state = self.session.state
-            self.session.poll()
+        trace_seen = 0
+        prev_state = self.session.state
+
+        def after_poll():
+            nonlocal trace_seen, prev_state
+            if self.pending_rows:
+                rows, self.pending_rows = self.pending_rows, []
+                self.call_from_thread(self.add_packet_rows, rows)
 
             if self.session.stream_incoming:
                 self.call_from_thread(self.on_abm_rx, self.session.stream_incoming)
                 self.session.stream_incoming = b''
 
-            time.sleep(0.05)
+            if self.snoop_lines:
+                lines, self.snoop_lines = self.snoop_lines, []
+                self.call_from_thread(self.on_snoop_lines, lines)
 
             if self.session.state != prev_state:
+                prev_state = self.session.state
                 self.call_from_thread(self.on_abm_state_change)
 
-            self.call_from_thread(self.on_periodic_poll)
+            if self.session.trace.seq != trace_seen:
+                lines = [message for _, _, message in self.session.trace.decode(trace_seen)]
+                trace_seen = self.session.trace.seq
+                self.call_from_thread(self.on_session_log, lines)
 
+        def periodic():
             if get_current_worker().is_cancelled:
-                break
+                self.reactor.stop()
+                return
+            self.call_from_thread(self.on_periodic_poll) # Only redraws if something changed
+            self.reactor.call_later(0.2, periodic)
+
+        self.reactor.after_poll.append(after_poll)
+        self.reactor.call_later(0.1, lambda: self.reactor.add_session(self.session))
+        periodic()
+        self.reactor.run()
 
 
-def run_ui(session):
-    app = ClientApp(session)
+def run_ui(session, history=5000, snoop=False):
+    app = ClientApp(session, history, snoop)
     app.run()
     sys.exit(0)
@@ -1,6 +1,9 @@
+import sys
 from ..tui import run_ui
 from ..args import get_session
 
 if __name__ == '__main__':
-	run_ui(get_session('tncture.dial.tui'))
-
+	history = int(sys.argv[sys.argv.index('--history') + 1]) if '--history' in sys.argv else 5000
+	if '--snoop' in sys.argv and '--agw-offload' in sys.argv:
+		sys.exit("--snoop needs raw frames, which --agw-offload doesn't see")
+	run_ui(get_session('tncture.dial.tui'), history, '--snoop' in sys.argv)
@@ -0,0 +1,48 @@
+from ...ax25.abm import *
+from ...yapp import YAPPSender, YAPPReceiver
+from ...reactor import Reactor
+import sys, time
+
+
+def run_transfer(session, action, path):
+	# action is 'send' (path is a file) or 'recv' (path is the directory to save into)
+	if action == 'send':
+		start = lambda: YAPPSender(session, path)
+	else:
+		start = lambda: YAPPReceiver(session, path)
+
+	reactor = Reactor()
+	reactor.add_session(session)
+	transfer = None
+	last_report = 0
+
+	def after_poll():
+		nonlocal transfer, last_report
+		if transfer is None and session.state == AX25ConnectedModeConnection.States.CONNECTED:
+			print("[xfer] Connected.")
+			transfer = start()
+
+		if transfer and time.time() - last_report > 1 and transfer.started:
+			last_report = time.time()
+			eta = transfer.eta()
+			print(f"[xfer] {transfer.name}: {transfer.offset}/{transfer.size} bytes, "
+				f"{transfer.rate():.0f} B/s, ETA {'?' if eta is None else f'{eta:.0f}s'}")
+
+		if transfer and transfer.done and session.state == AX25ConnectedModeConnection.States.CONNECTED:
+			if transfer.error:
+				print(f"[xfer] Failed: {transfer.error}")
+			else:
+				print(f"[xfer] {transfer.name}: {transfer.offset - transfer.resumed_from} bytes in "
+					f"{transfer.finished - transfer.started:.1f}s, {transfer.rate():.0f} B/s goodput")
+			session.initiate_disconnection()
+
+		if session.state == AX25ConnectedModeConnection.States.DISCONNECTED and (transfer or not session.accept_incoming):
+			print("[xfer] Disconnected.")
+			reactor.stop()
+
+	reactor.after_poll.append(after_poll)
+
+	print(f"[xfer] {'Waiting for' if session.accept_incoming else 'Dialing'} {session.mycall} -> {session.theircall}")
+
+	reactor.run()
+	sys.exit(0 if transfer and transfer.done and not transfer.error else 1)
@@ -0,0 +1,11 @@
+import sys
+from ..xfer import run_transfer
+from ..args import get_session
+
+if __name__ == '__main__':
+	action = next((a for a in ('send', 'recv') if a in sys.argv[3:]), None)
+	if action is None:
+		print("Usage: tncture.dial.xfer MYCALL[-X] THEIRCALL-X (send FILE | recv DIR) [--listen]")
+		sys.exit(1)
+	path = sys.argv[sys.argv.index(action) + 1]
+	run_transfer(get_session('tncture.dial.xfer'), action, path)
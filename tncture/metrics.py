@@ -0,0 +1,181 @@
+from bisect import bisect_left
+import threading
+
+class Counter:
+	__slots__ = ('value',)
+	kind = 'counter'
+
+	def __init__(self):
+		self.value = 0
+
+	def inc(self, n=1):
+		self.value += n
+
+	def snapshot(self):
+		return self.value
+
+class Gauge:
+	__slots__ = ('value',)
+	kind = 'gauge'
+
+	def __init__(self):
+		self.value = 0
+
+	def set(self, value):
+		self.value = value
+
+	def inc(self, n=1):
+		self.value += n
+
+	def dec(self, n=1):
+		self.value -= n
+
+	def snapshot(self):
+		return self.value
+
+# Seconds; covers sub-millisecond polls up to multi-second RF round trips
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30)
+# Seconds; for per-call costs (a poll(), parsing one read) that are usually microseconds
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1)
+
+class Histogram:
+	__slots__ = ('buckets', 'counts', 'sum', 'count')
+	kind = 'histogram'
+
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def snapshot(self):
+		cumulative, total = {}, 0
+		for bound, n in zip(self.buckets, self.counts):
+			total += n
+			cumulative[bound] = total
+		return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+class MetricsRegistry:
+	def __init__(self):
+		self.families = {} # name -> (kind, help, {labels: metric})
+		self.lock = threading.Lock()
+
+	def _get(self, cls, name, help, labels, *args):
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			family = self.families.get(name)
+			if family is None:
+				family = self.families[name] = (cls.kind, help, {})
+			assert family[0] == cls.kind, f"Metric {name} already registered as a {family[0]}"
+			metric = family[2].get(key)
+			if metric is None:
+				metric = family[2][key] = cls(*args)
+			return metric
+
+	def counter(self, name, help='', **labels):
+		return self._get(Counter, name, help, labels)
+
+	def gauge(self, name, help='', **labels):
+		return self._get(Gauge, name, help, labels)
+
+	def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+		return self._get(Histogram, name, help, labels, buckets)
+
+	def remove(self, **match):
+		# Forget every series whose labels include `match`, e.g. a closed
+		# connection's, so long-running processes don't accumulate them.
+		# Metric objects still held elsewhere keep working, unexported.
+		match = set(match.items())
+		with self.lock:
+			for name, (kind, help, series) in list(self.families.items()):
+				for key in [key for key in series if match <= set(key)]:
+					del series[key]
+				if not series:
+					del self.families[name]
+
+	def snapshot(self, **match):
+		# {name: [(labels, value), ...]}, optionally only series whose labels include `match`
+		out = {}
+		with self.lock:
+			families = [(name, list(family[2].items())) for name, family in self.families.items()]
+		for name, series in families:
+			rows = [(dict(key), m.snapshot()) for key, m in series
+				if all(dict(key).get(k) == v for k, v in match.items())]
+			if rows:
+				out[name] = rows
+		return out
+
+	def render_prometheus(self):
+		def fmt_labels(labels, **extra):
+			labels = {**labels, **extra}
+			if not labels:
+				return ''
+			return '{' + ','.join(f'{k}="{escape(str(v))}"' for k, v in labels.items()) + '}'
+
+		def escape(v):
+			return v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+		lines = []
+		with self.lock:
+			families = [(name, kind, help, list(series.items())) for name, (kind, help, series) in self.families.items()]
+		for name, kind, help, series in families:
+			if help:
+				lines.append(f"# HELP {name} {help}")
+			lines.append(f"# TYPE {name} {kind}")
+			for key, metric in series:
+				labels = dict(key)
+				if kind == 'histogram':
+					snap = metric.snapshot()
+					for bound, n in snap['buckets'].items():
+						lines.append(f"{name}_bucket{fmt_labels(labels, le=bound)} {n}")
+					lines.append(f"{name}_bucket{fmt_labels(labels, le='+Inf')} {snap['count']}")
+					lines.append(f"{name}_sum{fmt_labels(labels)} {snap['sum']}")
+					lines.append(f"{name}_count{fmt_labels(labels)} {snap['count']}")
+				else:
+					lines.append(f"{name}{fmt_labels(labels)} {metric.value}")
+		return '\n'.join(lines) + '\n'
+
+class CounterSet:
+	# Counters sharing a name and labels except for one, created on first use
+	def __init__(self, registry, name, help, label, **labels):
+		self.registry = registry
+		self.name = name
+		self.help = help
+		self.label = label
+		self.labels = labels
+		self.counters = {}
+
+	def __getitem__(self, value):
+		c = self.counters.get(value)
+		if c is None:
+			c = self.counters[value] = self.registry.counter(self.name, self.help, **{self.label: value}, **self.labels)
+		return c
+
+REGISTRY = MetricsRegistry()
+
+def serve_prometheus(registry=REGISTRY, address='127.0.0.1', port=9125):
+	from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+	class Handler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path not in ('/', '/metrics'):
+				self.send_error(404)
+				return
+			body = registry.render_prometheus().encode('utf-8')
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/plain; version=0.0.4')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, *a):
+			pass
+
+	server = ThreadingHTTPServer((address, port), Handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
@@ -0,0 +1,300 @@
+from dataclasses import dataclass
+from bisect import bisect_left
+import mmap, os, struct, sys, time
+from ..ax25.frame import *
+from ..transport.agw import AGWResp_MonitoredRawFrame, AGWResp_MonitoredOwnFrame
+
+# Capture file: MAGIC, then records of RECORD_HEADER followed by the raw AX.25 frame.
+# Sidecar index (<capture>.idx): INDEX_MAGIC, the number of capture bytes covered,
+# then one fixed-size INDEX_ENTRY per record, in capture order.
+
+MAGIC = b'TNCCAP\x00\x01'
+RECORD_HEADER = struct.Struct('<IdBB') # frame length, timestamp, radio port, flags
+INDEX_MAGIC = b'TNCIDX\x00\x01'
+INDEX_HEADER = struct.Struct('<8sQ')
+INDEX_ENTRY = struct.Struct('<dQ7s7sxx') # timestamp, record offset, source key, dest key
+
+FLAG_TX = 0b01
+FLAG_AGW = 0b10
+
+NULL_KEY = bytes(7) # Index key for frames too short to have both addresses
+
+LINKTYPE_AX25_KISS = 202
+
+@dataclass
+class CaptureRecord:
+	timestamp: float
+	port: int
+	flags: int
+	frame: bytes
+
+	@property
+	def tx(self):
+		return bool(self.flags & FLAG_TX)
+
+	def __str__(self):
+		parsed = parse_ax25_frame(self.frame, 8) if len(self.frame) >= 15 else f"runt frame, {len(self.frame)} bytes"
+		return f"{self.timestamp:.3f} {self.port} {'TX' if self.tx else 'RX'} {parsed}"
+
+def index_keys(frame):
+	# (source key, dest key) for the index. Runts from a noisy channel are
+	# still recorded, just not findable by address.
+	if len(frame) < 14:
+		return NULL_KEY, NULL_KEY
+	return peek_ax25_addresses(frame)
+
+class CaptureWriter:
+	def __init__(self, path):
+		self.path = path
+		self.f = open(path, 'ab')
+		if self.f.tell() == 0:
+			self.f.write(MAGIC)
+
+		self.idx = open(path + '.idx', 'r+b' if os.path.exists(path + '.idx') else 'w+b')
+		if self.idx.seek(0, os.SEEK_END) == 0:
+			self.idx.write(INDEX_HEADER.pack(INDEX_MAGIC, len(MAGIC)))
+		self._sync_index()
+
+	def _sync_index(self):
+		# Only trust the sidecar if it covers exactly what's in the capture, otherwise
+		# leave it for CaptureReader to rebuild
+		self.idx.seek(0)
+		magic, covered = INDEX_HEADER.unpack(self.idx.read(INDEX_HEADER.size))
+		self.index_ok = magic == INDEX_MAGIC and covered == self.f.tell()
+		self.idx.seek(0, os.SEEK_END)
+
+	def write(self, frame, port=0, flags=0, timestamp=None):
+		if timestamp is None:
+			timestamp = time.time()
+		offset = self.f.tell()
+		self.f.write(RECORD_HEADER.pack(len(frame), timestamp, port, flags))
+		self.f.write(frame)
+
+		if self.index_ok:
+			src, dest = index_keys(frame)
+			self.idx.write(INDEX_ENTRY.pack(timestamp, offset, src, dest))
+
+	def flush(self):
+		self.f.flush()
+		if self.index_ok:
+			self.idx.seek(0)
+			self.idx.write(INDEX_HEADER.pack(INDEX_MAGIC, self.f.tell()))
+			self.idx.seek(0, os.SEEK_END)
+			self.idx.flush()
+
+	def close(self):
+		self.flush()
+		self.f.close()
+		self.idx.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *a):
+		self.close()
+
+	def write_kiss_frame(self, frame, tx=False):
+		# As returned by TCPKISSConnection.recieve_raw_kiss_frame: command byte + data
+		if frame[0] & 0b1111 != 0:
+			return
+		self.write(frame[1:], frame[0] >> 4, FLAG_TX if tx else 0)
+
+	def write_agw_frame(self, frame):
+		if type(frame) == AGWResp_MonitoredRawFrame:
+			self.write(frame.frame, frame.port, FLAG_AGW)
+		elif type(frame) == AGWResp_MonitoredOwnFrame:
+			self.write(frame.frame, frame.port, FLAG_AGW | FLAG_TX)
+
+	def hook_port(self, port):
+		# Record everything a KISSPort sends and receives, keeping existing hooks
+		on_tx, on_rx = port.on_tx, port.on_rx
+		def tx(frame):
+			self.write(frame, port.port, FLAG_TX)
+			on_tx(frame)
+		def rx(frame):
+			self.write(frame, port.port)
+			on_rx(frame)
+		port.on_tx, port.on_rx = tx, rx
+
+class CaptureReader:
+	def __init__(self, path):
+		self.path = path
+		self.f = open(path, 'rb')
+		self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+		assert self.data[:len(MAGIC)] == MAGIC, "Not a tncture capture file"
+
+		self._update_index()
+		self.idx = open(path + '.idx', 'rb')
+		self.index = mmap.mmap(self.idx.fileno(), 0, access=mmap.ACCESS_READ)
+		# A writer still recording may have indexed records past what we mapped
+		self.count = self._entries_below(self.index, len(self.data))
+
+	@staticmethod
+	def _entries_below(index, limit):
+		# How many leading entries are for records that start before `limit`
+		n = (len(index) - INDEX_HEADER.size) // INDEX_ENTRY.size
+		offset = lambda i: INDEX_ENTRY.unpack_from(index, INDEX_HEADER.size + i * INDEX_ENTRY.size)[1]
+		return bisect_left(range(n), limit, key=offset)
+
+	def _update_index(self):
+		# Extend (or rebuild) the sidecar by walking record headers; frames aren't
+		# parsed. A CaptureWriter may have it open, so it's never changed in place:
+		# the new one is written alongside and renamed over it.
+		path = self.path + '.idx'
+		index = b''
+		if os.path.exists(path):
+			with open(path, 'rb') as f:
+				index = f.read()
+		covered = 0
+		if len(index) >= INDEX_HEADER.size:
+			magic, covered = INDEX_HEADER.unpack_from(index)
+			if magic != INDEX_MAGIC or covered > len(self.data):
+				covered = 0
+
+		if covered == len(self.data):
+			return
+
+		if covered:
+			# Entries the writer added after it last wrote the header are rebuilt below
+			kept = self._entries_below(index, covered)
+			entries = [index[INDEX_HEADER.size:INDEX_HEADER.size + kept * INDEX_ENTRY.size]]
+		else:
+			covered = len(MAGIC)
+			entries = []
+
+		offset = covered
+		while offset + RECORD_HEADER.size <= len(self.data):
+			length, timestamp, _, _ = RECORD_HEADER.unpack_from(self.data, offset)
+			start = offset + RECORD_HEADER.size
+			if start + length > len(self.data):
+				break # Partially written record
+			src, dest = index_keys(self.data[start:start+min(length, 14)])
+			entries.append(INDEX_ENTRY.pack(timestamp, offset, src, dest))
+			offset = start + length
+
+		tmp = f"{path}.{os.getpid()}.tmp"
+		with open(tmp, 'wb') as idx:
+			idx.write(INDEX_HEADER.pack(INDEX_MAGIC, offset))
+			idx.write(b''.join(entries))
+		os.replace(tmp, path)
+
+	def close(self):
+		self.index.close()
+		self.idx.close()
+		self.data.close()
+		self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *a):
+		self.close()
+
+	def __len__(self):
+		return self.count
+
+	def _entry(self, i):
+		return INDEX_ENTRY.unpack_from(self.index, INDEX_HEADER.size + i * INDEX_ENTRY.size)
+
+	def timestamp(self, i):
+		return struct.unpack_from('<d', self.index, INDEX_HEADER.size + i * INDEX_ENTRY.size)[0]
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += self.count
+		if not 0 <= i < self.count:
+			raise IndexError(i)
+		offset = self._entry(i)[1]
+		length, timestamp, port, flags = RECORD_HEADER.unpack_from(self.data, offset)
+		start = offset + RECORD_HEADER.size
+		return CaptureRecord(timestamp, port, flags, self.data[start:start+length])
+
+	def __iter__(self):
+		for i in range(self.count):
+			yield self[i]
+
+	def _bisect(self, t):
+		# Records are appended in (wall clock) time order
+		return bisect_left(range(self.count), t, key=self.timestamp)
+
+	def between(self, start=None, end=None):
+		first = self._bisect(start) if start is not None else 0
+		last = self._bisect(end) if end is not None else self.count
+		for i in range(first, last):
+			yield self[i]
+
+	def by_callsign(self, call, start=None, end=None):
+		# Substring search over the mmapped index, so this runs at memchr speed rather
+		# than visiting every entry from Python
+		key = encode_ax25_address_key(call)
+		first = self._bisect(start) if start is not None else 0
+		last = self._bisect(end) if end is not None else self.count
+
+		fields = (16, 23) # Offsets of the source and dest keys within an entry
+		pos = INDEX_HEADER.size + first * INDEX_ENTRY.size
+		stop = INDEX_HEADER.size + last * INDEX_ENTRY.size
+		prev = None
+		while True:
+			pos = self.index.find(key, pos, stop)
+			if pos == -1:
+				break
+			i, field = divmod(pos - INDEX_HEADER.size, INDEX_ENTRY.size)
+			if field in fields and i != prev:
+				prev = i
+				yield self[i]
+			pos += 1
+
+def export_pcap(records, path):
+	with open(path, 'wb') as f:
+		f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, LINKTYPE_AX25_KISS))
+		for r in records:
+			sec = int(r.timestamp)
+			usec = int((r.timestamp - sec) * 1000000)
+			packet = bytes([r.port << 4]) + r.frame
+			f.write(struct.pack('<IIII', sec, usec, len(packet), len(packet)))
+			f.write(packet)
+
+def record_kiss(path, address='localhost', port=8001):
+	from ..transport.kiss import TCPKISSConnection
+	kiss = TCPKISSConnection(address, port)
+	with CaptureWriter(path) as w:
+		while True:
+			for p in range(16):
+				frame = kiss.recieve_raw_kiss_frame(p)
+				while frame:
+					w.write_kiss_frame(frame)
+					frame = kiss.recieve_raw_kiss_frame(p)
+			w.flush()
+			time.sleep(0.05)
+
+def record_agw(path, address='localhost', port=8000):
+	from ..transport.agw import AGWTCPConnection, AGWReq_EnableRawMonitoring
+	agw = AGWTCPConnection(address, port)
+	agw.send_agw_frame(AGWReq_EnableRawMonitoring(0))
+	with CaptureWriter(path) as w:
+		while True:
+			w.write_agw_frame(agw.recv_agw_frame_blocking())
+			w.flush()
+
+def main(argv):
+	if len(argv) < 3:
+		print("Usage: tncture.monitor.capture record-kiss|record-agw FILE [HOST PORT]")
+		print("       tncture.monitor.capture show FILE [CALL]")
+		print("       tncture.monitor.capture pcap FILE OUT.pcap")
+		sys.exit(1)
+
+	cmd, path, *rest = argv[1:]
+	if cmd == 'record-kiss':
+		record_kiss(path, rest[0], int(rest[1])) if rest else record_kiss(path)
+	elif cmd == 'record-agw':
+		record_agw(path, rest[0], int(rest[1])) if rest else record_agw(path)
+	elif cmd == 'show':
+		with CaptureReader(path) as r:
+			for record in (r.by_callsign(rest[0]) if rest else r):
+				print(record)
+	elif cmd == 'pcap':
+		with CaptureReader(path) as r:
+			export_pcap(r, rest[0])
+
+if __name__ == '__main__':
+	main(sys.argv)
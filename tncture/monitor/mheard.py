@@ -0,0 +1,225 @@
+from collections import OrderedDict
+import os, struct, sys, time
+from ..ax25.frame import *
+from ..metrics import REGISTRY
+
+# Heard-stations table (MHEARD): who has been heard, on which port, when, and
+# via which digipeaters. Only the address fields and control byte of each raw
+# frame are looked at, so it can sit on every received frame (hook_port() puts
+# it on a KISSPort's on_rx). One small record per (station, port), least
+# recently heard evicted first past max_stations, snapshotted to disk with
+# save() and read back when the index is created.
+
+# Snapshot file: MAGIC, then per station SNAPSHOT_RECORD followed by its path bytes,
+# least recently heard first
+MAGIC = b'TNCMHD\x00\x01'
+SNAPSHOT_RECORD = struct.Struct('<7sBddIIIIB') # key, port, first, last, I, S, U, UI, path length
+
+class HeardStation:
+	__slots__ = ('key', 'port', 'first', 'last', 'i', 's', 'u', 'ui', 'path')
+
+	def __init__(self, key, port, t):
+		self.key = key # Address key, see ax25_address_key
+		self.port = port
+		self.first = t
+		self.last = t
+		self.i = 0
+		self.s = 0
+		self.u = 0 # Not counting UI
+		self.ui = 0
+		self.path = b'' # Repeater address fields of the last frame, as received
+
+	@property
+	def call(self):
+		return str_ax25_address_key(self.key)
+
+	@property
+	def frames(self):
+		return self.i + self.s + self.u + self.ui
+
+	def via(self):
+		# Digipeater calls of the last frame, those that had repeated it marked *
+		return [str_ax25_address_key(self.path[n:n+7]) + ('*' if self.path[n+6] & 0x80 else '')
+			for n in range(0, len(self.path), 7)]
+
+	def __str__(self):
+		via = f" via {','.join(self.via())}" if self.path else ''
+		return f"{self.call} on port {self.port}, last {format_time(self.last)}, {self.frames} frames{via}"
+
+class MHeard:
+	def __init__(self, max_stations=1000, path=None):
+		self.max_stations = max_stations
+		self.path = path # Snapshot file, loaded now if it exists
+		self.stations = OrderedDict() # key + port byte -> HeardStation, least recently heard first
+		self.ports = set() # Ports anything has been heard on, for lookups by call alone
+		self.on_new = lambda station:None # First time a station is heard (or heard again after eviction)
+
+		self.m_stations = REGISTRY.gauge('tncture_mheard_stations', 'Stations in the heard list')
+		self.m_evicted = REGISTRY.counter('tncture_mheard_evictions_total', 'Stations dropped from a full heard list')
+
+		if path and os.path.exists(path):
+			self.load(path)
+
+	def hook_port(self, port, index=None):
+		# Feed everything a KISSPort receives, keeping any existing hook
+		index = port.port if index is None else index
+		on_rx = port.on_rx
+		def rx(frame):
+			self.feed(frame, index)
+			on_rx(frame)
+		port.on_rx = rx
+
+	def feed(self, frame, port=0, t=None):
+		if len(frame) < 15:
+			return
+		end = ax25_address_end(frame)
+		if end >= len(frame):
+			return
+		if t is None:
+			t = time.time()
+
+		key = ax25_address_key(frame[7:14])
+		entry = key + bytes([port])
+		station = self.stations.get(entry)
+		if station is None:
+			station = self._add(entry, key, port, t)
+		else:
+			self.stations.move_to_end(entry)
+			station.last = t
+
+		control = frame[end]
+		if control & 1 == 0:
+			station.i += 1
+		elif control & 0b11 == 0b01:
+			station.s += 1
+		elif control & ~0x10 == 0x03:
+			station.ui += 1
+		else:
+			station.u += 1
+		station.path = frame[14:end]
+
+	def _add(self, entry, key, port, t):
+		if len(self.stations) >= self.max_stations:
+			self.stations.popitem(last=False)
+			self.m_evicted.inc()
+		station = self.stations[entry] = HeardStation(key, port, t)
+		self.ports.add(port)
+		self.m_stations.set(len(self.stations))
+		self.on_new(station)
+		return station
+
+	def get(self, call, port=None):
+		# Most recently heard record for call (on port, if given), or None
+		key = encode_ax25_address_key(call)
+		ports = self.ports if port is None else (port,)
+		found = [self.stations.get(key + bytes([p])) for p in ports]
+		return max((s for s in found if s), key=lambda s: s.last, default=None)
+
+	def heard(self, port=None, since=None, limit=None):
+		# Most recently heard first
+		out = []
+		for station in reversed(self.stations.values()):
+			if since is not None and station.last < since:
+				break
+			if port is None or station.port == port:
+				out.append(station)
+				if limit is not None and len(out) >= limit:
+					break
+		return out
+
+	def save(self, path=None):
+		# Written beside the old snapshot and renamed over it, so a crash
+		# mid-save leaves the previous one
+		path = path or self.path
+		tmp = path + '.tmp'
+		with open(tmp, 'wb') as f:
+			f.write(MAGIC)
+			for s in self.stations.values():
+				f.write(SNAPSHOT_RECORD.pack(s.key, s.port, s.first, s.last, s.i, s.s, s.u, s.ui, len(s.path)))
+				f.write(s.path)
+		os.replace(tmp, path)
+
+	def load(self, path):
+		with open(path, 'rb') as f:
+			data = f.read()
+		if data[:len(MAGIC)] != MAGIC:
+			return # Not a snapshot (or an old format); start empty
+		offset = len(MAGIC)
+		while offset + SNAPSHOT_RECORD.size <= len(data):
+			key, port, first, last, i, s, u, ui, path_length = SNAPSHOT_RECORD.unpack_from(data, offset)
+			offset += SNAPSHOT_RECORD.size
+			station = HeardStation(key, port, first)
+			station.last, station.i, station.s, station.u, station.ui = last, i, s, u, ui
+			station.path = data[offset:offset+path_length]
+			offset += path_length
+			self.stations[key + bytes([port])] = station
+			self.ports.add(port)
+		while len(self.stations) > self.max_stations:
+			self.stations.popitem(last=False)
+		self.m_stations.set(len(self.stations))
+
+	def autosave(self, reactor, interval=300):
+		# Snapshot every interval seconds on reactor
+		def save():
+			self.save()
+			reactor.call_later(interval, save)
+		reactor.call_later(interval, save)
+
+def format_time(t):
+	return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+
+def format_heard(stations):
+	lines = [f"{'Call':<10} {'Port':>4}  {'Last heard':<19}  {'First heard':<19} {'I':>6} {'S':>6} {'U':>5} {'UI':>6}  Via"]
+	for s in stations:
+		lines.append(f"{s.call:<10} {s.port:>4}  {format_time(s.last)}  {format_time(s.first)} {s.i:>6} {s.s:>6} {s.u:>5} {s.ui:>6}  {','.join(s.via())}")
+	return '\n'.join(lines)
+
+def main(argv):
+	if len(argv) < 2:
+		print("Usage: tncture.monitor.mheard live [HOST PORT] [--db PATH]")
+		print("       tncture.monitor.mheard replay CAPTURE [--db PATH]")
+		print("       tncture.monitor.mheard show PATH")
+		sys.exit(1)
+
+	db = argv[argv.index('--db') + 1] if '--db' in argv else None
+	args = [a for i, a in enumerate(argv[1:], 1) if a != '--db' and argv[i-1] != '--db']
+
+	if args[0] == 'show':
+		print(format_heard(MHeard(path=args[1]).heard()))
+	elif args[0] == 'replay':
+		from .capture import CaptureReader
+		mheard = MHeard(path=db)
+		with CaptureReader(args[1]) as r:
+			for record in r:
+				if not record.tx:
+					mheard.feed(record.frame, record.port, record.timestamp)
+		print(format_heard(mheard.heard()))
+		if db:
+			mheard.save()
+	elif args[0] == 'live':
+		from ..transport.kiss import TCPKISSConnection, KISSPort
+		from ..reactor import Reactor
+		port = KISSPort(TCPKISSConnection(args[1], int(args[2])) if len(args) > 2 else TCPKISSConnection('localhost', 8001), 0)
+		mheard = MHeard(path=db)
+		mheard.hook_port(port)
+		mheard.on_new = lambda station: print(f"[mheard] New: {station}")
+		reactor = Reactor()
+
+		def pump():
+			# Receiving is all it takes; the hook does the rest
+			frame = port.recieve_data_frame()
+			while frame or port.pending():
+				frame = port.recieve_data_frame()
+		reactor.add_reader(port.transport, pump)
+		if db:
+			mheard.autosave(reactor, 60)
+		try:
+			reactor.run()
+		except KeyboardInterrupt:
+			pass
+		print(format_heard(mheard.heard()))
+		if db:
+			mheard.save()
+
+if __name__ == '__main__':
+	main(sys.argv)
@@ -0,0 +1,417 @@
+from collections import OrderedDict
+import sys, time, zlib
+from ..ax25.frame import *
+from ..ax25.compress import PID_COMPRESSED
+from ..node.digipeater import dupe_key
+from ..metrics import REGISTRY, CounterSet
+
+# Passive reconstruction of the connected-mode sessions on a channel. Frames are
+# read straight from the raw bytes; each pair of stations gets a MonitoredSession
+# holding one Direction per sender, which puts I-frames back in N(S) order, drops
+# retransmissions and times acknowledgements. Everything per session is bounded
+# by the modulo-8 window, and sessions are evicted when idle or when there are
+# too many of them.
+
+# Control bytes with the P/F bit masked off
+U_SABM = 0x2F
+U_SABME = 0x6F
+U_DISC = 0x43
+U_UA = 0x63
+U_DM = 0x0F
+U_FRMR = 0x87
+
+S_RR, S_RNR, S_REJ, S_SREJ = 0, 1, 2, 3
+MODULUS = 8
+
+class Direction:
+	# Frames from one station to the other. next_ns is the receiver's V(R) as far
+	# as we can tell, va/vs the sender's V(A)/V(S).
+	__slots__ = ('next_ns', 'va', 'vs', 'pending', 'recent', 'sent_at', 'decompressor', 'from_start',
+		'bytes', 'frames', 'retries', 'gaps', 'rej', 'rnr', 'undecodable', 'rtt_count', 'rtt_total', 'rtt_min', 'rtt_max')
+
+	def __init__(self, from_start):
+		self.restart(from_start)
+		self.bytes = 0
+		self.frames = 0
+		self.retries = 0
+		self.gaps = 0 # Frames the receiver acknowledged that we never heard
+		self.rej = 0
+		self.rnr = 0
+		self.undecodable = 0
+		self.rtt_count = 0
+		self.rtt_total = 0.0
+		self.rtt_min = None
+		self.rtt_max = None
+
+	def restart(self, from_start=True):
+		# Sequence state for a new link; the counters carry on
+		self.next_ns = 0 if from_start else None # None until the first I-frame if we joined late
+		self.va = self.vs = self.next_ns
+		self.pending = {} # N(S) -> payload heard ahead of a missing frame
+		self.recent = {} # N(S) -> hash of the payload last delivered with it
+		self.sent_at = {} # N(S) -> first transmission time, None once retransmitted
+		self.decompressor = None
+		self.from_start = from_start # Seen since SABM, so compressed payload can be followed
+
+	def information(self, ns, pid, data, t):
+		# Payloads now in order, if any
+		self.frames += 1
+		if self.next_ns is None:
+			self.next_ns = self.va = self.vs = ns
+		if ns != self.next_ns:
+			if ns in self.pending or self.recent.get(ns) == hash(data):
+				self.retries += 1
+				if ns in self.sent_at:
+					self.sent_at[ns] = None # Karn: no RTT from a retransmitted frame
+				return ()
+			self.pending[ns] = (pid, data)
+			self._sent(ns, t)
+			if len(self.pending) >= MODULUS - 1:
+				return self._skip_to(max(self.pending, key=lambda n: (n - self.next_ns) % MODULUS))
+			return ()
+
+		self._sent(ns, t)
+		out = [self._deliver(ns, pid, data)]
+		out += self._drain()
+		return out
+
+	def _sent(self, ns, t):
+		self.sent_at[ns] = t
+		if (ns - self.va) % MODULUS >= (self.vs - self.va) % MODULUS:
+			self.vs = (ns + 1) % MODULUS
+
+	def _deliver(self, ns, pid, data):
+		self.recent[ns] = hash(data)
+		self.next_ns = (ns + 1) % MODULUS
+		if pid == PID_COMPRESSED:
+			if self.decompressor is None and self.from_start:
+				self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+			if self.decompressor is None:
+				self.undecodable += 1
+				return b''
+			try:
+				data = self.decompressor.decompress(data)
+			except zlib.error:
+				self.decompressor = None
+				self.from_start = False
+				self.undecodable += 1
+				return b''
+		self.bytes += len(data)
+		return data
+
+	def _drain(self):
+		out = []
+		while self.next_ns in self.pending:
+			ns = self.next_ns
+			out.append(self._deliver(ns, *self.pending.pop(ns)))
+		return out
+
+	def _skip_to(self, ns):
+		# Give up on frames before ns: deliver what we have, count the rest as gaps
+		out = []
+		while self.next_ns != ns:
+			if self.next_ns in self.pending:
+				out.append(self._deliver(self.next_ns, *self.pending.pop(self.next_ns)))
+			else:
+				self.gaps += 1
+				self.next_ns = (self.next_ns + 1) % MODULUS
+				if self.decompressor:
+					self.decompressor = None # The stream has a hole now
+					self.from_start = False
+		return out + self._drain()
+
+	def acknowledged(self, nr, t):
+		# N(R) from the other station; payloads released if it covers frames we missed
+		if self.va is None or (nr - self.va) % MODULUS > (self.vs - self.va) % MODULUS:
+			return () # Stale or out of window
+		while self.va != nr:
+			sent = self.sent_at.pop(self.va, None)
+			if sent is not None:
+				rtt = t - sent
+				self.rtt_count += 1
+				self.rtt_total += rtt
+				self.rtt_min = rtt if self.rtt_min is None else min(self.rtt_min, rtt)
+				self.rtt_max = rtt if self.rtt_max is None else max(self.rtt_max, rtt)
+			self.va = (self.va + 1) % MODULUS
+		if (nr - self.next_ns) % MODULUS <= (self.vs - self.next_ns) % MODULUS and nr != self.next_ns:
+			return self._skip_to(nr)
+		return ()
+
+	def stats(self, duration):
+		return {
+			'bytes': self.bytes,
+			'frames': self.frames,
+			'retries': self.retries,
+			'gaps': self.gaps,
+			'rej': self.rej,
+			'rnr': self.rnr,
+			'undecodable': self.undecodable,
+			'goodput': self.bytes / duration if duration > 0 else 0.0,
+			'rtt_avg': self.rtt_total / self.rtt_count if self.rtt_count else None,
+			'rtt_min': self.rtt_min,
+			'rtt_max': self.rtt_max,
+		}
+
+class MonitoredSession:
+	__slots__ = ('key', 'initiator', 'responder', 'state', 'directions', 'started', 'connected', 'last_heard',
+		'link_retries', 'resets', 'joined_late', 'flowing')
+
+	def __init__(self, key, initiator, responder, t, joined_late):
+		self.key = key
+		self.initiator = initiator # Address keys; the initiator sent the SABM (or the first frame we heard)
+		self.responder = responder
+		self.state = 'connected' if joined_late else 'connecting'
+		self.started = t
+		self.connected = t if joined_late else None
+		self.last_heard = t
+		self.link_retries = 0 # Repeated SABM/DISC
+		self.resets = 0
+		self.joined_late = joined_late
+		self.flowing = False # Any I-frame since the link was (re)established
+		self.directions = {initiator: Direction(not joined_late), responder: Direction(not joined_late)}
+
+	def restart(self):
+		self.flowing = False
+		for d in self.directions.values():
+			d.restart()
+
+	def __str__(self):
+		return f"{str_ax25_address_key(self.initiator)}<>{str_ax25_address_key(self.responder)}"
+
+	def stats(self, now=None):
+		duration = (now if now is not None else self.last_heard) - (self.connected or self.started)
+		return {
+			'session': str(self),
+			'state': self.state,
+			'joined_late': self.joined_late,
+			'duration': duration,
+			'link_retries': self.link_retries,
+			'resets': self.resets,
+			'directions': {str_ax25_address_key(k): d.stats(duration) for k, d in self.directions.items()},
+		}
+
+class SessionMonitor:
+	def __init__(self, max_sessions=1000, idle_timeout=600, dupe_window=5):
+		self.max_sessions = max_sessions
+		self.idle_timeout = idle_timeout
+		self.dupe_window = dupe_window # For digipeated copies of a frame we already heard
+		self.sessions = OrderedDict() # pair key -> MonitoredSession, least recently heard first
+		self.recent = {} # hash of dupe key -> (expiry, H bits first heard), in insertion (so expiry) order
+		self.last_expire = 0
+
+		self.on_open = lambda session:None
+		self.on_data = lambda session, source, data:None # source is the sender's address key
+		self.on_close = lambda session, reason:None
+
+		self.m_frames = CounterSet(REGISTRY, 'tncture_monitor_frames_total', 'Frames seen by the session monitor', 'kind')
+		self.m_closed = CounterSet(REGISTRY, 'tncture_monitor_sessions_closed_total', 'Monitored sessions ended, by reason', 'reason')
+		self.m_active = REGISTRY.gauge('tncture_monitor_sessions', 'Sessions being tracked')
+
+	def feed(self, frame, t=None):
+		# One raw AX.25 frame as heard on the channel; usable as a PortMux tap
+		if t is None:
+			t = time.time()
+		if t - self.last_expire >= 1:
+			self.expire(t)
+		if len(frame) < 15:
+			return
+		end = ax25_address_end(frame)
+		if end >= len(frame):
+			return
+		if not frame[13] & 1 and self._digipeated_copy(frame, end, t):
+			self.m_frames['copy'].inc()
+			return
+
+		source, dest = peek_ax25_addresses(frame)
+		control = frame[end]
+		key = (source, dest) if source < dest else (dest, source)
+		session = self.sessions.get(key)
+
+		if control & 0b11 == 0b11:
+			self._unnumbered(session, key, source, dest, control & ~0x10, t)
+			return
+
+		if session is None:
+			session = self._open(key, source, dest, t, joined_late=True)
+		else:
+			self.sessions.move_to_end(key)
+		session.last_heard = t
+		if session.state == 'connecting':
+			# Missed the UA but they're talking
+			session.state = 'connected'
+			session.connected = t
+
+		mine = session.directions[source]
+		theirs = session.directions[dest]
+		out = theirs.acknowledged(control >> 5, t)
+		if out:
+			self._emit(session, dest, out)
+		if control & 1 == 0:
+			self.m_frames['I'].inc()
+			session.flowing = True
+			pid = frame[end+1] if end + 1 < len(frame) else None
+			out = mine.information((control >> 1) & 0b111, pid, frame[end+2:], t)
+			if out:
+				self._emit(session, source, out)
+		else:
+			self.m_frames['S'].inc()
+			ss = (control >> 2) & 0b11
+			if ss == S_REJ:
+				theirs.rej += 1
+			elif ss == S_RNR:
+				theirs.rnr += 1
+
+	def _digipeated_copy(self, frame, end, t):
+		# A frame heard again with different H bits is the same transmission
+		# repeated by a digipeater. With the same H bits it's the sender (or the
+		# same digipeater) sending it again, which is a retransmission to count.
+		h = hash(dupe_key(frame, end))
+		repeated = bytes(frame[i] & 0x80 for i in range(20, end, 7))
+		seen = self.recent.pop(h, None)
+		if seen is not None and seen[0] > t:
+			first = seen[1]
+			self.recent[h] = (t + self.dupe_window, first) # Its digipeated copies follow
+			return repeated != first
+		self.recent[h] = (t + self.dupe_window, repeated)
+		return False
+
+	def _unnumbered(self, session, key, source, dest, u, t):
+		self.m_frames['U'].inc()
+		if u in (U_SABM, U_SABME):
+			if session is None:
+				self._open(key, source, dest, t)
+				return
+			self.sessions.move_to_end(key)
+			session.last_heard = t
+			if session.state == 'connecting' or not session.flowing:
+				session.link_retries += 1 # Includes a SABM resent because its UA got lost
+			else:
+				session.resets += 1
+			# Either way sequence numbers start again
+			session.state = 'connecting'
+			session.restart()
+			return
+
+		if session is None:
+			return # Stray UA/DM/DISC for something we aren't following
+		self.sessions.move_to_end(key)
+		session.last_heard = t
+		if u == U_UA:
+			if session.state == 'connecting':
+				session.state = 'connected'
+				session.connected = t
+			elif session.state == 'disconnecting':
+				self._close(session, 'disc')
+		elif u == U_DISC:
+			if session.state == 'disconnecting':
+				session.link_retries += 1
+			session.state = 'disconnecting'
+		elif u == U_DM:
+			self._close(session, 'dm')
+		elif u == U_FRMR:
+			self._close(session, 'frmr')
+
+	def _open(self, key, initiator, responder, t, joined_late=False):
+		if len(self.sessions) >= self.max_sessions:
+			_, oldest = self.sessions.popitem(last=False)
+			self._closed(oldest, 'evicted')
+		session = self.sessions[key] = MonitoredSession(key, initiator, responder, t, joined_late)
+		self.m_active.set(len(self.sessions))
+		self.on_open(session)
+		return session
+
+	def _close(self, session, reason):
+		del self.sessions[session.key]
+		self._closed(session, reason)
+
+	def _closed(self, session, reason):
+		session.state = 'closed'
+		self.m_closed[reason].inc()
+		self.m_active.set(len(self.sessions))
+		self.on_close(session, reason)
+
+	def _emit(self, session, source, payloads):
+		for data in payloads:
+			if data:
+				self.on_data(session, source, data)
+
+	def expire(self, now=None):
+		if now is None:
+			now = time.time()
+		self.last_expire = now
+		for h, (expiry, _) in list(self.recent.items()):
+			if expiry > now:
+				break
+			del self.recent[h]
+		while self.sessions:
+			session = next(iter(self.sessions.values()))
+			if now - session.last_heard < self.idle_timeout:
+				break
+			self._close(session, 'idle')
+
+	def close_all(self, reason='stopped'):
+		while self.sessions:
+			self._close(next(iter(self.sessions.values())), reason)
+
+	def pump(self, port):
+		# Feed everything waiting on a KISSPort/AGWPort
+		frame = port.recieve_data_frame()
+		while frame or port.pending():
+			if frame:
+				self.feed(frame)
+			frame = port.recieve_data_frame()
+
+def format_stats(stats):
+	lines = [f"{stats['session']} {stats['state']}, {stats['duration']:.1f}s"
+		+ (", joined late" if stats['joined_late'] else "")
+		+ f", {stats['link_retries']} link retries, {stats['resets']} resets"]
+	for call, d in stats['directions'].items():
+		rtt = f"{d['rtt_avg']:.2f}s ({d['rtt_min']:.2f}-{d['rtt_max']:.2f})" if d['rtt_avg'] is not None else "-"
+		lines.append(f"  from {call}: {d['bytes']} bytes in {d['frames']} I-frames, {d['goodput']:.1f} B/s, "
+			f"{d['retries']} retries, {d['gaps']} gaps, {d['rej']} REJ, {d['rnr']} RNR, RTT {rtt}")
+	return '\n'.join(lines)
+
+def print_monitor(monitor, show_data):
+	monitor.on_open = lambda s: print(f"[open] {s}" + (" (joined late)" if s.joined_late else ""))
+	monitor.on_close = lambda s, reason: print(f"[{reason}] " + format_stats(s.stats()))
+	if show_data:
+		def on_data(session, source, data):
+			for line in data.decode('ascii', 'replace').replace('\r', '\n').splitlines():
+				print(f"[{str_ax25_address_key(source)}] {line}")
+		monitor.on_data = on_data
+
+def main(argv):
+	if len(argv) < 2:
+		print("Usage: tncture.monitor.sessions live [HOST PORT] [--data]")
+		print("       tncture.monitor.sessions replay CAPTURE [--data]")
+		sys.exit(1)
+
+	show_data = '--data' in argv
+	args = [a for a in argv[1:] if a != '--data']
+	monitor = SessionMonitor()
+	print_monitor(monitor, show_data)
+
+	if args[0] == 'replay':
+		from .capture import CaptureReader
+		with CaptureReader(args[1]) as r:
+			for record in r:
+				monitor.feed(record.frame, record.timestamp)
+		monitor.close_all('end of capture')
+	elif args[0] == 'live':
+		from ..transport.kiss import TCPKISSConnection, KISSPort
+		from ..reactor import Reactor
+		port = KISSPort(TCPKISSConnection(args[1], int(args[2])) if len(args) > 2 else TCPKISSConnection('localhost', 8001), 0)
+		reactor = Reactor()
+		reactor.add_reader(port.transport, lambda: monitor.pump(port))
+
+		def expire():
+			monitor.expire() # Idle sessions go even if the channel is quiet
+			reactor.call_later(10, expire)
+		expire()
+		try:
+			reactor.run()
+		except KeyboardInterrupt:
+			monitor.close_all()
+
+if __name__ == '__main__':
+	main(sys.argv)
@@ -0,0 +1,71 @@
+from ..metrics import REGISTRY
+
+# Splices two connections so a user connected to the node can go onward to
+# another station. Everything is driven from the connections' own callbacks:
+# received payload is queued on the other side by reference, and a side whose
+# send queue backs up holds the far end off with RNR until it drains. An idle
+# bridge does no work at all. When one side goes away, whatever was relayed
+# to the other is still delivered before that one is disconnected too.
+
+class Bridge:
+	def __init__(self, a, b, high_water=None, low_water=None):
+		self.a = a
+		self.b = b
+		# Enough queued for a couple of frames either way before pushing back
+		self.high_water = high_water if high_water is not None else 4 * max(a.mtu, b.mtu)
+		self.low_water = low_water if low_water is not None else self.high_water // 2
+		self.open = True # Relaying both ways
+		self.closed = False # Callbacks handed back
+
+		self.m_bytes = REGISTRY.counter('tncture_bridge_bytes_total', 'Bytes relayed between bridged connections')
+		self.m_busy = REGISTRY.counter('tncture_bridge_busy_total', 'Times a bridge held a sender off with RNR')
+
+		for src, dst in ((a, b), (b, a)):
+			# Anything that arrived before the bridge existed goes across first
+			if src.stream_incoming:
+				dst.stream_outgoing += src.stream_incoming
+				src.stream_incoming = b''
+			src.on_data = lambda data, src=src, dst=dst: self._relay(src, dst, data)
+			dst.on_drain = lambda src=src, dst=dst: self._drained(src, dst)
+			src.on_disconnect = lambda src=src, dst=dst: self._closed(src, dst)
+
+	def _relay(self, src, dst, data):
+		dst.stream_outgoing += data
+		self.m_bytes.inc(len(data))
+		if len(dst.stream_outgoing) >= self.high_water and not src.busy:
+			self.m_busy.inc()
+			src.set_busy(True)
+
+	def _drained(self, src, dst):
+		if src.busy and len(dst.stream_outgoing) <= self.low_water:
+			src.set_busy(False)
+
+	def _closed(self, src, dst):
+		# One side went away; take the other down with it once it has sent
+		# (and had acknowledged) everything relayed to it
+		if dst.state == dst.States.DISCONNECTED:
+			self.close()
+			return
+		self.open = False
+		dst.on_data = lambda data:None # Nowhere to go now
+		dst.set_busy(False)
+		dst.on_drain = lambda: self._close_drained(dst)
+		dst.on_disconnect = self.close
+		self._close_drained(dst)
+
+	def _close_drained(self, dst):
+		if dst.drained():
+			self.close()
+			if dst.state == dst.States.CONNECTED:
+				dst.initiate_disconnection()
+
+	def close(self):
+		if self.closed:
+			return
+		self.open = False
+		self.closed = True
+		for conn in (self.a, self.b):
+			conn.on_data = None
+			conn.on_drain = lambda:None
+			conn.on_disconnect = lambda:None
+			conn.set_busy(False)
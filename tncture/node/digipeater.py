@@ -0,0 +1,142 @@
+import sys, time
+from ..ax25.frame import *
+from ..metrics import REGISTRY, CounterSet
+
+# Repeats frames whose next unrepeated digipeater is one of our aliases. Works
+# on the raw bytes: the address field is walked in place, the H bit patched and
+# the frame sent back out, with no parse or re-encode.
+
+H_BIT = 0x80
+KEY_MASK = bytes([0xff] * 6 + [0b00011110]) # Callsign + SSID of an address field
+
+class TokenBucket:
+	__slots__ = ('rate', 'burst', 'tokens', 'last')
+
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.last = time.monotonic()
+
+	def take(self, now):
+		self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+		if self.tokens >= 1:
+			self.tokens -= 1
+			return True
+		return False
+
+	def full(self, now):
+		return self.tokens + (now - self.last) * self.rate >= self.burst
+
+def next_hop(frame):
+	# Offset of the first repeater address without the H bit, or None
+	offset = 14
+	if frame[13] & 1:
+		return None # No digipeater path
+	while offset + 7 <= len(frame):
+		if not frame[offset+6] & H_BIT:
+			return offset
+		if frame[offset+6] & 1:
+			return None # Fully repeated
+		offset += 7
+	return None
+
+def dupe_key(frame, end):
+	# Dest, source, repeaters and payload with the H bits masked, so a copy heard
+	# back from another digipeater matches the one we sent
+	key = bytearray(frame)
+	for offset in range(6, end, 7):
+		key[offset] &= 0b01111111
+	return bytes(key)
+
+class Digipeater:
+	def __init__(self, port, aliases, dupe_window=30, alias_rate=(5, 10), path_rate=(1, 5)):
+		self.port = port
+		self.aliases = {encode_ax25_address_key(a): str(a) for a in aliases}
+		self.dupe_window = dupe_window
+		self.alias_rate = alias_rate # (frames/s, burst)
+		self.path_rate = path_rate
+		self.recent = {} # hash of dupe key -> expiry, in insertion (so expiry) order
+		self.alias_buckets = {key: TokenBucket(*alias_rate) for key in self.aliases}
+		self.path_buckets = {} # masked address field -> TokenBucket
+		self.last_expire = 0
+
+		labels = {'port': str(getattr(port, 'port', ''))}
+		self.m_repeated = CounterSet(REGISTRY, 'tncture_digi_repeated_total', 'Frames digipeated', 'alias', **labels)
+		self.m_dropped = CounterSet(REGISTRY, 'tncture_digi_dropped_total', 'Frames for us not digipeated', 'reason', **labels)
+
+	def handle(self, frame):
+		# Takes any received frame; returns True if it was repeated. Can be used
+		# directly as a PortMux tap.
+		hop = next_hop(frame)
+		if hop is None:
+			return False
+		alias_key = ax25_address_key(frame[hop:hop+7])
+		alias = self.aliases.get(alias_key)
+		if alias is None:
+			return False
+
+		now = time.monotonic()
+		if now - self.last_expire > 1:
+			self._expire(now)
+
+		end = ax25_address_end(frame)
+		key = hash(dupe_key(frame, end))
+		if key in self.recent:
+			self.m_dropped['duplicate'].inc()
+			return False
+
+		if not self.alias_buckets[alias_key].take(now):
+			self.m_dropped['alias_rate'].inc()
+			return False
+
+		path = bytes(b & m for b, m in zip(frame[7:end], KEY_MASK * ((end - 7) // 7)))
+		bucket = self.path_buckets.get(path)
+		if bucket is None:
+			bucket = self.path_buckets[path] = TokenBucket(*self.path_rate)
+		if not bucket.take(now):
+			self.m_dropped['path_rate'].inc()
+			return False
+
+		self.recent[key] = now + self.dupe_window
+
+		out = bytearray(frame)
+		out[hop+6] |= H_BIT
+		self.port.send_data_frame(bytes(out))
+		self.m_repeated[alias].inc()
+		return True
+
+	def _expire(self, now):
+		self.last_expire = now
+		for key, expiry in list(self.recent.items()):
+			if expiry > now:
+				break
+			del self.recent[key]
+		for path, bucket in list(self.path_buckets.items()):
+			if bucket.full(now):
+				del self.path_buckets[path]
+
+	def pump(self):
+		frame = self.port.recieve_data_frame()
+		while frame or self.port.pending():
+			if frame and len(frame) >= 15:
+				self.handle(frame)
+			frame = self.port.recieve_data_frame()
+
+def main(argv):
+	if len(argv) < 2:
+		print("Usage: tncture.node.digipeater MYCALL[-X] [ALIAS ...]")
+		sys.exit(1)
+
+	from ..transport.kiss import TCPKISSConnection, KISSPort
+	from ..reactor import Reactor
+	port = KISSPort(TCPKISSConnection('localhost', 8001), 0)
+	digi = Digipeater(port, [AX25Address.parse(a) for a in argv[1:]])
+	reactor = Reactor()
+	reactor.add_reader(port.transport, digi.pump)
+	print(f"[digi] Repeating for {', '.join(digi.aliases.values())}")
+	reactor.run()
+
+if __name__ == '__main__':
+	main(sys.argv)
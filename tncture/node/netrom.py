@@ -0,0 +1,242 @@
+from dataclasses import dataclass
+import struct, time
+from ..ax25.frame import *
+from ..metrics import REGISTRY
+
+# NET/ROM NODES broadcasts and the routing table they feed. A broadcast is a UI
+# frame to NODES with PID 0xCF: 0xFF, the sender's 6-character alias, then up
+# to 11 entries of (destination call, destination alias, best neighbour call,
+# quality).
+
+PID_NETROM = 0xCF
+NODES_SIGNATURE = 0xFF
+NODES_DEST = AX25Address('NODES', 0)
+NODES_DEST_KEY = encode_ax25_address_key(NODES_DEST)
+ENTRY = struct.Struct('7s6s7sB')
+ENTRIES_PER_FRAME = 11
+
+@dataclass
+class NodesEntry:
+	call: AX25Address
+	alias: str
+	neighbour: AX25Address
+	quality: int
+
+def _alias_bytes(alias):
+	return alias.upper().ljust(6)[:6].encode('ascii')
+
+def _call_bytes(address):
+	return encode_ax25_address(AX25DestinationAddress(address.callsign, address.ssid), False)
+
+def _key_address(key):
+	return AX25Address.parse(str_ax25_address_key(key))
+
+def _raw_entries(frame):
+	# (sender alias, [(call key, alias, neighbour key, quality)]) without building addresses
+	if frame.frametype != 'U' or frame.control.mmmmm != UFrameTypes.UI or list(frame.pid) != [PID_NETROM]:
+		return None
+	data = frame.data
+	if len(data) < 7 or data[0] != NODES_SIGNATURE:
+		return None
+	count = (len(data) - 7) // ENTRY.size
+	# Aliases are upper-cased here, as lookup() does with what it's asked for
+	return data[1:7].decode('ascii', 'replace').rstrip().upper(), [
+		(ax25_address_key(call), alias.decode('ascii', 'replace').rstrip().upper(), ax25_address_key(neighbour), quality)
+		for call, alias, neighbour, quality in ENTRY.iter_unpack(data[7:7+count*ENTRY.size])
+	]
+
+def parse_nodes_broadcast(frame):
+	# (sender alias, [NodesEntry]) for a NODES broadcast AX25Frame, else None
+	parsed = _raw_entries(frame)
+	if parsed is None:
+		return None
+	alias, entries = parsed
+	return alias, [NodesEntry(_key_address(c), a, _key_address(n), q) for c, a, n, q in entries]
+
+def encode_nodes_broadcast(mycall, alias, entries):
+	# AX25Frames carrying every entry, ENTRIES_PER_FRAME at a time
+	frames = []
+	for i in range(0, max(len(entries), 1), ENTRIES_PER_FRAME):
+		data = bytes([NODES_SIGNATURE]) + _alias_bytes(alias)
+		for e in entries[i:i+ENTRIES_PER_FRAME]:
+			data += ENTRY.pack(_call_bytes(e.call), _alias_bytes(e.alias), _call_bytes(e.neighbour), e.quality)
+		frames.append(AX25Frame(
+			AX25SourceAddress(mycall.callsign, mycall.ssid, c=0),
+			AX25DestinationAddress(NODES_DEST.callsign, NODES_DEST.ssid, c=1),
+			[], AX25UControl(UFrameTypes.UI, pf=0), [PID_NETROM], data
+		))
+	return frames
+
+class Neighbour:
+	__slots__ = ('key', 'call', 'port', 'quality', 'last_heard')
+
+	def __init__(self, key, call, port, quality):
+		self.key = key
+		self.call = call
+		self.port = port
+		self.quality = quality
+		self.last_heard = time.time()
+
+class Route:
+	__slots__ = ('neighbour', 'quality', 'obsolescence')
+
+	def __init__(self, neighbour, quality, obsolescence):
+		self.neighbour = neighbour
+		self.quality = quality
+		self.obsolescence = obsolescence
+
+class Destination:
+	__slots__ = ('key', 'call', 'alias', 'routes', 'best')
+
+	def __init__(self, key, call, alias):
+		self.key = key
+		self.call = call
+		self.alias = alias
+		self.routes = [] # At most RoutingTable.max_routes, any order
+		self.best = None
+
+	def choose_best(self):
+		self.best = max(self.routes, key=lambda r: r.quality, default=None)
+
+class RoutingTable:
+	# Each broadcast only touches the destinations it lists: their route via the
+	# sender is updated and best route rechosen among at most max_routes. Lookups
+	# by callsign key or alias are dict hits on the cached best route.
+	def __init__(self, mycall, alias, default_quality=192, min_quality=50,
+			obsolescence=6, min_obsolescence=4, max_routes=3, max_destinations=50000):
+		self.mycall = mycall
+		self.mykey = encode_ax25_address_key(mycall)
+		self.alias = alias
+		self.default_quality = default_quality # Port quality for neighbours we have no setting for
+		self.min_quality = min_quality
+		self.obsolescence = obsolescence # Broadcast intervals a route survives unrefreshed
+		self.min_obsolescence = min_obsolescence # Below this, stop advertising it
+		self.max_routes = max_routes
+		self.max_destinations = max_destinations
+		self.port_quality = {}
+
+		self.neighbours = {} # (key, port) -> Neighbour
+		self.destinations = {} # call key -> Destination
+		self.aliases = {} # alias -> Destination
+
+		self.m_updates = REGISTRY.counter('tncture_netrom_broadcasts_total', 'NODES broadcasts processed')
+		self.m_rejected = REGISTRY.counter('tncture_netrom_destinations_rejected_total', 'New destinations refused because the table is full')
+		self.m_destinations = REGISTRY.gauge('tncture_netrom_destinations', 'Destinations in the routing table')
+
+	def neighbour(self, call, port):
+		key = encode_ax25_address_key(call)
+		n = self.neighbours.get((key, port))
+		if n is None:
+			n = self.neighbours[(key, port)] = Neighbour(key, call, port, self.port_quality.get(port, self.default_quality))
+		return n
+
+	def _update(self, key, alias, neighbour, quality):
+		dest = self.destinations.get(key)
+		if dest is None:
+			if quality < self.min_quality:
+				return
+			if len(self.destinations) >= self.max_destinations:
+				self.m_rejected.inc()
+				return
+			dest = self.destinations[key] = Destination(key, _key_address(key), alias)
+		if alias and alias != dest.alias:
+			if self.aliases.get(dest.alias) is dest:
+				del self.aliases[dest.alias]
+			dest.alias = alias
+		if alias:
+			self.aliases[alias] = dest
+
+		for route in dest.routes:
+			if route.neighbour is neighbour:
+				route.quality = quality
+				route.obsolescence = self.obsolescence
+				break
+		else:
+			if quality < self.min_quality:
+				return
+			if len(dest.routes) >= self.max_routes:
+				worst = min(dest.routes, key=lambda r: r.quality)
+				if worst.quality >= quality:
+					return
+				dest.routes.remove(worst)
+			dest.routes.append(Route(neighbour, quality, self.obsolescence))
+
+		if quality < self.min_quality:
+			dest.routes = [r for r in dest.routes if r.quality >= self.min_quality]
+			if not dest.routes:
+				self._remove(dest)
+				return
+		dest.choose_best()
+
+	def _remove(self, dest):
+		del self.destinations[dest.key]
+		if self.aliases.get(dest.alias) is dest:
+			del self.aliases[dest.alias]
+
+	def update_from_broadcast(self, frame, port=0):
+		parsed = _raw_entries(frame)
+		if parsed is None:
+			return False
+		alias, entries = parsed
+		neighbour = self.neighbour(AX25Address(frame.source.callsign, frame.source.ssid), port)
+		neighbour.last_heard = time.time()
+
+		# The sender itself is reachable at the port quality
+		self._update(neighbour.key, alias, neighbour, neighbour.quality)
+		for key, dest_alias, via, quality in entries:
+			if key == self.mykey or via == self.mykey:
+				continue # Us, or a route that goes back through us
+			self._update(key, dest_alias, neighbour, quality * neighbour.quality // 256)
+		self.m_updates.inc()
+		self.m_destinations.set(len(self.destinations))
+		return True
+
+	def handle(self, raw, port=0):
+		# Raw-frame entry point, cheap enough for a PortMux tap: only NODES
+		# broadcasts get a full parse
+		if len(raw) < 16 or ax25_address_key(raw[0:7]) != NODES_DEST_KEY:
+			return False
+		end = ax25_address_end(raw)
+		if end + 1 >= len(raw) or raw[end+1] != PID_NETROM:
+			return False
+		frame = parse_ax25_frame(raw, 8)
+		return frame is not None and self.update_from_broadcast(frame, port)
+
+	def sweep(self):
+		# Once per broadcast interval: age every route, drop the ones that ran out
+		for dest in list(self.destinations.values()):
+			for route in dest.routes:
+				route.obsolescence -= 1
+			alive = [r for r in dest.routes if r.obsolescence > 0]
+			if len(alive) != len(dest.routes):
+				dest.routes = alive
+				dest.choose_best()
+				if not alive:
+					self._remove(dest)
+		self.m_destinations.set(len(self.destinations))
+
+	def lookup(self, dest):
+		# Next-hop Neighbour for a callsign, alias or address key, or None
+		if isinstance(dest, bytes):
+			d = self.destinations.get(dest)
+		elif isinstance(dest, AX25Address):
+			d = self.destinations.get(encode_ax25_address_key(dest))
+		else:
+			d = self.aliases.get(dest.upper())
+			if d is None and dest:
+				d = self.destinations.get(encode_ax25_address_key(dest.upper()))
+		if d is not None and d.best is not None:
+			return d.best.neighbour
+
+	def broadcast(self):
+		# Frames advertising every destination's best route
+		entries = [
+			NodesEntry(d.call, d.alias, d.best.neighbour.call, d.best.quality)
+			for d in self.destinations.values()
+			if d.best and d.best.obsolescence >= self.min_obsolescence and d.best.quality >= self.min_quality
+		]
+		return encode_nodes_broadcast(self.mycall, self.alias, entries)
+
+	def send_broadcast(self, port):
+		# One batched write of the whole table on a KISSPort bound to mycall
+		port.sendto_batch([(NODES_DEST, PID_NETROM, f.data) for f in self.broadcast()])
@@ -0,0 +1,281 @@
+from collections import deque
+from multiprocessing import shared_memory
+import multiprocessing, os, struct, sys, zlib
+from ..ax25.frame import *
+from ..transport.mux import PortMux
+from ..reactor import Reactor
+
+# One I/O process owns the TNC ports and fans received frames out to worker
+# processes, sharded by remote callsign so each connection lives in exactly one
+# worker. Frames travel over single-producer/single-consumer rings in shared
+# memory; a pipe byte is only written when the producer saw the ring empty,
+# so a busy ring costs no syscalls. Workers are forked, so they inherit the
+# rings' mappings and pipes directly.
+
+class ShmRing:
+	HEAD = 0 # Total bytes ever written, owned by the producer
+	TAIL = 8 # Total bytes ever read, owned by the consumer (byte 64, a separate cache line)
+	# HEAD and TAIL index the 8-byte counters view, not bytes
+	DATA = 128
+
+	def __init__(self, capacity=1 << 20):
+		self.capacity = capacity
+		self.shm = shared_memory.SharedMemory(create=True, size=self.DATA + capacity)
+		self.shm.buf[:self.DATA] = bytes(self.DATA)
+		self.buf = self.shm.buf
+		# Counters through a 'Q' view, so each is one aligned 8-byte load or
+		# store; struct.pack_into goes a byte at a time and can be read torn
+		self.counters = self.buf[:self.DATA].cast('Q')
+		self.doorbell_r, self.doorbell_w = os.pipe()
+		os.set_blocking(self.doorbell_r, False)
+		os.set_blocking(self.doorbell_w, False)
+
+	def _counters(self):
+		return self.counters[self.HEAD], self.counters[self.TAIL]
+
+	def _copy_in(self, offset, data):
+		pos = offset % self.capacity
+		first = min(len(data), self.capacity - pos)
+		self.buf[self.DATA+pos:self.DATA+pos+first] = data[:first]
+		if first < len(data):
+			self.buf[self.DATA:self.DATA+len(data)-first] = data[first:]
+
+	def _copy_out(self, offset, length):
+		pos = offset % self.capacity
+		first = min(length, self.capacity - pos)
+		data = bytes(self.buf[self.DATA+pos:self.DATA+pos+first])
+		if first < length:
+			data += bytes(self.buf[self.DATA:self.DATA+length-first])
+		return data
+
+	def put(self, data):
+		head, tail = self._counters()
+		n = 4 + len(data)
+		if head + n - tail > self.capacity:
+			return False # Full; the caller decides whether to drop
+		self._copy_in(head, struct.pack('<I', len(data)) + data)
+		self.counters[self.HEAD] = head + n
+		# tail was read before publishing; if the consumer drained everything
+		# since, it may have found the ring empty and gone to sleep, so look
+		# again. Ringing when it didn't is harmless: the doorbell coalesces.
+		if head == tail or self.counters[self.TAIL] >= head:
+			try:
+				os.write(self.doorbell_w, b'\x00')
+			except BlockingIOError:
+				pass
+		return True
+
+	def get(self):
+		head, tail = self._counters()
+		if head == tail:
+			return None
+		length, = struct.unpack('<I', self._copy_out(tail, 4))
+		data = self._copy_out(tail + 4, length)
+		self.counters[self.TAIL] = tail + 4 + length
+		return data
+
+	def __bool__(self):
+		head, tail = self._counters()
+		return head > tail
+
+	def fileno(self):
+		return self.doorbell_r
+
+	def drain_doorbell(self):
+		# Before reading the ring, never after: a put() that lands in between
+		# either gets read now or rings again
+		try:
+			while os.read(self.doorbell_r, 4096):
+				pass
+		except BlockingIOError:
+			pass
+
+	def close(self, unlink=False):
+		self.counters.release()
+		self.counters = self.buf = None
+		self.shm.close()
+		if unlink:
+			self.shm.unlink()
+
+def read_ring(ring):
+	# Everything in the ring, checking head again after the doorbell is
+	# drained so nothing is left behind when the consumer goes back to sleep
+	while True:
+		ring.drain_doorbell()
+		msg = ring.get()
+		while msg is not None:
+			yield msg
+			msg = ring.get()
+		if not ring:
+			return
+
+def shard_for(frame, workers):
+	# Source address, so every frame from one remote station lands in the same worker
+	return zlib.crc32(ax25_address_key(frame[7:14])) % workers
+
+def echo_application(conn):
+	if conn.stream_incoming:
+		conn.stream_outgoing += conn.stream_incoming
+		conn.stream_incoming = b''
+
+class ShardPort:
+	# Worker side of one radio port: frames arrive from the I/O process's ring
+	def __init__(self, worker, index):
+		self.worker = worker
+		self.index = index
+		self.rx_frames = deque()
+		self.on_tx = lambda f:None
+		self.on_rx = lambda f:None
+
+	@property
+	def transport(self):
+		return self.worker
+
+	def send_data_frame(self, frame):
+		self.on_tx(frame)
+		while not self.worker.out_ring.put(bytes([self.index]) + frame):
+			self.worker.out_ring_full()
+
+	def pending(self):
+		return bool(self.rx_frames)
+
+	def recieve_data_frame(self):
+		# Filled by ShardWorker.pump when the ring's doorbell rings
+		if self.rx_frames:
+			frame = self.rx_frames.popleft()
+			self.on_rx(frame)
+			return frame
+
+class ShardWorker:
+	def __init__(self, in_ring, out_ring, ports, mycall, application):
+		self.in_ring = in_ring
+		self.out_ring = out_ring
+		self.reactor = Reactor()
+		self.application = application
+		self.connections = []
+		self.ports = [ShardPort(self, i) for i in range(ports)]
+		self.muxes = [PortMux(p) for p in self.ports]
+		for mux in self.muxes:
+			mux.listen(mycall, self.on_connection)
+		self.reactor.add_reader(self.in_ring, self.pump)
+		self.reactor.after_poll.append(self.after_poll)
+
+	def fileno(self):
+		return self.in_ring.fileno()
+
+	def pump(self):
+		for msg in read_ring(self.in_ring):
+			self.ports[msg[0]].rx_frames.append(msg[1:])
+		for mux in self.muxes:
+			mux.pump()
+
+	def out_ring_full(self):
+		# The I/O process is behind; give it the CPU rather than dropping our own frames
+		os.sched_yield()
+
+	def on_connection(self, conn):
+		self.connections.append(conn)
+		self.reactor.sessions.append(conn)
+
+	def after_poll(self):
+		closed = []
+		for conn in self.connections:
+			self.application(conn)
+			if conn.state == conn.States.DISCONNECTED:
+				closed.append(conn)
+		for conn in closed:
+			self.connections.remove(conn)
+			self.reactor.remove_session(conn)
+			conn.port.close()
+
+	def run(self):
+		self.reactor.run()
+
+def worker_main(in_ring, out_ring, ports, mycall, application):
+	ShardWorker(in_ring, out_ring, ports, mycall, application).run()
+
+class ShardedNode:
+	def __init__(self, ports, mycall, workers=os.cpu_count(), application=echo_application, ring_size=1 << 20):
+		self.ports = ports
+		self.mycall = mycall
+		self.workers = workers
+		self.application = application
+		self.ring_size = ring_size
+		self.in_rings = []
+		self.out_rings = []
+		self.processes = []
+		self.dropped = 0
+		self.reactor = Reactor()
+
+	def start(self):
+		ctx = multiprocessing.get_context('fork')
+		for i in range(self.workers):
+			in_ring = ShmRing(self.ring_size)
+			out_ring = ShmRing(self.ring_size)
+			p = ctx.Process(target=worker_main, daemon=True, args=(
+				in_ring, out_ring, len(self.ports), self.mycall, self.application))
+			p.start()
+			self.in_rings.append(in_ring)
+			self.out_rings.append(out_ring)
+			self.processes.append(p)
+			self.reactor.add_reader(out_ring, lambda ring=out_ring: self.transmit(ring))
+
+		# One reader per transport: the reactor keeps a single callback per
+		# fileobj, and ports on one TNC connection share its socket
+		by_transport = {}
+		for i, port in enumerate(self.ports):
+			by_transport.setdefault(port.transport, []).append((i, port))
+		for transport, ports in by_transport.items():
+			self.reactor.add_reader(transport, lambda ports=ports: self.receive(ports))
+
+	def receive(self, ports):
+		for index, port in ports:
+			frame = port.recieve_data_frame()
+			while frame or port.pending(): # None can also mean a dropped echo
+				if frame and len(frame) >= 15:
+					if not self.in_rings[shard_for(frame, self.workers)].put(bytes([index]) + frame):
+						self.dropped += 1 # AX.25 will retransmit
+				frame = port.recieve_data_frame()
+
+	def transmit(self, ring):
+		for msg in read_ring(ring):
+			self.ports[msg[0]].send_data_frame(msg[1:])
+
+	def run(self):
+		self.start()
+		try:
+			self.reactor.run()
+		finally:
+			self.stop()
+
+	def stop(self):
+		for p in self.processes:
+			p.terminate()
+			p.join()
+		for ring in self.in_rings + self.out_rings:
+			ring.close(unlink=True)
+		self.processes = []
+
+def main(argv):
+	if len(argv) < 2:
+		print("Usage: tncture.node.shard MYCALL[-X] [--workers N] [--bitrate BPS] [--duty-cycle FRACTION]")
+		sys.exit(1)
+
+	from ..transport.kiss import TCPKISSConnection, KISSPort
+	def option(name, default, type_):
+		return type_(argv[argv.index(name) + 1]) if name in argv else default
+	workers = option('--workers', os.cpu_count(), int)
+	port = KISSPort(TCPKISSConnection('localhost', 8001), 0)
+	scheduler = None
+	if '--bitrate' in argv or '--duty-cycle' in argv:
+		# Every worker's frames go through here, so this is where airtime is shared out
+		from ..transport.scheduler import TxScheduler
+		port = scheduler = TxScheduler(port, option('--bitrate', 1200, int), duty_cycle=option('--duty-cycle', 1.0, float))
+	print(f"[node] {argv[1]} echo node, {workers} workers")
+	node = ShardedNode([port], AX25Address.parse(argv[1]), workers)
+	if scheduler:
+		scheduler.reactor = node.reactor # To send held frames when they're due
+	node.run()
+
+if __name__ == '__main__':
+	main(sys.argv)
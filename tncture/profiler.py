@@ -0,0 +1,139 @@
+from collections import Counter
+import os, signal, sys, threading, time
+
+# Statistical stack sampler. A background thread looks at every other
+# thread's current frame every `interval` seconds and counts the stacks; the
+# threads being profiled do no extra work. Stacks are kept as tuples of code
+# objects and only turned into text when written out, in the collapsed format
+# flamegraph.pl, speedscope and inferno read:
+#
+#	thread:MainThread;run (reactor.py:144);run_once (reactor.py:121);... 37
+#
+# Toggle it from outside with `kill -USR2 PID` after install_signal_toggle(),
+# or from the TUI with ctrl+o. Per-call timings are in the metrics histograms
+# (tncture_abm_poll_seconds, tncture_transport_recv_seconds, ...).
+
+class StackSampler:
+	def __init__(self, interval=0.005, max_depth=128):
+		self.interval = interval
+		self.max_depth = max_depth
+		self.stacks = Counter() # (thread id, code, code, ...) outermost first -> samples
+		self.thread_names = {}
+		self.samples = 0
+		self.started = None
+		self.thread = None
+		self.stopping = threading.Event()
+
+	@property
+	def running(self):
+		return self.thread is not None
+
+	def start(self):
+		if self.running:
+			return
+		self.stopping.clear()
+		self.started = time.time()
+		self.thread = threading.Thread(target=self._run, name='tncture-sampler', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		if not self.running:
+			return
+		self.stopping.set()
+		if self.thread is not threading.current_thread():
+			self.thread.join()
+		self.thread = None
+
+	def _run(self):
+		me = threading.get_ident()
+		while not self.stopping.wait(self.interval):
+			self.sample(skip=me)
+
+	def sample(self, skip=None):
+		for ident, frame in sys._current_frames().items():
+			if ident == skip:
+				continue
+			codes = []
+			while frame is not None and len(codes) < self.max_depth:
+				codes.append(frame.f_code)
+				frame = frame.f_back
+			codes.append(ident)
+			codes.reverse()
+			self.stacks[tuple(codes)] += 1
+			if ident not in self.thread_names:
+				self.thread_names.update((t.ident, t.name) for t in threading.enumerate())
+		self.samples += 1
+
+	def clear(self):
+		self.stacks.clear()
+		self.samples = 0
+
+	@staticmethod
+	def _label(code):
+		return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+	def collapsed(self):
+		labels = {}
+		lines = []
+		for stack, n in self.stacks.most_common():
+			ident, *codes = stack
+			parts = [f"thread:{self.thread_names.get(ident, ident)}"]
+			for code in codes:
+				label = labels.get(code)
+				if label is None:
+					label = labels[code] = self._label(code).replace(';', ':')
+				parts.append(label)
+			lines.append(f"{';'.join(parts)} {n}")
+		return '\n'.join(lines) + '\n' if lines else ''
+
+	def write(self, path):
+		with open(path, 'w') as f:
+			f.write(self.collapsed())
+		return path
+
+SAMPLER = StackSampler()
+
+def toggle_sampler(path=None):
+	# Start sampling, or stop and write what was collected. Returns the path
+	# written, or None if it just started.
+	if not SAMPLER.running:
+		SAMPLER.clear()
+		SAMPLER.start()
+		return None
+	SAMPLER.stop()
+	path = path or f"tncture-profile-{os.getpid()}-{int(SAMPLER.started)}.folded"
+	return SAMPLER.write(path)
+
+def install_signal_toggle(signum=signal.SIGUSR2, on_toggle=lambda path:None):
+	# on_toggle gets the path written, or None when sampling starts
+	signal.signal(signum, lambda *a: on_toggle(toggle_sampler()))
+
+def main(argv):
+	# Profile another module's main(): tncture.profiler [--interval=S] [--out=PATH] MODULE [ARGS ...]
+	from importlib import import_module
+
+	options = [a for a in argv[1:] if a.startswith('--')]
+	args = argv[1 + len(options):]
+	if not args:
+		print("Usage: tncture.profiler [--interval=SECONDS] [--out=PATH] MODULE [ARGS ...]")
+		sys.exit(1)
+	path = None
+	for option in options:
+		name, _, value = option.partition('=')
+		if name == '--interval':
+			SAMPLER.interval = float(value)
+		elif name == '--out':
+			path = value
+
+	SAMPLER.start()
+	try:
+		return import_module(args[0]).main(args)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		SAMPLER.stop()
+		path = SAMPLER.write(path or f"tncture-profile-{os.getpid()}.folded")
+		print(f"[profiler] {SAMPLER.samples} samples written to {path}", file=sys.stderr)
+
+if __name__ == '__main__':
+	main(sys.argv)
@@ -0,0 +1,177 @@
+from collections import deque
+import heapq, itertools, selectors, socket, time
+
+# Timers and session deadlines share time.time() with abm.Timer
+TIMER_SLACK = 0.001 # Timer.expired is strict, so wake just after the deadline
+
+class TimerHandle:
+	__slots__ = ('deadline', 'callback', 'cancelled')
+
+	def __init__(self, deadline, callback):
+		self.deadline = deadline
+		self.callback = callback
+		self.cancelled = False
+
+	def cancel(self):
+		self.cancelled = True
+
+class Reactor:
+	def __init__(self):
+		self.selector = selectors.DefaultSelector()
+		self.timers = [] # heap of (deadline, seq, TimerHandle)
+		self.timer_seq = itertools.count()
+		self.ready = deque()
+		self.sessions = []
+		self.after_poll = [] # Called after every round of session polls
+		self.streams = {} # Reconnecting transport -> [callback, registered fd, link generation, events]
+		self.running = False
+
+		# Lets other threads interrupt select() after call_soon_threadsafe
+		self.wakeup_r, self.wakeup_w = socket.socketpair()
+		self.wakeup_r.setblocking(0)
+		self.wakeup_w.setblocking(0)
+		self.add_reader(self.wakeup_r, self._drain_wakeup)
+
+	def add_reader(self, fileobj, callback):
+		if hasattr(fileobj, 'link_generation'):
+			# Reconnecting transport: its socket changes, so register whichever fd
+			# it has now and follow it in _follow_streams()
+			self.streams[fileobj] = [callback, None, None, 0]
+			self._follow_streams()
+			return
+		self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+	def remove_reader(self, fileobj):
+		entry = self.streams.pop(fileobj, None)
+		if entry is None:
+			self.selector.unregister(fileobj)
+		elif entry[1] is not None:
+			self.selector.unregister(entry[1])
+
+	def add_transport(self, conn):
+		if not hasattr(conn, 'fileno') or conn in self.streams:
+			return
+		if conn not in [k.fileobj for k in self.selector.get_map().values()]:
+			self.add_reader(conn, conn.pump)
+
+	def _follow_streams(self):
+		for stream, entry in self.streams.items():
+			callback, fd, generation, events = entry
+			current = stream.fileno() if stream.link_up else None
+			# Also wait for room in the socket while it has writes buffered
+			wanted = selectors.EVENT_READ
+			if current is not None and stream.wants_write():
+				wanted |= selectors.EVENT_WRITE
+			if current == fd and stream.link_generation == generation:
+				if current is not None and wanted != events:
+					self.selector.modify(current, wanted, callback)
+					entry[3] = wanted
+				continue
+			if fd is not None:
+				try:
+					self.selector.unregister(fd) # Usually already closed
+				except KeyError:
+					pass
+			if current is not None:
+				self.selector.register(current, wanted, callback)
+			entry[1], entry[2], entry[3] = current, stream.link_generation, wanted
+
+	def _writable(self, fd):
+		for stream, entry in self.streams.items():
+			if entry[1] == fd:
+				stream.flush()
+				return
+
+	def add_session(self, session):
+		self.sessions.append(session)
+		self.add_transport(session.transport)
+		self.call_soon(lambda: None) # Make sure it gets its first poll
+
+	def remove_session(self, session):
+		self.sessions.remove(session)
+
+	def call_at(self, deadline, callback):
+		handle = TimerHandle(deadline, callback)
+		heapq.heappush(self.timers, (deadline, next(self.timer_seq), handle))
+		return handle
+
+	def call_later(self, delay, callback):
+		return self.call_at(time.time() + delay, callback)
+
+	def call_soon(self, callback):
+		self.ready.append(callback)
+
+	def call_soon_threadsafe(self, callback):
+		self.ready.append(callback)
+		try:
+			self.wakeup_w.send(b'\x00')
+		except BlockingIOError:
+			pass # Already signalled
+
+	def _drain_wakeup(self):
+		try:
+			while self.wakeup_r.recv(4096):
+				pass
+		except BlockingIOError:
+			pass
+
+	def poll_sessions(self):
+		for session in list(self.sessions):
+			session.poll()
+			while session.pending():
+				session.poll()
+		for callback in list(self.after_poll):
+			callback()
+
+	def next_deadline(self):
+		while self.timers and self.timers[0][2].cancelled:
+			heapq.heappop(self.timers)
+		deadlines = [s.next_deadline() for s in self.sessions]
+		deadlines += [stream.next_deadline() for stream in self.streams] # Reconnection attempts
+		if self.timers:
+			deadlines.append(self.timers[0][0])
+		return min((d for d in deadlines if d is not None), default=None)
+
+	def run_once(self, timeout=None):
+		self._follow_streams()
+		if self.ready:
+			timeout = 0
+		else:
+			deadline = self.next_deadline()
+			if deadline is not None:
+				wait = max(0, deadline - time.time() + TIMER_SLACK)
+				timeout = wait if timeout is None else min(timeout, wait)
+
+		for key, mask in self.selector.select(timeout):
+			if mask & selectors.EVENT_WRITE:
+				self._writable(key.fd)
+			if mask & selectors.EVENT_READ:
+				key.data()
+
+		now = time.time()
+		for stream, (callback, _, _, _) in list(self.streams.items()):
+			if not stream.link_up and stream.next_deadline() <= now:
+				callback() # Down; reading it retries the connection
+
+		while self.timers and self.timers[0][0] <= now:
+			_, _, handle = heapq.heappop(self.timers)
+			if not handle.cancelled:
+				self.ready.append(handle.callback)
+
+		while self.ready:
+			self.ready.popleft()()
+
+		self.poll_sessions()
+
+	def run(self):
+		self.running = True
+		while self.running:
+			self.run_once()
+
+	def stop(self):
+		self.running = False
+
+	def close(self):
+		self.selector.close()
+		self.wakeup_r.close()
+		self.wakeup_w.close()
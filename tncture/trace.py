@@ -0,0 +1,208 @@
+from array import array
+from enum import IntEnum
+import struct, sys, time
+from .ax25.frame import *
+
+# Fixed-size flight recorder for protocol events. Recording stores a timestamp, an
+# event code and up to four small integers into preallocated arrays; formatting
+# into messages only happens when the ring is decoded.
+
+class TraceEvents(IntEnum):
+	SEND = 1
+	RECV = 2
+	FAULT_INJECT = 3
+	DISC_WHILE_DISCONNECTED = 4
+	FRAME_WHILE_DISCONNECTED = 5
+	UA_CONNECTED = 6
+	DM_DISCONNECTED = 7
+	UA_DISCONNECTED = 8
+	DISC_DISCONNECTED = 9
+	ACCEPT_I = 10
+	OUT_OF_ORDER_REJ = 11
+	OUT_OF_ORDER_IGNORED = 12
+	RR_POLL = 13
+	RR_ACK = 14
+	RR_PAST = 15
+	REJ_RESEND = 16
+	REJ_IGNORED = 17
+	TX_I = 18
+	TX_BLOCKED = 19
+	TX_SABM = 20
+	RESEND_I = 21
+	KEEPALIVE = 22
+	TX_DISC = 23
+	DELAYED_RR = 24
+	AGW_CONNECT = 25
+	AGW_CONNECTED = 26
+	AGW_DISCONNECTED = 27
+	AGW_DATA_RX = 28
+	AGW_DATA_TX = 29
+	AGW_OUTSTANDING = 30
+	SABM_ACCEPTED = 31
+	SABM_RESET = 32
+	BUSY_SET = 33
+	BUSY_CLEAR = 34
+	BUSY_DISCARD = 35
+	RNR_RX = 36
+	PEER_READY = 37
+	XID_SENT = 38
+	XID_RECEIVED = 39
+	LINK_DOWN = 40
+	LINK_UP = 41
+
+# Frame types as small integers: 0 = I, then S types, then U types
+FRAME_TYPES = ['I'] + [t.name for t in SFrameTypes] + [t.name for t in UFrameTypes]
+FRAME_TYPE_CODES = {name: i for i, name in enumerate(FRAME_TYPES)}
+
+def frame_args(frame):
+	# (type, N(S) << 8 | N(R), PF | C << 1, data length)
+	c = frame.control
+	ns = getattr(c, 'ns', 0)
+	nr = getattr(c, 'nr', 0)
+	return FRAME_TYPE_CODES[frame.typename], (ns << 8) | nr, int(c.pf) | (int(frame.dest.c) << 1), len(frame.data)
+
+def str_frame_args(t, seq, flags, length):
+	name = FRAME_TYPES[t]
+	fields = [name]
+	if name == 'I':
+		fields.append(f"N(S)={seq >> 8}")
+	if name == 'I' or t < 1 + len(SFrameTypes):
+		fields.append(f"N(R)={seq & 0xff}")
+	fields.append(f"PF={flags & 1}")
+	fields.append("cmd" if flags & 2 else "rsp")
+	if length:
+		fields.append(f"{length} bytes")
+	return ' '.join(fields)
+
+MESSAGES = {
+	TraceEvents.SEND: lambda *a: "AX25ConnectedModeConnection: send: " + str_frame_args(*a),
+	TraceEvents.RECV: lambda *a: "AX25ConnectedModeConnection: recv: " + str_frame_args(*a),
+	TraceEvents.FAULT_INJECT: lambda *a: "FAULT-INJECT NO RX",
+	TraceEvents.DISC_WHILE_DISCONNECTED: lambda *a: "Got DISC while DISCONNECTED, send UA again",
+	TraceEvents.FRAME_WHILE_DISCONNECTED: lambda *a: "??? frame while DISCONNECTED",
+	TraceEvents.UA_CONNECTED: lambda *a: "Got UA, going CONNECTING -> CONNECTED",
+	TraceEvents.DM_DISCONNECTED: lambda *a: "Got DM, going CONNECTING -> DISCONNECTED",
+	TraceEvents.UA_DISCONNECTED: lambda *a: "Got UA, going DISCONNECTING -> DISCONNECTED",
+	TraceEvents.DISC_DISCONNECTED: lambda *a: "Got DISC, going CONNECTED -> DISCONNECTED",
+	TraceEvents.ACCEPT_I: lambda ns, length, *a: f"Accept I frame: N(S)={ns}, {length} bytes",
+	TraceEvents.OUT_OF_ORDER_REJ: lambda ns, vr, *a: f"Out of order I-frame N(S)={ns}, V(R)={vr}, REJ",
+	TraceEvents.OUT_OF_ORDER_IGNORED: lambda ns, vr, *a: f"Got out of order I-frame N(S)={ns}, V(R)={vr} with PF=0, ignoring for now",
+	TraceEvents.RR_POLL: lambda *a: "Receive polling acknowledgement, reply",
+	TraceEvents.RR_ACK: lambda *a: "Receive normal acknowledgement",
+	TraceEvents.RR_PAST: lambda nr, vs, *a: f"Recieved ACK for past frame: N(R)={nr}, V(S)={vs}",
+	TraceEvents.REJ_RESEND: lambda *a: "REJ for pending frame, resend",
+	TraceEvents.REJ_IGNORED: lambda *a: "REJ for ACKed frame, ignore",
+	TraceEvents.TX_I: lambda ns, length, *a: f"TX frame N(S)={ns}, {length} bytes",
+	TraceEvents.TX_BLOCKED: lambda *a: "Have outstanding data, can't TX",
+	TraceEvents.TX_SABM: lambda *a: "Transmit SABM",
+	TraceEvents.RESEND_I: lambda ns, *a: f"Resend I-frame N(S)={ns}",
+	TraceEvents.KEEPALIVE: lambda *a: "Send keep-alive",
+	TraceEvents.TX_DISC: lambda *a: "Transmit DISC",
+	TraceEvents.DELAYED_RR: lambda *a: "Send delayed RR",
+	TraceEvents.SABM_ACCEPTED: lambda *a: "Got SABM, going DISCONNECTED -> CONNECTED",
+	TraceEvents.SABM_RESET: lambda *a: "Got SABM while CONNECTED, reset link",
+	TraceEvents.BUSY_SET: lambda *a: "Receiver busy, send RNR",
+	TraceEvents.BUSY_CLEAR: lambda *a: "Receiver ready, send RR",
+	TraceEvents.BUSY_DISCARD: lambda ns, *a: f"Busy, discard I-frame N(S)={ns}",
+	TraceEvents.RNR_RX: lambda nr, *a: f"Got RNR N(R)={nr}, hold I-frames",
+	TraceEvents.PEER_READY: lambda *a: "Got RR after RNR, resume sending",
+	TraceEvents.XID_SENT: lambda cmd, offer, *a: f"Send XID {'cmd' if cmd else 'rsp'}" + (", offering compression" if offer else ""),
+	TraceEvents.XID_RECEIVED: lambda cmd, agreed, *a: f"Got XID {'cmd' if cmd else 'rsp'}, compression {'on' if agreed else 'off'}",
+	TraceEvents.LINK_DOWN: lambda *a: "Link to the TNC down, timers paused",
+	TraceEvents.LINK_UP: lambda *a: "Link to the TNC back, timers resumed",
+	TraceEvents.AGW_CONNECT: lambda via, *a: f"AGW: request connect ({via} digipeaters)",
+	TraceEvents.AGW_CONNECTED: lambda *a: "AGW: connected, going CONNECTING -> CONNECTED",
+	TraceEvents.AGW_DISCONNECTED: lambda *a: "AGW: disconnected by TNC, going DISCONNECTED",
+	TraceEvents.AGW_DATA_RX: lambda length, *a: f"AGW: recv {length} bytes",
+	TraceEvents.AGW_DATA_TX: lambda length, *a: f"AGW: send {length} bytes",
+	TraceEvents.AGW_OUTSTANDING: lambda count, *a: f"AGW: {count} frames outstanding",
+}
+
+# Dumps are little-endian with fixed-width fields (times 'd', codes 'H', args
+# 'q'), so they can be read on another machine
+DUMP_MAGIC = b'TNCTRC\x00\x02'
+DUMP_HEADER = struct.Struct('<8sIQ') # magic, capacity, events recorded
+
+# Every connection has one, so the default is a few hundred events (about
+# 10 KB); sessions whose trace gets dumped ask for more
+DEFAULT_CAPACITY = 256
+DUMP_CAPACITY = 4096
+
+class TraceRing:
+	ARGS = 4
+
+	def __init__(self, capacity=DEFAULT_CAPACITY):
+		self.capacity = capacity
+		self.times = array('d', bytes(8 * capacity))
+		self.codes = array('H', bytes(2 * capacity))
+		self.args = array('q', bytes(8 * self.ARGS * capacity))
+		self.seq = 0 # Total events ever recorded; the next slot is seq % capacity
+
+	def record(self, code, a=0, b=0, c=0, d=0):
+		i = self.seq % self.capacity
+		self.times[i] = time.monotonic()
+		self.codes[i] = code
+		j = i * 4
+		args = self.args
+		args[j] = a
+		args[j+1] = b
+		args[j+2] = c
+		args[j+3] = d
+		self.seq += 1
+
+	def events(self, since=0):
+		# (seq, timestamp, code, args) for every retained event with seq >= since
+		start = max(since, self.seq - self.capacity)
+		for seq in range(start, self.seq):
+			i = seq % self.capacity
+			yield seq, self.times[i], self.codes[i], tuple(self.args[i*4:i*4+4])
+
+	def decode(self, since=0):
+		for seq, t, code, args in self.events(since):
+			fmt = MESSAGES.get(code)
+			yield seq, t, fmt(*args) if fmt else f"Unknown trace event {code} {args}"
+
+	def dump(self, path):
+		with open(path, 'wb') as f:
+			f.write(DUMP_HEADER.pack(DUMP_MAGIC, self.capacity, self.seq))
+			for a in (self.times, self.codes, self.args):
+				if sys.byteorder == 'big':
+					a = array(a.typecode, a)
+					a.byteswap()
+				f.write(a.tobytes())
+
+	@classmethod
+	def load(cls, path):
+		with open(path, 'rb') as f:
+			header = f.read(DUMP_HEADER.size)
+			if len(header) < DUMP_HEADER.size or header[:len(DUMP_MAGIC)] != DUMP_MAGIC:
+				raise ValueError(f"{path} is not a tncture trace dump")
+			_, capacity, seq = DUMP_HEADER.unpack(header)
+			ring = cls(capacity)
+			ring.seq = seq
+			ring.times = array('d', f.read(8 * capacity))
+			ring.codes = array('H', f.read(2 * capacity))
+			ring.args = array('q', f.read())
+			if sys.byteorder == 'big':
+				for a in (ring.times, ring.codes, ring.args):
+					a.byteswap()
+		return ring
+
+def main(argv):
+	if len(argv) < 2:
+		print("Usage: tncture.trace DUMPFILE")
+		sys.exit(1)
+
+	try:
+		ring = TraceRing.load(argv[1])
+	except ValueError as e:
+		print(e)
+		sys.exit(1)
+	t0 = None
+	for seq, t, message in ring.decode():
+		if t0 is None:
+			t0 = t
+		print(f"{seq:8d} {t-t0:10.3f} {message}")
+
+if __name__ == '__main__':
+	main(sys.argv)
@@ -1,6 +1,9 @@
 from dataclasses import dataclass
 from enum import Enum
-import struct, socket, time
+import struct, socket, select, time
+from collections import deque
+from ..metrics import REGISTRY
+from .reconnect import ReconnectingStream
 
 @dataclass
 class RawAGWFrame:
@@ -32,6 +35,8 @@ class RawAGWFrame:
 		assert len(data) == datalen
 		r = cls(*fields, data)
 		r.datakind = chr(r.datakind)
+		r.callfrom = r.callfrom.rstrip(b'\x00').decode('ascii', 'replace')
+		r.callto = r.callto.rstrip(b'\x00').decode('ascii', 'replace')
 		return r
 
 	@classmethod
@@ -133,6 +138,13 @@ class AGWReq_EnableMonitoring(AGWReqFrame, datakind='m'):
 class AGWReq_EnableRawMonitoring(AGWReqFrame, datakind='k'):
 	pass
 
+@dataclass
+class AGWReq_RawFrame(AGWReqFrame, datakind='K'):
+	frame: bytes
+
+	def mod_raw(self, raw):
+		raw.data = b'\x00' + self.frame # KISS command byte: data frame, port 0
+
 @dataclass
 class AGWResp_MonitoredRawFrame(AGWRespFrame, datakind='K'):
 	flag_port: int
@@ -192,50 +204,335 @@ class AGWResp_MonitoredGPIO(AGWRespFrame, datakind='1'):
 	def parse_members(cls, raw):
 		return (GPIOSignal(raw.data[0]), bool(raw.data[1]))
 
-class AGWTCPConnection:
-	def __init__(self, address, port):
-		self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.s.connect((address, port))
-		self.s.setblocking(0)
+@dataclass
+class AGWReq_RegisterCallsign(AGWReqFrame, datakind='X'):
+	callsign: str
+
+	def mod_raw(self, raw):
+		raw.callfrom = self.callsign
+
+@dataclass
+class AGWResp_RegisterCallsign(AGWRespFrame, datakind='X'):
+	callsign: str
+	success: bool
+
+	@classmethod
+	def parse_members(cls, raw):
+		return (raw.callfrom, bool(raw.data[0]))
+
+@dataclass
+class AGWReq_Connect(AGWReqFrame, datakind='C'):
+	callfrom: str
+	callto: str
+
+	def mod_raw(self, raw):
+		raw.callfrom = self.callfrom
+		raw.callto = self.callto
+
+@dataclass
+class AGWReq_ConnectVia(AGWReqFrame, datakind='v'):
+	callfrom: str
+	callto: str
+	via: list[str]
 
+	def mod_raw(self, raw):
+		raw.callfrom = self.callfrom
+		raw.callto = self.callto
+		raw.data = bytes([len(self.via)]) + b''.join(
+			struct.pack('10s', v.encode('ascii')) for v in self.via)
+
+# In connected mode responses, callfrom is the remote station and callto is us
+
+@dataclass
+class AGWResp_Connected(AGWRespFrame, datakind='C'):
+	callfrom: str
+	callto: str
+	message: bytes
+
+	@classmethod
+	def parse_members(cls, raw):
+		return (raw.callfrom, raw.callto, raw.data)
+
+@dataclass
+class AGWReq_Data(AGWReqFrame, datakind='D'):
+	callfrom: str
+	callto: str
+	data: bytes
+
+	def mod_raw(self, raw):
+		raw.pid = 0xF0
+		raw.callfrom = self.callfrom
+		raw.callto = self.callto
+		raw.data = self.data
+
+@dataclass
+class AGWResp_Data(AGWRespFrame, datakind='D'):
+	callfrom: str
+	callto: str
+	data: bytes
+
+	@classmethod
+	def parse_members(cls, raw):
+		return (raw.callfrom, raw.callto, raw.data)
+
+@dataclass
+class AGWReq_Disconnect(AGWReqFrame, datakind='d'):
+	callfrom: str
+	callto: str
+
+	def mod_raw(self, raw):
+		raw.callfrom = self.callfrom
+		raw.callto = self.callto
+
+@dataclass
+class AGWResp_Disconnected(AGWRespFrame, datakind='d'):
+	callfrom: str
+	callto: str
+	message: bytes
+
+	@classmethod
+	def parse_members(cls, raw):
+		return (raw.callfrom, raw.callto, raw.data)
+
+@dataclass
+class AGWReq_OutstandingFrames(AGWReqFrame, datakind='Y'):
+	callfrom: str
+	callto: str
+
+	def mod_raw(self, raw):
+		raw.callfrom = self.callfrom
+		raw.callto = self.callto
+
+@dataclass
+class AGWResp_OutstandingFrames(AGWRespFrame, datakind='Y'):
+	# Echoes the request header, so callfrom is us here
+	callfrom: str
+	callto: str
+	count: int
+
+	@classmethod
+	def parse_members(cls, raw):
+		return (raw.callfrom, raw.callto, struct.unpack('<I', raw.data[:4])[0])
+
+@dataclass
+class AGWReq_PortOutstandingFrames(AGWReqFrame, datakind='y'):
+	pass
+
+@dataclass
+class AGWResp_PortOutstandingFrames(AGWRespFrame, datakind='y'):
+	count: int
+
+	@classmethod
+	def parse_members(cls, raw):
+		return (struct.unpack('<I', raw.data[:4])[0],)
+
+def agw_call(address):
+	if address.ssid == 0:
+		return address.callsign
+	return f"{address.callsign}-{address.ssid}"
+
+class AGWTCPConnection(ReconnectingStream):
+	PEER_NAME = "AGW server"
+
+	def __init__(self, address, port, s=None, **k):
 		self.rx_byte_buffer = b''
-		self.rx_frame_buffer = []
+		self.rx_frame_buffer = deque()
+
+		# Radio port -> (raw AX.25 frame, tx) monitored there, for ports claimed by
+		# an AGWPort. tx frames are ones the server transmitted for another client.
+		self.raw_frame_buffers = {}
+		# Radio port -> frames recently transmitted through the server, each
+		# recorded once, used to drop their 'K' echo
+		self.own_frames = {}
+		# (radio port, mycall, theircall) -> connected mode frames for that session
+		self.session_frame_buffers = {}
+		self.registered = {}
+		super().__init__('agw', address, port, s, **k)
+
+	@classmethod
+	def from_socket(cls, s):
+		# Already-connected stream socket, e.g. one end of a socketpair
+		return cls('socket', s.fileno(), s)
 
 	def send_raw_agw_frame(self, frame):
-		b = frame.to_buffer()
-		self.s.sendall(b)
+		self.write(frame.to_buffer())
 
 	def send_agw_frame(self, frame):
 		self.send_raw_agw_frame(frame.to_raw())
 
-	def recv_raw_agw_frame(self):
-		try:
-			while True:
-				self.rx_byte_buffer += self.s.recv(1024)
-		except BlockingIOError:
-			pass
-
-		while True:
-			if len(self.rx_byte_buffer) >= RawAGWFrame.HEADER_SIZE:
-				header = self.rx_byte_buffer[:RawAGWFrame.HEADER_SIZE]
-				total_size = RawAGWFrame.HEADER_SIZE + RawAGWFrame.peek_size(header)
-				if len(self.rx_byte_buffer) >= total_size:
-					buffer = self.rx_byte_buffer[:total_size]
-					self.rx_byte_buffer = self.rx_byte_buffer[total_size:]
-					self.rx_frame_buffer.append(RawAGWFrame.from_buffer(buffer))
-					continue
-			break
+	def resync(self):
+		self.rx_byte_buffer = b''
+		for port, own in self.own_frames.items():
+			own.clear()
+		if not self.link_up:
+			# Connections the server was running for us went with it
+			for (port, mycall, theircall), buffer in self.session_frame_buffers.items():
+				buffer.append(AGWResp_Disconnected(port, theircall, mycall, b'*** AGW link lost'))
+
+	def restore(self):
+		# A restarted server has forgotten our monitoring request and callsigns
+		if self.raw_frame_buffers:
+			self.send_agw_frame(AGWReq_EnableRawMonitoring(0))
+		for callsign in self.registered:
+			self.registered[callsign] = None
+			self.send_agw_frame(AGWReq_RegisterCallsign(0, callsign))
+
+	def pump(self):
+		t0 = time.perf_counter()
+		data = self.read_available(4096)
+		if not data:
+			return # Anything left in rx_byte_buffer is an incomplete frame
+		t1 = time.perf_counter()
+		self.rx_byte_buffer += data
+
+		while len(self.rx_byte_buffer) >= RawAGWFrame.HEADER_SIZE:
+			header = self.rx_byte_buffer[:RawAGWFrame.HEADER_SIZE]
+			total_size = RawAGWFrame.HEADER_SIZE + RawAGWFrame.peek_size(header)
+			if len(self.rx_byte_buffer) < total_size:
+				break
+			buffer = self.rx_byte_buffer[:total_size]
+			self.rx_byte_buffer = self.rx_byte_buffer[total_size:]
+			self.m_frames_rx.inc()
+			self.dispatch_raw_agw_frame(RawAGWFrame.from_buffer(buffer))
+
+		self.m_recv_time.observe(t1 - t0)
+		self.m_parse_time.observe(time.perf_counter() - t1)
+
+	def dispatch_raw_agw_frame(self, raw):
+		if raw.port in self.raw_frame_buffers and raw.datakind == 'K':
+			f = AGWRespFrame.parse(raw)
+			own = self.own_frames[raw.port]
+			if f.frame in own:
+				own.remove(f.frame) # The echo of something transmitted here
+			else:
+				self.raw_frame_buffers[raw.port].append((f.frame, False))
+		elif raw.port in self.raw_frame_buffers and raw.datakind == 'T':
+			# The server transmitted this. Our own sends were recorded by
+			# send_data_frame; anything else came from another AGW client, which
+			# monitors see as a transmission and sessions don't see at all.
+			f = AGWRespFrame.parse(raw)
+			own = self.own_frames[raw.port]
+			if f.frame not in own:
+				own.append(f.frame)
+				self.raw_frame_buffers[raw.port].append((f.frame, True))
+		elif raw.datakind in ('C', 'D', 'd', 'Y'):
+			if raw.datakind == 'Y':
+				key = (raw.port, raw.callfrom, raw.callto)
+			else:
+				key = (raw.port, raw.callto, raw.callfrom)
+			if key in self.session_frame_buffers:
+				self.session_frame_buffers[key].append(AGWRespFrame.parse(raw))
+			else:
+				self.rx_frame_buffer.append(raw)
+		elif raw.datakind == 'X':
+			self.registered[raw.callfrom] = AGWRespFrame.parse(raw).success
+		else:
+			self.rx_frame_buffer.append(raw)
+
+	def wait(self, timeout=None):
+		if self.rx_frame_buffer:
+			return
+		if self.link_up:
+			select.select([self.s], [], [], timeout)
+		else:
+			delay = max(0, self.retry_at - time.time())
+			time.sleep(delay if timeout is None else min(delay, timeout))
 
+	def recv_raw_agw_frame(self):
+		self.pump()
 		if self.rx_frame_buffer:
-			return self.rx_frame_buffer.pop(0)
+			return self.rx_frame_buffer.popleft()
 
 	def recv_agw_frame(self):
 		f = self.recv_raw_agw_frame()
 		if f:
-			return AGWRespFrame.parse(f)
+			parsed = AGWRespFrame.parse(f)
+			if parsed is None:
+				self.m_parse_failures.inc()
+			return parsed
 
 	def recv_agw_frame_blocking(self):
-		f = None
+		f = self.recv_agw_frame()
 		while f is None:
+			self.wait()
 			f = self.recv_agw_frame()
 		return f
+
+	def claim_raw_port(self, port):
+		if not self.raw_frame_buffers:
+			self.send_agw_frame(AGWReq_EnableRawMonitoring(0))
+		self.raw_frame_buffers[port] = deque()
+		self.own_frames[port] = deque(maxlen=32)
+
+	def send_data_frame(self, port, frame):
+		self.own_frames[port].append(frame)
+		self.send_agw_frame(AGWReq_RawFrame(port, frame))
+
+	def pending(self, port):
+		return bool(self.raw_frame_buffers[port])
+
+	def recieve_raw_frame(self, port):
+		# (frame, tx) or None
+		buffer = self.raw_frame_buffers[port]
+		if not buffer:
+			self.pump()
+		if buffer:
+			return buffer.popleft()
+
+	def recieve_data_frame(self, port):
+		f = self.recieve_raw_frame(port)
+		while f and f[1]:
+			f = self.recieve_raw_frame(port)
+		if f:
+			return f[0]
+
+	def register_callsign(self, callsign):
+		if callsign not in self.registered:
+			self.registered[callsign] = None
+			self.send_agw_frame(AGWReq_RegisterCallsign(0, callsign))
+
+	def open_session(self, port, mycall, theircall):
+		key = (port, mycall, theircall)
+		self.session_frame_buffers[key] = deque()
+		return self.session_frame_buffers[key]
+
+	def close_session(self, port, mycall, theircall):
+		self.session_frame_buffers.pop((port, mycall, theircall), None)
+
+	def recieve_session_frame(self, buffer):
+		if not buffer:
+			self.pump()
+		if buffer:
+			return buffer.popleft()
+
+class AGWPort:
+	def __init__(self, conn, port):
+		self.conn = conn
+		self.port = port
+		self.on_tx = lambda f:None
+		self.on_rx = lambda f:None
+		conn.claim_raw_port(port)
+
+	def send_data_frame(self, frame):
+		self.on_tx(frame)
+		self.conn.send_data_frame(self.port, frame)
+
+	@property
+	def transport(self):
+		return self.conn
+
+	@property
+	def link_up(self):
+		return self.conn.link_up
+
+	def pending(self):
+		return self.conn.pending(self.port)
+
+	def recieve_data_frame(self):
+		f = self.conn.recieve_raw_frame(self.port)
+		while f and f[1]:
+			self.on_tx(f[0]) # Another client's transmission, for capture and monitors
+			f = self.conn.recieve_raw_frame(self.port)
+		if f:
+			self.on_rx(f[0])
+			return f[0]
@@ -0,0 +1,153 @@
+from ..ax25.abm import AX25ConnectedModeConnection, ByteQueue
+from .agw import *
+from ..trace import TraceRing, TraceEvents as TE
+import time
+
+class AGWSessionPort:
+	# What callers of AX25ConnectedModeConnection.port use. The TNC builds the
+	# frames, so on_tx/on_rx never see any.
+	def __init__(self, conn, index):
+		self.conn = conn
+		self.port = index
+		self.on_tx = lambda f:None
+		self.on_rx = lambda f:None
+
+	@property
+	def transport(self):
+		return self.conn
+
+class AGWConnectedModeConnection:
+	# Stands in for AX25ConnectedModeConnection where the TNC (Direwolf, AGWPE,
+	# ...) runs the AX.25 state machine and we only move payload bytes. The
+	# stream, callback and state interface is the same; the protocol internals
+	# (timers, V(S)/V(R)/V(A), the pending frame) live in the TNC and aren't
+	# here.
+	States = AX25ConnectedModeConnection.States
+
+	def __init__(self, conn, port, mycall, theircall, via=()):
+		self.conn = conn
+		self.port = AGWSessionPort(conn, port)
+		self.mycall = mycall
+		self.theircall = theircall
+		self.via = list(via)
+		self.accept_incoming = False
+
+		self._stream_outgoing = ByteQueue()
+		self.stream_incoming = b''
+		self.on_data = None # If set, called with received payload instead of appending to stream_incoming
+		self.on_drain = lambda:None # Called after bytes are handed to the TNC, and once it has sent them all
+		self.on_disconnect = lambda:None
+		self.busy = False
+
+		self.state = self.States.CONNECTING
+		self.connect_sent = False
+
+		self.mtu = 200
+		self.max_outstanding = 7 # Frames queued in the TNC before we stop feeding it
+		self.outstanding = 0
+		self.outstanding_query_interval = 0.5
+		self.last_outstanding_query = 0
+
+		self._calls = (agw_call(mycall), agw_call(theircall))
+		conn.register_callsign(self._calls[0])
+		self.rx_buffer = conn.open_session(port, *self._calls)
+
+		self.trace = TraceRing()
+
+	stream_outgoing = AX25ConnectedModeConnection.stream_outgoing
+
+	@property
+	def transport(self):
+		return self.conn
+
+	def pending(self):
+		return bool(self.rx_buffer)
+
+	def next_deadline(self):
+		if self.state == self.States.CONNECTING and not self.connect_sent:
+			return 0
+		if self.state == self.States.CONNECTED and self.stream_outgoing:
+			if self.outstanding < self.max_outstanding:
+				return 0
+			return self.last_outstanding_query + self.outstanding_query_interval
+		if self.state == self.States.CONNECTED and self.outstanding:
+			return self.last_outstanding_query + self.outstanding_query_interval # Until drained
+		return None
+
+	def drained(self):
+		# Everything queued has been handed to the TNC and sent
+		return not self.stream_outgoing and self.outstanding == 0
+
+	def set_busy(self, busy):
+		# AGWPE has no receive flow control: the TNC acknowledges whatever
+		# arrives, so this can't hold the other end off. Kept so bridges and
+		# other consumers can treat both session types alike.
+		self.busy = busy
+
+	def initiate_disconnection(self):
+		if self.state == self.States.DISCONNECTED:
+			return
+		self.state = self.States.DISCONNECTING
+		self.conn.send_agw_frame(AGWReq_Disconnect(self.port.port, *self._calls))
+
+	def disconnect(self):
+		self.state = self.States.DISCONNECTED
+		self.conn.close_session(self.port.port, *self._calls)
+		self.on_disconnect()
+
+	def poll(self):
+		tr = self.trace.record
+
+		if self.state == self.States.CONNECTING and not self.connect_sent:
+			tr(TE.AGW_CONNECT, len(self.via))
+			if self.via:
+				self.conn.send_agw_frame(AGWReq_ConnectVia(self.port.port, *self._calls, self.via))
+			else:
+				self.conn.send_agw_frame(AGWReq_Connect(self.port.port, *self._calls))
+			self.connect_sent = True
+
+		if self.state == self.States.DISCONNECTED:
+			return
+
+		f = self.conn.recieve_session_frame(self.rx_buffer)
+		while f:
+			if type(f) == AGWResp_Connected:
+				if self.state == self.States.CONNECTING:
+					tr(TE.AGW_CONNECTED)
+					self.state = self.States.CONNECTED
+			elif type(f) == AGWResp_Data:
+				tr(TE.AGW_DATA_RX, len(f.data))
+				if self.on_data:
+					self.on_data(f.data)
+				else:
+					self.stream_incoming += f.data
+			elif type(f) == AGWResp_Disconnected:
+				tr(TE.AGW_DISCONNECTED)
+				self.disconnect()
+				return
+			elif type(f) == AGWResp_OutstandingFrames:
+				tr(TE.AGW_OUTSTANDING, f.count)
+				sent_all = self.outstanding and not f.count
+				self.outstanding = f.count
+				if sent_all:
+					self.on_drain()
+			f = self.conn.recieve_session_frame(self.rx_buffer)
+
+		if self.state != self.States.CONNECTED or not (self.stream_outgoing or self.outstanding):
+			return
+
+		# The TNC queues whatever we hand it, so meter data in against its
+		# outstanding frame count rather than flooding its buffers. With
+		# nothing left to hand over, keep asking until it's all sent.
+		if self.outstanding >= self.max_outstanding or not self.stream_outgoing:
+			if time.time() - self.last_outstanding_query > self.outstanding_query_interval:
+				self.conn.send_agw_frame(AGWReq_OutstandingFrames(self.port.port, *self._calls))
+				self.last_outstanding_query = time.time()
+			return
+
+		while self.stream_outgoing and self.outstanding < self.max_outstanding:
+			frame = self.stream_outgoing.take(self.mtu)
+			tr(TE.AGW_DATA_TX, len(frame))
+			self.conn.send_agw_frame(AGWReq_Data(self.port.port, *self._calls, frame))
+			self.outstanding += 1
+		self.on_drain()
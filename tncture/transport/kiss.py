@@ -1,19 +1,25 @@
 import socket, time
 from ..ax25.frame import *
+from ..metrics import REGISTRY
+from .reconnect import ReconnectingStream
 
 FEND = 0xC0
 FESC = 0xDB
 TFEND = 0xDC
 TFESC = 0xDD
 
-class TCPKISSConnection:
-	def __init__(self, address, port):
-		self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.s.connect((address, port))
-		self.s.setblocking(0)
+class TCPKISSConnection(ReconnectingStream):
+	PEER_NAME = "KISS TNC"
 
+	def __init__(self, address, port, s=None, **k):
 		self.rx_byte_buffer = b''
 		self.rx_frame_buffers = [[] for x in range(16)]
+		super().__init__('kiss', address, port, s, **k)
+
+	@classmethod
+	def from_socket(cls, s):
+		# Already-connected stream socket, e.g. one end of a socketpair
+		return cls('socket', s.fileno(), s)
 
 	@staticmethod
 	def pack_slip_frame(frame):
@@ -45,48 +51,73 @@ class TCPKISSConnection:
 				output.append(b)
 		return bytes(output)
 
-	def send_raw_kiss_frame(self, port_index, command_code, data):
-		command_byte = port_index << 4 | command_code
-		frame = bytes([
-			FEND,
-			command_byte,
-			*self.pack_slip_frame(data),
-			FEND
-		])
+	@staticmethod
+	def kiss_frame(command_byte, data):
+		# Same bytes as pack_slip_frame, escaping FESC before FEND
+		data = bytes(data).replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc')
+		return b'\xc0' + bytes([command_byte]) + data + b'\xc0'
 
-		self.s.sendall(frame)
+	def send_raw_kiss_frame(self, port_index, command_code, data):
+		self.write(self.kiss_frame(port_index << 4 | command_code, data))
 
 	def send_data_frame(self, port_index, data):
-		return self.send_raw_kiss_frame(0, 0, data)
+		return self.send_raw_kiss_frame(port_index, 0, data)
 
-	def recieve_raw_kiss_frame(self, port):
-		try:
-			while True:
-				self.rx_byte_buffer += self.s.recv(1024)
-		except BlockingIOError:
-			pass
+	def send_data_frames(self, port_index, frames):
+		# Many frames in one write
+		self.write(b''.join([self.kiss_frame(port_index << 4, f) for f in frames]))
+
+	def pending(self, port):
+		return bool(self.rx_frame_buffers[port])
+
+	def resync(self):
+		# Frames already split out are whole; a partial one can't be finished.
+		# Every frame we send starts with FEND, which resyncs the TNC's side.
+		self.rx_byte_buffer = b''
+
+	def pump(self):
+		t0 = time.perf_counter()
+		data = self.read_available(1024)
+		if not data:
+			return # Anything left in rx_byte_buffer is an incomplete frame
+		t1 = time.perf_counter()
+		self.rx_byte_buffer += data
 
 		while True:
 			if self.rx_byte_buffer:
-				assert self.rx_byte_buffer[0] == FEND
+				if self.rx_byte_buffer[0] != FEND:
+					# Garbage between frames, skip to the next FEND
+					self.m_parse_failures.inc()
+					start = self.rx_byte_buffer.find(FEND)
+					self.rx_byte_buffer = self.rx_byte_buffer[start:] if start != -1 else b''
+					continue
 
 				end = self.rx_byte_buffer[1:].find(FEND)
 				if end == -1:
 					break
 
 				frame = self.rx_byte_buffer[:end+2]
-				self.rx_byte_buffer = self.rx_byte_buffer[end+2:]
+				self.rx_byte_buffer = self.rx_byte_buffer[end+1:] # Closing FEND may open the next frame
 
-				assert frame[0] == FEND, "Malformed KISS frame: "+repr(frame)
-				assert frame[-1] == FEND, "Malformed KISS frame: "+repr(frame)
+				if len(frame) == 2:
+					continue # Back-to-back FENDs
 
-				frame = self.unpack_slip_frame(frame[1:-1])
+				try:
+					frame = self.unpack_slip_frame(frame[1:-1])
+				except (ValueError, IndexError):
+					self.m_parse_failures.inc()
+					continue
 
-				port = frame[0] >> 4
-				self.rx_frame_buffers[port].append(frame)
+				self.m_frames_rx.inc()
+				self.rx_frame_buffers[frame[0] >> 4].append(frame)
 			else:
 				break
 
+		self.m_recv_time.observe(t1 - t0)
+		self.m_parse_time.observe(time.perf_counter() - t1)
+
+	def recieve_raw_kiss_frame(self, port):
+		self.pump()
 		if self.rx_frame_buffers[port]:
 			return self.rx_frame_buffers[port].pop(0)
 		else:
@@ -94,25 +125,33 @@ class TCPKISSConnection:
 
 	def recieve_data_frame(self, port):
 		frame = self.recieve_raw_kiss_frame(port)
+		while frame and (frame[0] & 0b1111) != 0:
+			self.m_parse_failures.inc() # KISS frame not data
+			frame = self.recieve_raw_kiss_frame(port)
 		if not frame:
 			return None
 
-		assert (frame[0] & 0b1111) == 0, "KISS frame not data"
-
 		return frame[1:]
 
 class DummyKISSConnection:
 	def __init__(self):
+		self.link_up = True
 		self.rx_frame_buffers = [[] for x in range(16)]
 		self.tx_frame_buffers = [[] for x in range(16)]
 
+	def pending(self, port):
+		return bool(self.rx_frame_buffers[port])
+
 	def recieve_data_frame(self, port):
 		if self.rx_frame_buffers[port]:
-			return self.rx_frame_buffers.pop(0)
+			return self.rx_frame_buffers[port].pop(0)
 
 	def send_data_frame(self, port, frame):
 		self.tx_frame_buffers[port].append(frame)
 
+	def send_data_frames(self, port, frames):
+		self.tx_frame_buffers[port].extend(frames)
+
 	def dummy_receive(self, port, frame):
 		self.rx_frame_buffers[port].append(frame)
 
@@ -126,19 +165,82 @@ class KISSPort:
 		self.port = port
 		self.debug = debug
 		self.last_sent = None
+		self.mycall = None # Source address for sendto(), see bind()
+		self.ui_headers = {} # (dest, pid, via) -> encoded address, control and PID bytes
 		# self.debug_fd = open("kiss_debug.txt", 'a')
 		self.on_tx = lambda f:None
 		self.on_rx = lambda f:None
 
+		labels = {'port': str(port)}
+		self.m_frames_tx = REGISTRY.counter('tncture_port_frames_tx_total', 'Frames sent on the port', **labels)
+		self.m_frames_rx = REGISTRY.counter('tncture_port_frames_rx_total', 'Frames received on the port', **labels)
+		self.m_echoes = REGISTRY.counter('tncture_port_echoes_dropped_total', 'Received copies of our own last frame', **labels)
+
 	def send_data_frame(self, frame):
 		self.on_tx(frame)
 		self.conn.send_data_frame(self.port, frame)
 		self.last_sent = frame
+		self.m_frames_tx.inc()
+
+	@property
+	def transport(self):
+		return self.conn
+
+	@property
+	def link_up(self):
+		return self.conn.link_up
+
+	def pending(self):
+		return self.conn.pending(self.port)
+
+	def bind(self, mycall):
+		if isinstance(mycall, str):
+			mycall = AX25Address.parse(mycall)
+		self.mycall = mycall
+		self.ui_headers.clear()
+
+	def ui_header(self, dest, pid, via=()):
+		key = (str(dest), pid, tuple(str(v) for v in via))
+		header = self.ui_headers.get(key)
+		if header is None:
+			assert self.mycall is not None, "bind() a source callsign before sending datagrams"
+			header = self.ui_headers[key] = encode_ui_header(self.mycall, dest, pid, via)
+		return header
+
+	def sendto(self, dest, pid, data, via=()):
+		self.send_data_frame(self.ui_header(dest, pid, via) + data)
+
+	def sendto_batch(self, datagrams):
+		# (dest, pid, data) or (dest, pid, data, via) tuples, encoded from cached
+		# headers and written to the TNC at once
+		frames = []
+		for dest, pid, data, *via in datagrams:
+			frame = self.ui_header(dest, pid, *via) + data
+			self.on_tx(frame)
+			frames.append(frame)
+		if not frames:
+			return
+		self.conn.send_data_frames(self.port, frames)
+		self.last_sent = frames[-1]
+		self.m_frames_tx.inc(len(frames))
+
+	def datagrams(self, dest=None, pid=None):
+		# Received UI frames as (source, dest, pid, data) until the port runs dry,
+		# skipping anything not for dest/pid without parsing it
+		dest_key = encode_ax25_address_key(dest) if dest is not None else None
+		frame = self.recieve_data_frame()
+		while frame or self.pending():
+			datagram = frame and peek_ui_frame(frame, dest_key, pid)
+			if datagram:
+				yield datagram
+			frame = self.recieve_data_frame()
 
 	def recieve_data_frame(self):
 		frame = self.conn.recieve_data_frame(self.port)
-		if frame == self.last_sent:
+		if frame and frame == self.last_sent:
+			self.m_echoes.inc()
 			frame = None
 		if frame:
+			self.m_frames_rx.inc()
 			self.on_rx(frame)
 		return frame
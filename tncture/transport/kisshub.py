@@ -0,0 +1,226 @@
+from collections import deque
+import socket, sys
+from ..metrics import REGISTRY
+from ..reactor import Reactor
+from .kiss import FEND
+from .reconnect import ReconnectingStream
+
+# Lets several local programs (monitor, node, dial clients) share the one TCP
+# KISS connection a TNC allows. The hub holds that connection and serves KISS
+# to any number of local clients. Frames are never decoded, only cut at FEND
+# boundaries: each read from the TNC becomes one buffer that every client's
+# queue references. Client transmits go upstream in the order they arrived,
+# and (with loopback) to the other clients, as they'd be heard on a shared
+# channel. A client that doesn't keep up loses its oldest frames, not everyone
+# else's. When the TNC doesn't keep up, the hub stops reading from clients until
+# the upstream buffer drains, so TCP holds them back.
+
+KISS_RETURN = 0xFF # Takes the TNC out of KISS mode; one client can't do that to the rest
+CLIENT_RETRY = 0.05 # How soon to try a client whose socket buffer was full again
+
+def split_frames(buffer):
+	# (whole frames from the first FEND to the last, the rest from the last FEND
+	# on). Each piece is delimited on both ends, so dropping one can't glue two
+	# frames together; the FEND they share just appears twice.
+	start = buffer.find(FEND)
+	if start == -1:
+		return b'', b''
+	last = buffer.rfind(FEND)
+	if last == start:
+		return b'', buffer[start:]
+	return buffer[start:last + 1], buffer[last:]
+
+class HubUpstream(ReconnectingStream):
+	PEER_NAME = "KISS TNC"
+
+	def __init__(self, address, port, **k):
+		self.rx_buffer = b''
+		super().__init__('kisshub', address, port, **k)
+
+	def resync(self):
+		self.rx_buffer = b''
+
+class HubClient:
+	__slots__ = ('s', 'name', 'rx_buffer', 'queue', 'queued')
+
+	def __init__(self, s, name):
+		self.s = s
+		self.name = name
+		self.rx_buffer = b''
+		self.queue = deque() # memoryviews of whole frames, oldest first
+		self.queued = 0
+
+	def fileno(self):
+		return self.s.fileno()
+
+class KISSHub:
+	def __init__(self, tnc=('localhost', 8001), listen=('localhost', 8101), max_queued=65536, loopback=True, reactor=None):
+		self.upstream = HubUpstream(*tnc)
+		self.max_queued = max_queued # Bytes waiting for one client before its oldest frames go
+		self.loopback = loopback
+		self.clients = []
+		self.tx_pending = [] # (sender, frames) read from clients this round
+		self.retry = None
+		self.clients_paused = False # Not reading clients while the TNC catches up
+
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind(listen)
+		self.listener.listen()
+		self.listener.setblocking(0)
+
+		self.reactor = reactor or Reactor()
+		self.reactor.add_reader(self.upstream, self.on_upstream)
+		self.reactor.add_reader(self.listener, self.on_accept)
+		self.reactor.after_poll.append(self.flush)
+
+		self.m_clients = REGISTRY.gauge('tncture_kisshub_clients', 'Local KISS clients connected')
+		self.m_frames_tx = REGISTRY.counter('tncture_kisshub_frames_tx_total', 'Client frames passed to the TNC')
+		self.m_frames_refused = REGISTRY.counter('tncture_kisshub_frames_refused_total', 'Client frames not passed on (KISS return)')
+		self.m_bytes_dropped = REGISTRY.counter('tncture_kisshub_bytes_dropped_total', 'Bytes dropped from slow clients\' queues')
+		self.m_pauses = REGISTRY.counter('tncture_kisshub_client_pauses_total', 'Times client reads stopped for a TNC that wasn\'t keeping up')
+
+	def on_accept(self):
+		try:
+			s, addr = self.listener.accept()
+		except BlockingIOError:
+			return
+		s.setblocking(0)
+		client = HubClient(s, f"{addr[0]}:{addr[1]}")
+		self.clients.append(client)
+		if not self.clients_paused:
+			self.reactor.add_reader(client, lambda: self.on_client(client))
+		self.m_clients.set(len(self.clients))
+
+	def drop_client(self, client):
+		if client not in self.clients:
+			return
+		self.clients.remove(client)
+		if not self.clients_paused:
+			self.reactor.remove_reader(client)
+		client.s.close()
+		self.m_clients.set(len(self.clients))
+
+	def on_upstream(self):
+		data = self.upstream.read_available(4096)
+		if not data:
+			return
+		frames, self.upstream.rx_buffer = split_frames(self.upstream.rx_buffer + data)
+		if frames:
+			self.fan_out(frames)
+
+	def on_client(self, client):
+		try:
+			data = client.s.recv(4096)
+		except BlockingIOError:
+			return
+		except OSError:
+			data = b''
+		if not data:
+			self.drop_client(client)
+			return
+		frames, client.rx_buffer = split_frames(client.rx_buffer + data)
+		if frames:
+			self.tx_pending.append((client, frames))
+
+	def fan_out(self, frames, sender=None):
+		view = memoryview(frames)
+		for client in self.clients:
+			if client is sender:
+				continue
+			client.queue.append(view)
+			client.queued += len(view)
+			while client.queued > self.max_queued and len(client.queue) > 1: # Never the frames just read
+				dropped = client.queue.popleft()
+				client.queued -= len(dropped)
+				self.m_bytes_dropped.inc(len(dropped))
+
+	def flush(self):
+		# Client transmits first, in arrival order, in one write
+		if self.tx_pending:
+			pending, self.tx_pending = self.tx_pending, []
+			out = []
+			for sender, frames in pending:
+				split = [f for f in frames.split(b'\xc0') if f]
+				kept = [f for f in split if f[0] != KISS_RETURN]
+				self.m_frames_refused.inc(len(split) - len(kept))
+				if not kept:
+					continue
+				frames = b'\xc0' + b'\xc0\xc0'.join(kept) + b'\xc0'
+				self.m_frames_tx.inc(len(kept))
+				out.append(frames)
+				if self.loopback:
+					self.fan_out(frames, sender)
+			if out:
+				self.upstream.write(b''.join(out))
+		self.pause_clients(self.upstream.tx_buffered > self.upstream.max_buffered // 2)
+
+		backlog = False
+		for client in list(self.clients):
+			self.send_queued(client)
+			backlog = backlog or bool(client.queue)
+		if backlog and self.retry is None:
+			self.retry = self.reactor.call_later(CLIENT_RETRY, self._retry)
+
+	def pause_clients(self, paused):
+		if paused == self.clients_paused:
+			return
+		self.clients_paused = paused
+		if paused:
+			self.m_pauses.inc()
+		for client in self.clients:
+			if paused:
+				self.reactor.remove_reader(client)
+			else:
+				self.reactor.add_reader(client, lambda client=client: self.on_client(client))
+
+	def _retry(self):
+		self.retry = None # flush() runs after this round's polls anyway
+
+	def send_queued(self, client):
+		while client.queue:
+			head = client.queue[0]
+			try:
+				sent = client.s.send(head)
+			except BlockingIOError:
+				return
+			except OSError:
+				self.drop_client(client)
+				return
+			client.queued -= sent
+			if sent < len(head):
+				client.queue[0] = head[sent:]
+				return
+			client.queue.popleft()
+
+	def run(self):
+		self.reactor.run()
+
+	def close(self):
+		for client in list(self.clients):
+			self.drop_client(client)
+		self.reactor.remove_reader(self.listener)
+		self.listener.close()
+
+def main(argv):
+	args = [a for a in argv[1:] if not a.startswith('--')]
+	if len(args) not in (0, 2) or '--help' in argv:
+		print("Usage: tncture.transport.kisshub [TNC_HOST TNC_PORT] [--listen=PORT] [--no-loopback]")
+		sys.exit(1)
+	tnc = (args[0], int(args[1])) if args else ('localhost', 8001)
+	listen = ('localhost', 8101)
+	for a in argv[1:]:
+		if a.startswith('--listen='):
+			listen = ('localhost', int(a.split('=', 1)[1]))
+
+	hub = KISSHub(tnc, listen, loopback='--no-loopback' not in argv)
+	hub.upstream.on_link = lambda up: print(f"[hub] TNC link {'back' if up else 'lost, reconnecting...'}")
+	print(f"[hub] Sharing {tnc[0]}:{tnc[1]} on {listen[0]}:{listen[1]}")
+	try:
+		hub.run()
+	except KeyboardInterrupt:
+		pass
+	hub.close()
+
+if __name__ == '__main__':
+	main(sys.argv)
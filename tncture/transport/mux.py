@@ -0,0 +1,129 @@
+from collections import deque
+from ..ax25.frame import *
+
+class MuxSessionPort:
+	# Looks like a KISSPort to one AX25ConnectedModeConnection, but only sees frames
+	# between its two stations
+	def __init__(self, mux, key):
+		self.mux = mux
+		self.key = key
+		self.rx_frames = deque()
+		self.on_tx = lambda f:None
+		self.on_rx = lambda f:None
+
+	@property
+	def conn(self):
+		return self.mux.port.conn
+
+	@property
+	def transport(self):
+		return self.mux
+
+	@property
+	def link_up(self):
+		return getattr(self.mux.port, 'link_up', True)
+
+	def send_data_frame(self, frame):
+		self.on_tx(frame)
+		self.mux.port.send_data_frame(frame)
+
+	def pending(self):
+		if not self.rx_frames:
+			self.mux.pump()
+		return bool(self.rx_frames)
+
+	def recieve_data_frame(self):
+		if not self.rx_frames:
+			self.mux.pump()
+		if self.rx_frames:
+			frame = self.rx_frames.popleft()
+			self.on_rx(frame)
+			return frame
+
+	def close(self):
+		self.mux.sessions.pop(self.key, None)
+
+class PortMux:
+	# Shares one port between many connections, routing received frames by
+	# (dest, source) address straight from the raw bytes
+	def __init__(self, port):
+		self.port = port
+		self.sessions = {} # (mycall key, theircall key) -> MuxSessionPort
+		self.listeners = {} # mycall key -> (connection class, on_connection)
+		self.taps = [] # Called with every received frame
+		self.on_unrouted = lambda f:None
+
+	@property
+	def conn(self):
+		return self.port.conn
+
+	def fileno(self):
+		return self.port.transport.fileno()
+
+	# Follow a reconnecting transport underneath (see Reactor.add_reader)
+
+	@property
+	def link_generation(self):
+		return self.port.transport.link_generation
+
+	@property
+	def link_up(self):
+		return self.port.link_up
+
+	def next_deadline(self):
+		return self.port.transport.next_deadline()
+
+	def wants_write(self):
+		return self.port.transport.wants_write()
+
+	def flush(self):
+		self.port.transport.flush()
+
+	def session_port(self, mycall, theircall):
+		key = (encode_ax25_address_key(mycall), encode_ax25_address_key(theircall))
+		port = self.sessions[key] = MuxSessionPort(self, key)
+		return port
+
+	def listen(self, mycall, on_connection, connection_class=None):
+		# Start an incoming connection whenever someone sends mycall a SABM
+		if connection_class is None:
+			from ..ax25.abm import AX25ConnectedModeConnection
+			connection_class = AX25ConnectedModeConnection
+		self.listeners[encode_ax25_address_key(mycall)] = (mycall, connection_class, on_connection)
+
+	def pending(self):
+		return self.port.pending()
+
+	def pump(self):
+		frame = self.port.recieve_data_frame()
+		while frame:
+			self.route(frame)
+			frame = self.port.recieve_data_frame()
+
+	def route(self, frame):
+		if len(frame) < 15:
+			return
+		for tap in self.taps:
+			tap(frame)
+
+		theirs, mine = peek_ax25_addresses(frame)
+		session = self.sessions.get((mine, theirs))
+		if session:
+			session.rx_frames.append(frame)
+			return
+
+		listener = self.listeners.get(mine)
+		if listener and self._is_sabm(frame):
+			mycall, connection_class, on_connection = listener
+			theircall = AX25Address.parse(str_ax25_address_key(theirs))
+			port = self.session_port(mycall, theircall)
+			port.rx_frames.append(frame)
+			on_connection(connection_class(port, mycall, theircall, incoming=True))
+			return
+
+		self.on_unrouted(frame)
+
+	@staticmethod
+	def _is_sabm(frame):
+		end = ax25_address_end(frame)
+		return end < len(frame) and (frame[end] & ~0b10000) == 0b00101111
@@ -0,0 +1,217 @@
+from collections import deque
+import errno, random, select, socket, time
+from ..metrics import REGISTRY, FAST_BUCKETS
+
+# TCP link to a TNC that survives the TNC restarting. When the socket fails we
+# close it, discard any half-received frame and retry the connection with
+# jittered exponential backoff, queueing (a bounded number of) outgoing frames
+# meanwhile. While it's up, whatever the socket won't take yet is buffered
+# (also bounded) and sent as it becomes writable. Sessions read link_up through their port and hold their timers
+# while it's False, so an outage doesn't cost them retries.
+
+class Backoff:
+	def __init__(self, initial=0.5, maximum=30, factor=2, jitter=0.5):
+		self.initial = initial
+		self.maximum = maximum
+		self.factor = factor
+		self.jitter = jitter # Fraction of each delay that's randomised
+		self.reset()
+
+	def reset(self):
+		self.delay = self.initial
+
+	def next(self):
+		delay = self.delay * (1 - self.jitter * random.random())
+		self.delay = min(self.delay * self.factor, self.maximum)
+		return delay
+
+class ReconnectingStream:
+	PEER_NAME = "TNC"
+	CONNECT_TIMEOUT = 5
+	CONNECT_POLL = 0.05 # How often to check on a connect() in progress
+
+	def __init__(self, kind, address, port, s=None, max_queued=64, max_buffered=65536, backoff=None):
+		# s is an already-connected socket; those can't be reopened, so losing
+		# them raises as before
+		self.peer = (address, port) if s is None else None
+		if s is None:
+			s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			s.connect((address, port))
+		self.s = s
+		self.s.setblocking(0)
+
+		self.link_up = True
+		self.link_generation = 0 # Bumped on every reconnect, so a reused fd still looks new
+		self.backoff = backoff or Backoff()
+		self.retry_at = None
+		self.connecting = None # (socket, started) while a connect() is in progress
+		self.tx_queue = deque()
+		self.max_queued = max_queued
+		self.tx_buffer = deque() # Writes the socket hasn't taken all of yet, oldest first
+		self.tx_sent = 0 # Bytes of the first one it has taken
+		self.tx_buffered = 0
+		self.max_buffered = max_buffered # Bytes, before the oldest unstarted writes go
+		self.on_link = lambda up:None
+
+		labels = {'transport': kind, 'peer': f"{address}:{port}"}
+		self.m_bytes_tx = REGISTRY.counter('tncture_transport_bytes_tx_total', 'Bytes written to the TNC', **labels)
+		self.m_bytes_rx = REGISTRY.counter('tncture_transport_bytes_rx_total', 'Bytes read from the TNC', **labels)
+		self.m_frames_rx = REGISTRY.counter('tncture_transport_frames_rx_total', 'Frames reassembled from the TNC stream', **labels)
+		self.m_parse_failures = REGISTRY.counter('tncture_transport_parse_failures_total', 'Malformed frames dropped', **labels)
+		self.m_link_up = REGISTRY.gauge('tncture_transport_link_up', '1 while connected to the TNC', **labels)
+		self.m_link_losses = REGISTRY.counter('tncture_transport_link_losses_total', 'Connections to the TNC lost', **labels)
+		self.m_tx_queued = REGISTRY.counter('tncture_transport_frames_queued_total', 'Frames held while the link was down', **labels)
+		self.m_tx_dropped = REGISTRY.counter('tncture_transport_frames_dropped_total', 'Held frames dropped because the queue was full', **labels)
+		self.m_recv_time = REGISTRY.histogram('tncture_transport_recv_seconds', 'Time reading from the TNC, per read that got data', FAST_BUCKETS, **labels)
+		self.m_parse_time = REGISTRY.histogram('tncture_transport_parse_seconds', 'Time splitting and parsing what a read got', FAST_BUCKETS, **labels)
+		self.m_link_up.set(1)
+
+	def fileno(self):
+		return self.s.fileno()
+
+	def next_deadline(self):
+		# When the next reconnection attempt is due, None while connected
+		return None if self.link_up else self.retry_at
+
+	def write(self, data):
+		if not self.link_up:
+			self.maintain()
+		if not self.link_up:
+			self.enqueue(data)
+			return
+		self.tx_buffer.append(data)
+		self.tx_buffered += len(data)
+		while self.tx_buffered > self.max_buffered and len(self.tx_buffer) > 2:
+			# The head may be partly sent and the newest is what we were just
+			# given; dropping a whole write in between keeps the stream framed
+			dropped = self.tx_buffer[1]
+			del self.tx_buffer[1]
+			self.tx_buffered -= len(dropped)
+			self.m_tx_dropped.inc()
+		self.flush()
+
+	def flush(self):
+		# Send what the socket will take now; the reactor calls this again once
+		# it's writable (see wants_write)
+		while self.tx_buffer and self.link_up:
+			head = self.tx_buffer[0]
+			try:
+				sent = self.s.send(memoryview(head)[self.tx_sent:])
+			except BlockingIOError:
+				return
+			except OSError as e:
+				self.link_lost(e)
+				return
+			self.m_bytes_tx.inc(sent)
+			self.tx_buffered -= sent
+			self.tx_sent += sent
+			if self.tx_sent < len(head):
+				return
+			self.tx_buffer.popleft()
+			self.tx_sent = 0
+
+	def wants_write(self):
+		return self.link_up and bool(self.tx_buffer)
+
+	def read_available(self, size):
+		# Everything readable without blocking, b'' if nothing (or the link is down)
+		if not self.link_up:
+			self.maintain()
+			if not self.link_up:
+				return b''
+		if self.tx_buffer:
+			self.flush() # For callers that don't use a reactor
+			if not self.link_up:
+				return b''
+		chunks = []
+		try:
+			while True:
+				data = self.s.recv(size)
+				if not data:
+					raise ConnectionResetError(f"{self.PEER_NAME} closed the connection")
+				self.m_bytes_rx.inc(len(data))
+				chunks.append(data)
+		except BlockingIOError:
+			pass
+		except OSError as e:
+			self.link_lost(e) # What we got since the last frame boundary is discarded with it
+			return b''
+		return b''.join(chunks)
+
+	def enqueue(self, data):
+		if len(self.tx_queue) >= self.max_queued:
+			self.tx_queue.popleft() # Oldest first; AX.25 retransmission covers it
+			self.m_tx_dropped.inc()
+		self.tx_queue.append(data)
+		self.m_tx_queued.inc()
+
+	def link_lost(self, error):
+		if self.peer is None:
+			raise error
+		self.s.close()
+		self.link_up = False
+		# A partly sent write is lost with the connection; whole ones go out again
+		# after it's restored
+		buffered, self.tx_buffer, self.tx_buffered = self.tx_buffer, deque(), 0
+		if self.tx_sent:
+			buffered.popleft()
+			self.tx_sent = 0
+		for data in buffered:
+			self.enqueue(data)
+		self.m_link_up.set(0)
+		self.m_link_losses.inc()
+		self.retry_at = time.time() + self.backoff.next()
+		self.resync()
+		self.on_link(False)
+
+	def maintain(self):
+		# Retry the connection if it's down and the backoff has run out
+		if self.link_up or time.time() < self.retry_at:
+			return
+		if self.connecting is None:
+			s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			s.setblocking(0)
+			err = s.connect_ex(self.peer)
+			if err not in (0, errno.EINPROGRESS):
+				s.close()
+				self.retry_at = time.time() + self.backoff.next()
+				return
+			self.connecting = (s, time.time())
+
+		s, started = self.connecting
+		_, writable, _ = select.select([], [s], [], 0)
+		if writable:
+			self.connecting = None
+			if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+				s.close()
+				self.retry_at = time.time() + self.backoff.next()
+			else:
+				self.link_restored(s)
+		elif time.time() - started > self.CONNECT_TIMEOUT:
+			self.connecting = None
+			s.close()
+			self.retry_at = time.time() + self.backoff.next()
+		else:
+			self.retry_at = time.time() + self.CONNECT_POLL
+
+	def link_restored(self, s):
+		self.s = s
+		self.link_up = True
+		self.link_generation += 1
+		self.retry_at = None
+		self.backoff.reset()
+		self.m_link_up.set(1)
+		self.resync()
+		self.restore()
+		queued, self.tx_queue = self.tx_queue, deque()
+		for data in queued:
+			self.write(data)
+		self.on_link(True)
+
+	def resync(self):
+		# Throw away partly received stream state; the new connection starts clean
+		pass
+
+	def restore(self):
+		# Tell a freshly connected TNC whatever it needs to know, before queued frames go out
+		pass
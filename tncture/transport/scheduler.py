@@ -0,0 +1,198 @@
+from collections import deque
+import time
+from ..ax25.frame import *
+from ..metrics import REGISTRY, CounterSet
+
+# Sits between connections and a port and decides what goes on the air next.
+# Supervisory and U-frames jump the queue; I-frames are queued per connection
+# and shared out by deficit round-robin on estimated airtime. Only `backlog`
+# seconds of airtime are handed to the TNC at once, so ordering decisions stay
+# here instead of in the TNC's FIFO. A connection whose T1 runs out while its
+# I-frame is still held here resends it; the resend takes the queued copy's
+# place rather than queueing a second one.
+
+HDLC_OVERHEAD = 4 # Two flags and the FCS
+BIT_STUFFING = 1.05 # Rough average for mixed data
+
+class AirtimeWindow:
+	def __init__(self, window):
+		self.window = window
+		self.entries = deque() # (time, seconds)
+		self.total = 0
+
+	def add(self, now, seconds):
+		self.entries.append((now, seconds))
+		self.total += seconds
+
+	def expire(self, now):
+		while self.entries and self.entries[0][0] <= now - self.window:
+			self.total -= self.entries.popleft()[1]
+
+	def utilisation(self, now):
+		self.expire(now)
+		return self.total / self.window
+
+class TxScheduler:
+	def __init__(self, port, bitrate=1200, txdelay=0.3, duty_cycle=1.0, window=60, backlog=0.5, reactor=None):
+		self.port = port
+		self.bitrate = bitrate
+		self.txdelay = txdelay # Counted for every frame, so back-to-back frames are overestimated
+		self.duty_cycle = duty_cycle # Ceiling on our share of airtime over `window` seconds
+		self.backlog = backlog # Seconds of airtime we let the TNC queue up
+		self.reactor = reactor # If set, used to come back when held frames can go
+
+		self.urgent = deque()
+		self.flows = {} # (dest key, source key) -> deque of I-frames
+		self.deficits = {}
+		self.active = deque() # Flow keys with frames waiting, in round-robin order
+		self.quantum = self.airtime(256)
+
+		self.tx_window = AirtimeWindow(window)
+		self.rx_window = AirtimeWindow(window)
+		self.busy_until = 0
+		self.wakeup = None
+
+		labels = {'port': str(getattr(port, 'port', ''))}
+		self.m_airtime = CounterSet(REGISTRY, 'tncture_sched_airtime_seconds_total', 'Estimated airtime sent', 'class', **labels)
+		self.m_duty_held = REGISTRY.counter('tncture_sched_duty_cycle_holds_total', 'Times the duty-cycle ceiling held frames back', **labels)
+		self.m_replaced = REGISTRY.counter('tncture_sched_replaced_frames_total', 'Queued I-frames replaced by their retransmission', **labels)
+		self.m_queued = REGISTRY.gauge('tncture_sched_queued_frames', 'Frames waiting for airtime', **labels)
+		self.m_tx_util = REGISTRY.gauge('tncture_sched_tx_utilisation', 'Our share of airtime over the window', **labels)
+		self.m_channel_util = REGISTRY.gauge('tncture_sched_channel_utilisation', 'Airtime heard plus sent over the window', **labels)
+
+	def airtime(self, length):
+		return self.txdelay + (length + HDLC_OVERHEAD) * 8 * BIT_STUFFING / self.bitrate
+
+	# Port interface, so connections and PortMux can use the scheduler in place of the port
+
+	@property
+	def conn(self):
+		return self.port.conn
+
+	@property
+	def transport(self):
+		return self.port.transport
+
+	@property
+	def link_up(self):
+		return getattr(self.port, 'link_up', True)
+
+	def pending(self):
+		return self.port.pending()
+
+	def recieve_data_frame(self):
+		frame = self.port.recieve_data_frame()
+		if frame:
+			self.rx_window.add(time.time(), self.airtime(len(frame)))
+		return frame
+
+	def send_data_frame(self, frame):
+		end = ax25_address_end(frame) if len(frame) > 14 else None
+		if end is not None and not frame[end] & 1:
+			key = ax25_address_key(frame[0:7]) + ax25_address_key(frame[7:14])
+			flow = self.flows.get(key)
+			if flow is None:
+				flow = self.flows[key] = deque()
+				self.deficits[key] = 0
+				self.active.append(key)
+			for i, queued in enumerate(flow):
+				if self._same_i_frame(queued, frame, end):
+					flow[i] = frame # Keeps its place; the newer N(R) goes out
+					self.m_replaced.inc()
+					break
+			else:
+				flow.append(frame)
+		else:
+			self.urgent.append(frame)
+		self.flush()
+
+	@staticmethod
+	def _same_i_frame(a, b, end):
+		# Same N(S) and payload, so a retransmission; only N(R) and P may differ.
+		# With modulo 8 N(S) is bits 1-3 of the control byte and everything after
+		# it must match. Modulo 128 puts N(S) in the second control byte, which
+		# the tail comparison covers (and then the low bits of N(R) must agree
+		# too, which errs towards keeping both).
+		return len(a) == len(b) and a[end] & 0x0E == b[end] & 0x0E and a[end+1:] == b[end+1:]
+
+	def queued(self):
+		return len(self.urgent) + sum(len(f) for f in self.flows.values())
+
+	def _next_bulk(self):
+		while self.active:
+			key = self.active[0]
+			flow = self.flows[key]
+			cost = self.airtime(len(flow[0]))
+			if self.deficits[key] < cost:
+				self.deficits[key] += self.quantum
+				self.active.rotate(-1)
+				continue
+			self.deficits[key] -= cost
+			frame = flow.popleft()
+			if not flow:
+				self.active.popleft()
+				del self.flows[key]
+				del self.deficits[key]
+			return frame
+
+	def _held_by_duty_cycle(self, now):
+		return self.duty_cycle < 1 and self.tx_window.utilisation(now) >= self.duty_cycle
+
+	def flush(self):
+		now = time.time()
+		while self.urgent or self.active:
+			if self.busy_until - now > self.backlog:
+				break
+			if self._held_by_duty_cycle(now):
+				self.m_duty_held.inc()
+				break
+			if self.urgent:
+				frame, kind = self.urgent.popleft(), 'urgent'
+			else:
+				frame, kind = self._next_bulk(), 'bulk'
+			airtime = self.airtime(len(frame))
+			self.busy_until = max(self.busy_until, now) + airtime
+			self.tx_window.add(now, airtime)
+			self.m_airtime[kind].inc(airtime)
+			self.port.send_data_frame(frame)
+
+		self.m_queued.set(self.queued())
+		self.m_tx_util.set(self.tx_window.utilisation(now))
+		self.m_channel_util.set(self.channel_utilisation(now))
+		self._schedule_wakeup()
+
+	def next_deadline(self):
+		# When flush() could next send something, or None if nothing is queued
+		if not (self.urgent or self.active):
+			return None
+		if self._held_by_duty_cycle(time.time()):
+			# Enough of the window must slide past to get back under the ceiling
+			excess = self.tx_window.total - self.duty_cycle * self.tx_window.window
+			for t, seconds in self.tx_window.entries:
+				excess -= seconds
+				if excess < 0:
+					return t + self.tx_window.window
+		return self.busy_until - self.backlog
+
+	def _schedule_wakeup(self):
+		if self.reactor is None:
+			return
+		deadline = self.next_deadline()
+		if self.wakeup is not None:
+			if deadline is not None and self.wakeup.deadline == deadline:
+				return
+			self.wakeup.cancel()
+			self.wakeup = None
+		if deadline is not None:
+			self.wakeup = self.reactor.call_at(deadline, self._wake)
+
+	def _wake(self):
+		self.wakeup = None
+		self.flush()
+
+	def utilisation(self, now=None):
+		return self.tx_window.utilisation(now or time.time())
+
+	def channel_utilisation(self, now=None):
+		now = now or time.time()
+		return self.tx_window.utilisation(now) + self.rx_window.utilisation(now)
@@ -0,0 +1,271 @@
+from abc import ABC, abstractmethod
+from collections import deque
+import mmap, os, time
+
+# YAPP file transfer over a connected-mode session. Frames are a type byte and
+# either a second fixed byte or a length followed by that many bytes:
+#
+#   SI ENQ 01            RR ACK 01            RF ACK 02
+#   AF ACK 03            AT ACK 04            CA ACK 05
+#   HD SOH len name\0 size\0                  DT STX len data (len 0 = 256)
+#   EF ETX 01            ET EOT 01
+#   NR NAK len reason    RE NAK len R\0 offset\0 (resume, as in YAPPC)
+#   CN CAN len reason
+#
+# Both ends hook the connection's on_data/on_drain callbacks, so nothing runs
+# between frames. The sender maps the file and queues DT frames as slices of
+# the mapping only when the send queue runs low; the receiver appends each DT
+# straight to the file.
+
+SOH, STX, ETX, EOT, ENQ, ACK, NAK, CAN = 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x15, 0x18
+LENGTH_PREFIXED = (SOH, STX, NAK, CAN)
+BLOCK = 256
+
+SI = bytes([ENQ, 1])
+RR = bytes([ACK, 1])
+RF = bytes([ACK, 2])
+AF = bytes([ACK, 3])
+AT = bytes([ACK, 4])
+CA = bytes([ACK, 5])
+EF = bytes([ETX, 1])
+ET = bytes([EOT, 1])
+
+class YAPPError(Exception):
+	pass
+
+def yapp_frame(kind, body):
+	return bytes([kind, len(body) & 0xff]) + body
+
+class YAPPTransfer(ABC):
+	def __init__(self, conn):
+		self.conn = conn
+		self.rx = b''
+		self.state = None
+		self.error = None
+		self.name = None
+		self.size = None
+		self.offset = 0 # Bytes of the file done, including any resumed part
+		self.resumed_from = 0
+		self.started = None
+		self.finished = None
+
+		self.saved_callbacks = (conn.on_data, conn.on_drain)
+		conn.on_data = self._on_data
+		conn.on_drain = self._on_drain
+		if conn.stream_incoming:
+			data, conn.stream_incoming = conn.stream_incoming, b''
+			self._on_data(data)
+
+	@property
+	def done(self):
+		return self.state in ('done', 'failed')
+
+	def rate(self):
+		# Goodput in bytes/s since data started flowing
+		if self.started is None:
+			return 0
+		elapsed = (self.finished or time.time()) - self.started
+		return (self.offset - self.resumed_from) / elapsed if elapsed > 0 else 0
+
+	def eta(self):
+		# Seconds left, or None while unknown
+		rate = self.rate()
+		if self.size is None or not rate:
+			return None
+		return (self.size - self.offset) / rate
+
+	def cancel(self, reason='Cancelled'):
+		self._drop_queued()
+		self.send(yapp_frame(CAN, reason.encode('ascii', 'replace')))
+		self.state = 'cancelling'
+
+	def send(self, data):
+		self.conn.stream_outgoing += data
+
+	def _on_data(self, data):
+		self.rx += data
+		while len(self.rx) >= 2:
+			kind = self.rx[0]
+			if kind in LENGTH_PREFIXED:
+				length = self.rx[1] or (BLOCK if kind == STX else 0)
+				if len(self.rx) < 2 + length:
+					return
+				frame, body = self.rx[:2], self.rx[2:2+length]
+				self.rx = self.rx[2+length:]
+			else:
+				frame, body = self.rx[:2], b''
+				self.rx = self.rx[2:]
+
+			if frame[0] == CAN:
+				self._drop_queued()
+				self.send(CA)
+				self._finish(YAPPError(body.decode('ascii', 'replace') or 'Cancelled by peer'))
+			elif frame == CA and self.state == 'cancelling':
+				self._finish(YAPPError('Cancelled'))
+			else:
+				self.handle(frame, body)
+			if self.done:
+				return
+
+	def _on_drain(self):
+		pass
+
+	@abstractmethod
+	def handle(self, frame, body):
+		# One frame of the transfer other than CAN/CA, which _on_data handles
+		pass
+
+	def _drop_queued(self):
+		# Called before queuing CAN or CA: nothing still queued is wanted now
+		pass
+
+	def _finish(self, error=None):
+		self.error = error
+		self.state = 'failed' if error else 'done'
+		self.finished = time.time()
+		self.conn.on_data, self.conn.on_drain = self.saved_callbacks
+		if self.rx:
+			# Whatever followed the transfer belongs to the session again
+			self.conn.stream_incoming += self.rx
+			self.rx = b''
+		self.close()
+
+	def close(self):
+		pass
+
+class YAPPSender(YAPPTransfer):
+	def __init__(self, conn, path, name=None, low_water=None):
+		super().__init__(conn)
+		self.path = path
+		self.name = name or os.path.basename(path)
+		self.low_water = low_water if low_water is not None else 4 * conn.mtu
+		self.f = open(path, 'rb')
+		self.size = os.fstat(self.f.fileno()).st_size
+		self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+		self.view = memoryview(self.map)
+		self.queued = 0 # Bytes of DT frames and EF queued so far
+		self.frame_ends = deque() # Where each of those still queued ends, in the same count
+
+		self.state = 'SI'
+		self.send(SI)
+
+	def handle(self, frame, body):
+		if self.state == 'SI' and frame == RR:
+			self.send(yapp_frame(SOH, self.name.encode('ascii', 'replace') + b'\x00' + str(self.size).encode() + b'\x00'))
+			self.state = 'HD'
+		elif self.state == 'HD' and frame == RF:
+			self._start_data(0)
+		elif self.state == 'HD' and frame[0] == NAK and body[:2] == b'R\x00':
+			self._start_data(int(body[2:].split(b'\x00')[0] or 0))
+		elif frame[0] == NAK:
+			self._finish(YAPPError(f"Not ready: {body.decode('ascii', 'replace')}"))
+		elif self.state == 'EF' and frame == AF:
+			self.send(ET)
+			self.state = 'ET'
+		elif self.state == 'ET' and frame == AT:
+			self._finish()
+
+	def _start_data(self, offset):
+		self.offset = self.resumed_from = min(offset, self.size)
+		self.started = time.time()
+		self.state = 'DT'
+		self._on_drain()
+
+	def _on_drain(self):
+		if self.state != 'DT':
+			return
+		while len(self.conn.stream_outgoing) < self.low_water and self.offset < self.size:
+			block = self.view[self.offset:self.offset+BLOCK]
+			self.send(bytes([STX, len(block) & 0xff]))
+			self.send(block)
+			self.offset += len(block)
+			self._queued_frame(2 + len(block))
+		if self.offset >= self.size:
+			self.send(EF)
+			self._queued_frame(len(EF))
+			self.state = 'EF'
+
+	def _queued_frame(self, length):
+		self.queued += length
+		self.frame_ends.append(self.queued)
+		sent = self.queued - len(self.conn.stream_outgoing)
+		while self.frame_ends[0] <= sent:
+			self.frame_ends.popleft()
+
+	def _drop_queued(self):
+		# Past the header only DT frames and EF are queued. A frame that has
+		# started going out is finished, or the other end loses its framing
+		# and never sees our CAN or CA.
+		if self.state in ('DT', 'EF'):
+			sent = self.queued - len(self.conn.stream_outgoing)
+			while self.frame_ends and self.frame_ends[0] <= sent:
+				self.frame_ends.popleft()
+			rest = self.frame_ends[0] - sent if self.frame_ends else 0
+			self.conn.stream_outgoing = self.conn.stream_outgoing.take(rest)
+			self.frame_ends.clear()
+
+	def close(self):
+		# Whatever is still queued (a CA, say) must be sent, but can't keep
+		# referencing the mapping
+		if self.conn.stream_outgoing:
+			self.conn.stream_outgoing = bytes(self.conn.stream_outgoing)
+		self.view.release()
+		if self.size:
+			self.map.close()
+		self.f.close()
+
+class YAPPReceiver(YAPPTransfer):
+	def __init__(self, conn, directory, resume=True):
+		super().__init__(conn)
+		self.directory = directory
+		self.resume = resume
+		self.path = None
+		self.f = None
+		self.state = 'SI'
+
+	def handle(self, frame, body):
+		if self.state == 'SI' and frame == SI:
+			self.send(RR)
+			self.state = 'HD'
+		elif self.state == 'HD' and frame[0] == SOH:
+			fields = body.split(b'\x00')
+			name = os.path.basename(fields[0].decode('ascii', 'replace'))
+			self.name = name if name not in ('', '.', '..') else 'unnamed'
+			self.size = int(fields[1]) if len(fields) > 1 and fields[1].isdigit() else None
+			self.path = os.path.join(self.directory, self.name)
+
+			have = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+			try:
+				if self.resume and have and (self.size is None or have < self.size):
+					self.f = open(self.path, 'ab')
+					self.offset = self.resumed_from = have
+					self.send(yapp_frame(NAK, b'R\x00' + str(have).encode() + b'\x00'))
+				else:
+					self.f = open(self.path, 'wb')
+					self.send(RF)
+			except OSError as e:
+				self.cancel(f"Can't write {self.name}: {e.strerror}")
+				return
+			self.started = time.time()
+			self.state = 'DT'
+		elif self.state == 'DT' and frame[0] == STX:
+			try:
+				self.f.write(body)
+			except OSError as e: # Disk full, say; the partial file stays for a resume
+				self.f.close()
+				self.f = None
+				self.cancel(f"Can't write {self.name}: {e.strerror}")
+				return
+			self.offset += len(body)
+		elif self.state == 'DT' and frame == EF:
+			self.f.close()
+			self.f = None
+			self.send(AF)
+			self.state = 'ET'
+		elif self.state == 'ET' and frame == ET:
+			self.send(AT)
+			self._finish()
+
+	def close(self):
+		if self.f:
+			self.f.close() # Keep the partial file so the transfer can resume